@@ -63,7 +63,7 @@ def syntax(retCode):
     print()
     print("Usage:")
     print("  python arcgiscsv_report.py dbServer network user password arcgiscsvFile arcgiscsvPathMatch")
-    print("    [-p] [-s sourceID] -t refDateTime [-e endTime]")
+    print("    [-p] [-s sourceID] -t refDateTime [-e endTime] [--graph-cache DIR]")
     print()
     print("where:")
     print("  -p outputs a problem report (suppresses other output)")
@@ -71,6 +71,8 @@ def syntax(retCode):
     print("  -t is the zero-reference time that all arrival time outputs are related to.")
     print("     (Note that the day is ignored.) Use the format HH:MM:SS.")
     print("  -e is the end time in seconds (86400 by default)")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
     sys.exit(retCode)
 
 def main(argv):
@@ -86,6 +88,7 @@ def main(argv):
     sourceID = 0
     endTime = 86400
     refTime = None
+    graphCache = None
     problemReport = False
     
     if len(argv) > 6:
@@ -102,19 +105,17 @@ def main(argv):
                 i += 1
             elif argv[i] == "-p":
                 problemReport = True
+            elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+                graphCache = argv[i + 1]
+                i += 1
             i += 1
     
     if refTime is None and not problemReport:
         print("ERROR: No reference time is specified.")
         syntax(1)
 
-    # Get the database connected:
-    print("INFO: Connect to database...", file = sys.stderr)
-    database = vista_network.connect(dbServer, userName, password, networkName)
-    
-    # Read in the topology from the VISTA database:
-    print("INFO: Read topology from database...", file = sys.stderr)
-    vistaGraph = vista_network.fillGraph(database)
+    # Read in the topology from the VISTA database, or from the graph cache:
+    vistaGraph = vista_network.loadGraph(dbServer, networkName, userName, password, graphCache = graphCache)
     
     # Read in the GPS track information:
     print("INFO: Read ArcGIS CSV GPS track '%s'..." % csvFilename, file = sys.stderr)
@@ -54,7 +54,11 @@ def syntax():
     """
     print("dump_gps outputs GPS information for GTFS shapefiles and VISTA points.")
     print("Usage:")
-    print("  python dump_gps.py dbServer network user password shapePath pathMatchFile")
+    print("  python dump_gps.py dbServer network user password shapePath pathMatchFile [--graph-cache DIR]")
+    print()
+    print("where:")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
     sys.exit(0)
 
 def main(argv):
@@ -67,10 +71,17 @@ def main(argv):
     password = argv[4]
     shapePath = argv[5]
     pathMatchFilename = argv[6]
+    graphCache = None
+    i = 7
+    while i < len(argv):
+        if argv[i] == "--graph-cache" and i < len(argv) - 1:
+            graphCache = argv[i + 1]
+            i += 1
+        i += 1
         
     # Restore the stuff that was built with path_match:
-    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs) = transit_gtfs.restorePathMatch(dbServer, networkName, userName, password,
-                                                                        shapePath, pathMatchFilename)
+    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, _, _) = transit_gtfs.restorePathMatch(dbServer, networkName,
+                                                        userName, password, shapePath, pathMatchFilename, graphCache = graphCache)
     print("INFO: Output CSV...", file = sys.stderr)
     dumpGPS(gtfsNodes, vistaGraph)
     print("INFO: Done.", file = sys.stderr)
@@ -26,7 +26,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
 from datetime import datetime
-from nmc_mm_lib import gtfs, vista_network, path_engine, compat
+from nmc_mm_lib import gtfs, vista_network, path_engine, compat, gps, graph_snapshot
 import operator, sys
 
 # A module that deals with reading CSV files extracted from a GDB format.
@@ -38,7 +38,20 @@ def syntax():
     print("gdb_extracted.py matches a GDB text format GPS track to a VISTA network series")
     print("of links and outputs a CSV format of data in the standard output format.")
     print("Usage:")
-    print("  python gdb_extracted.py dbServer network user password gdbTextFile")
+    print("  python gdb_extracted.py dbServer network user password gdbTextFile [--workers N] [--chunk N]")
+    print("    [--graph-cache DIR [--tiles FT] [--tile-cache N]] [--clip-network]")
+    print()
+    print("where:")
+    print("  --workers matches datafiles in N parallel processes (default: 1)")
+    print("  --chunk matches each datafile in overlapping chunks of N points, with the chunks spread across the")
+    print("      worker processes; use for long tracks")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("      it from there while the network tables are unchanged")
+    print("  --tiles keeps the graph cache in square tiles FT feet on a side and reads them in only")
+    print("      as they are needed, for networks that are too large to hold in memory")
+    print("  --tile-cache keeps up to N tiles in memory (default: %d)" % graph_snapshot.DEFAULT_MAX_TILES)
+    print("  --clip-network reads only the part of the network within reach of the GPS tracks,")
+    print("      which saves time and memory on large networks")
     sys.exit(0)
 
 def fillFromFile(filename, GPS):
@@ -90,7 +103,8 @@ def fillFromFile(filename, GPS):
     # Return the shapes file contents:
     return ret
 
-def pathMatch(dbServer, networkName, userName, password, filename, limitMap = None):
+def pathMatch(dbServer, networkName, userName, password, filename, limitMap = None, workers = 1, chunkSize = None,
+              graphCache = None, clipNetwork = False, tileSize = None, maxTiles = graph_snapshot.DEFAULT_MAX_TILES):
     # Default parameters, with explanations and cross-references to Perrine et al., 2015:
     pointSearchRadius = 1000    # "k": Radius (ft) to search from GTFS point to perpendicular VISTA links
     pointSearchPrimary = 350    # "k_p": Radius (ft) to search from GTFS point to new VISTA links    
@@ -106,13 +120,16 @@ def pathMatch(dbServer, networkName, userName, password, filename, limitMap = No
     
     maxHops = 12                # Maximum number of VISTA links to pursue in a path-finding operation
     
-    # Get the database connected:
-    print("INFO: Connect to database...", file = sys.stderr)
-    database = vista_network.connect(dbServer, userName, password, networkName)
+    # Work out the area that the tracks cover, so that only the part of the network that can be reached from them
+    # needs to be read.  Only the latitudes and longitudes matter here, so any GPS center will do:
+    extent = None
+    if clipNetwork:
+        extent = vista_network.shapesExtent(compat.listvalues(fillFromFile(filename, gps.GPS(0.0, 0.0))))
     
-    # Read in the topology from the VISTA database:
-    print("INFO: Read topology from database...", file = sys.stderr)
-    vistaGraph = vista_network.fillGraph(database)
+    # Read in the topology from the VISTA database, or from the graph cache:
+    vistaGraph = vista_network.loadGraph(dbServer, networkName, userName, password, graphCache = graphCache,
+                                         extent = extent, extentBuffer = pointSearchRadius + limitLinearDist,
+                                         tileSize = tileSize, maxTiles = maxTiles)
     
     # Read in the GPS track information:
     print("INFO: Read GDB GPS track...", file = sys.stderr)
@@ -136,17 +153,12 @@ def pathMatch(dbServer, networkName, userName, password, filename, limitMap = No
             if datafileID not in datafileIDs:
                 print("WARNING: Limit datafile ID %d is not found in the shape file." % datafileID, file = sys.stderr)
     
-    for datafileID in datafileIDs:
-        "@type datafileID: int"
-        
-        if limitMap is not None and datafileID not in limitMap:
-            continue
-        
-        print("INFO: -- Datafile %s --" % datafileID, file = sys.stderr)
-        
-        # Find the path for the given shape:
-        gtfsNodes = pathFinder.constructPath(gpsTracks[datafileID], vistaGraph)
+    if limitMap is not None:
+        datafileIDs = [datafileID for datafileID in datafileIDs if datafileID in limitMap]
     
+    # Find the path for each track, possibly across worker processes:
+    for (datafileID, gtfsNodes) in path_engine.constructPaths(pathFinder, gpsTracks, datafileIDs, vistaGraph, workers,
+                                                              "Datafile", chunkSize):
         # File this away as a result for later output:
         nodesResults[datafileID] = gtfsNodes
     return nodesResults
@@ -160,8 +172,36 @@ def main(argv):
     userName = argv[3]
     password = argv[4]
     filename = argv[5]
+    workers = 1
+    chunkSize = None
+    graphCache = None
+    clipNetwork = False
+    tileSize = None
+    maxTiles = graph_snapshot.DEFAULT_MAX_TILES
+    i = 6
+    while i < len(argv):
+        if argv[i] == "--workers" and i < len(argv) - 1:
+            workers = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--chunk" and i < len(argv) - 1:
+            chunkSize = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+            graphCache = argv[i + 1]
+            i += 1
+        elif argv[i] == "--tiles" and i < len(argv) - 1:
+            tileSize = float(argv[i + 1])
+            i += 1
+        elif argv[i] == "--tile-cache" and i < len(argv) - 1:
+            maxTiles = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--clip-network":
+            clipNetwork = True
+        i += 1
     
-    gtfsNodesResults = pathMatch(dbServer, networkName, userName, password, filename)
+    gtfsNodesResults = pathMatch(dbServer, networkName, userName, password, filename, workers = workers,
+                                 chunkSize = chunkSize, graphCache = graphCache, clipNetwork = clipNetwork,
+                                 tileSize = tileSize, maxTiles = maxTiles)
     
     # Extract useful information:
     print("INFO: -- Final --", file = sys.stderr)
@@ -62,7 +62,7 @@ def syntax(retCode):
     print()
     print("Usage:")
     print("  python gdb_report.py dbServer network user password gdbTextFile gdbPathMatch")
-    print("    [-p] [-g] [-s sourceID] -t refDateTime [-e endTime]")
+    print("    [-p] [-g] [-s sourceID] -t refDateTime [-e endTime] [--graph-cache DIR]")
     print()
     print("where:")
     print("  -p outputs a problem report (suppresses other output)")
@@ -71,6 +71,8 @@ def syntax(retCode):
     print("  -t is the zero-reference time that all arrival time outputs are related to.")
     print("     (Note that the day is ignored.) Use the format HH:MM:SS.")
     print("  -e is the end time in seconds (86400 by default)")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
     sys.exit(retCode)
 
 def main(argv):
@@ -86,6 +88,7 @@ def main(argv):
     sourceID = 0
     endTime = 86400
     refTime = None
+    graphCache = None
     problemReport = False
     gdbReportFlag = False
     
@@ -105,6 +108,9 @@ def main(argv):
                 problemReport = True
             elif argv[i] == "-g":
                 gdbReportFlag = True
+            elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+                graphCache = argv[i + 1]
+                i += 1
             i += 1
     
     if refTime is None and not problemReport:
@@ -114,13 +120,8 @@ def main(argv):
         print("ERROR: Cannot output both a problem report and a GDB report.")
         syntax(1)
 
-    # Get the database connected:
-    print("INFO: Connect to database...", file = sys.stderr)
-    database = vista_network.connect(dbServer, userName, password, networkName)
-    
-    # Read in the topology from the VISTA database:
-    print("INFO: Read topology from database...", file = sys.stderr)
-    vistaGraph = vista_network.fillGraph(database)
+    # Read in the topology from the VISTA database, or from the graph cache:
+    vistaGraph = vista_network.loadGraph(dbServer, networkName, userName, password, graphCache = graphCache)
     
     # Read in the GPS track information:
     print("INFO: Read GDB GPS track '%s'..." % gdbFilename, file = sys.stderr)
@@ -0,0 +1,403 @@
+"""
+match_service.py keeps a VISTA network loaded and matches series of GPS points to it on
+    request over a local socket, answering in the standard path-match CSV format.
+@author: Kenneth Perrine
+@contact: kperrine@utexas.edu
+@organization: Network Modeling Center, Center for Transportation Research,
+    Cockrell School of Engineering, The University of Texas at Austin
+@version: 1.0
+
+@copyright: (C) 2014, The University of Texas at Austin
+@license: GPL v3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+from nmc_mm_lib import gtfs, vista_network, path_engine
+import os, signal, socket, stat, sys, time
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver # Python 2
+try:
+    from cStringIO import StringIO # Python 2
+except ImportError:
+    from io import StringIO
+
+# A request is a line that begins with "MATCH", followed by any "name=value" parameters separated by spaces, then
+# one "lat,lng" line per point.  It ends with a blank line or with the end of the stream.  The response is the
+# path-match CSV that path_engine.dumpStandardInfo() produces, or a single line that begins with "ERROR:".  If the
+# search had been narrowed because shapeTimeLimit was reached, the CSV is followed by a line that begins with
+# "WARNING:".
+
+# Default parameters, the same as those of path_match; each can be given in a request:
+DEFAULT_PARAMS = {
+    "pointSearchRadius": 1000.0,    # "k": Radius (ft) to search from GTFS point to perpendicular VISTA links
+    "pointSearchPrimary": 350.0,    # "k_p": Radius (ft) to search from GTFS point to new VISTA links
+    "pointSearchSecondary": 200.0,  # "k_s": Radius (ft) to search from VISTA perpendicular point to previous point
+    "limitLinearDist": 3800.0,      # Path distance (ft) to allow new proposed paths from one point to another
+    "limitDirectDist": 3500.0,      # Radius (ft) to allow new proposed paths from one point to another
+    "limitDirectDistRev": 500.0,    # Radius (ft) to allow backtracking on an existing link (e.g. parking lot)
+    "distanceFactor": 1.0,          # "f_d": Cost multiplier for Linear path distance
+    "driftFactor": 2.0,             # "f_r": Cost multiplier for distance from GTFS point to its VISTA link
+    "nonPerpPenalty": 1.5,          # "f_p": Penalty multiplier for points that aren't perpendicular to VISTA links
+    "limitClosestPoints": 12,       # "q_p": Number of close-proximity points that are considered for each point
+    "limitSimultaneousPaths": 8,    # "q_e": Number of proposed paths to maintain during pathfinding stage
+    "maxHops": 12,                  # Maximum number of VISTA links to pursue in a path-finding operation
+    "escalationSteps": 0}           # Number of times to retry a point with the radii and hops cut in half
+"@var DEFAULT_PARAMS: dict<str, float>"
+
+# Parameters that are off unless given in a request, as for path_match --ambiguity, --beam-margin and --time-limit:
+OPTIONAL_PARAMS = ("candidateAmbiguity", "beamMargin", "shapeTimeLimit")
+"@var OPTIONAL_PARAMS: tuple<str>"
+
+DEFAULT_MAX_CLIENTS = 8
+
+def syntax():
+    """
+    Print usage information
+    """
+    print("match_service.py keeps a VISTA network loaded and matches series of GPS points to it on request")
+    print("over a local socket, answering in the standard path-match CSV format.")
+    print("Usage:")
+    print("  python match_service.py dbServer network user password (--socket PATH | --port N)")
+    print("    [--graph-cache DIR] [--max-clients N]")
+    print("  python match_service.py --query (--socket PATH | --port N) pointsFile {[name=value] ...}")
+    print()
+    print("where:")
+    print("  --socket listens on (or, with --query, connects to) the Unix-domain socket PATH")
+    print("  --port listens on (or connects to) TCP port N on localhost")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("      it from there while the network tables are unchanged")
+    print("  --max-clients matches up to N requests at the same time, each in its own forked process")
+    print("      (default: %d)" % DEFAULT_MAX_CLIENTS)
+    print("  --query sends the points in pointsFile, one \"lat,lng\" per line, to a running service")
+    print("      and writes the response to standard output")
+    print("  name=value sets shapeID (the ID written in the output; default: 1) or overrides a parameter:")
+    print("      %s" % ", ".join(sorted(DEFAULT_PARAMS) + list(OPTIONAL_PARAMS)))
+    sys.exit(0)
+
+def parseParams(paramStrs):
+    """
+    parseParams reads "name=value" strings into the shape ID and a set of matching parameters that starts out
+    with DEFAULT_PARAMS.  A ValueError is raised for unknown names or bad values.
+    @type paramStrs: list<str>
+    @return The shape ID and the parameters
+    @rtype (str, dict<str, float>)
+    """
+    shapeID = "1"
+    params = dict(DEFAULT_PARAMS)
+    "@type params: dict<str, float>"
+    for paramStr in paramStrs:
+        (name, sep, value) = paramStr.partition("=")
+        if not sep:
+            raise ValueError("Parameter '%s' isn't of the form name=value." % paramStr)
+        if name == "shapeID":
+            shapeID = value
+        elif name in DEFAULT_PARAMS:
+            params[name] = type(DEFAULT_PARAMS[name])(value)
+        elif name in OPTIONAL_PARAMS:
+            params[name] = float(value)
+        else:
+            raise ValueError("Unknown parameter '%s'." % name)
+    return (shapeID, params)
+
+def matchPoints(vistaGraph, points, shapeID, params):
+    """
+    matchPoints finds the path through vistaGraph for a series of GPS points.  A new PathEngine is made for each
+    call, so calls that share vistaGraph may be made at the same time from different threads.
+    @type vistaGraph: graph.GraphLib
+    @param points: The latitude and longitude of each point
+    @type points: list<(float, float)>
+    @type shapeID: str
+    @param params: Parameters as returned by parseParams()
+    @type params: dict<str, float>
+    @return The path, and whether the search had reached shapeTimeLimit
+    @rtype (list<path_engine.PathEnd>, bool)
+    """
+    shapeEntries = []
+    "@type shapeEntries: list<gtfs.ShapesEntry>"
+    for (index, (lat, lng)) in enumerate(points):
+        shapeEntry = gtfs.ShapesEntry(shapeID, index + 1, lat, lng)
+        (shapeEntry.pointX, shapeEntry.pointY) = vistaGraph.gps.gps2feet(lat, lng)
+        shapeEntries.append(shapeEntry)
+
+    pathFinder = path_engine.PathEngine(params["pointSearchRadius"], params["pointSearchPrimary"],
+        params["pointSearchSecondary"], params["limitLinearDist"], params["limitDirectDist"],
+        params["limitDirectDistRev"], params["distanceFactor"], params["driftFactor"], params["nonPerpPenalty"],
+        params["limitClosestPoints"], params["limitSimultaneousPaths"])
+    pathFinder.maxHops = params["maxHops"]
+    pathFinder.escalationSteps = params["escalationSteps"]
+    pathFinder.candidateAmbiguity = params.get("candidateAmbiguity")
+    pathFinder.beamMargin = params.get("beamMargin")
+    pathFinder.shapeTimeLimit = params.get("shapeTimeLimit")
+    pathFinder.logFile = None # The service logs one line per request instead.
+    treeNodes = pathFinder.constructPath(shapeEntries, vistaGraph)
+    return (treeNodes, len(pathFinder.overBudgetShapes) > 0)
+
+class MatchHandler(socketserver.StreamRequestHandler):
+    """
+    MatchHandler answers one match request on a connection.
+    """
+    def _readRequest(self):
+        """
+        _readRequest reads the request from the connection.  A ValueError is raised if it isn't well-formed.
+        @return The shape ID, the parameters and the points, or None if the connection was closed without a request
+        @rtype (str, dict<str, float>, list<(float, float)>)
+        """
+        headerLine = self.rfile.readline()
+        if not headerLine:
+            return None
+        header = headerLine.decode("utf-8").split()
+        if not header or header[0] != "MATCH":
+            raise ValueError("The request doesn't begin with MATCH.")
+        (shapeID, params) = parseParams(header[1:])
+        points = []
+        "@type points: list<(float, float)>"
+        for line in self.rfile:
+            line = line.decode("utf-8").strip()
+            if not line:
+                break
+            (lat, lng) = line.split(",")
+            points.append((float(lat), float(lng)))
+        if not points:
+            raise ValueError("The request has no points.")
+        return (shapeID, params, points)
+    
+    def _reply(self, text):
+        """
+        _reply sends the response, unless the client has gone away.
+        @type text: str
+        """
+        try:
+            self.wfile.write(text.encode("utf-8"))
+            self.wfile.flush()
+        except socket.error as e:
+            print("WARNING: Couldn't answer a request: %s" % str(e), file = sys.stderr)
+    
+    def handle(self):
+        startTime = time.time()
+        try:
+            request = self._readRequest()
+        except Exception as e:
+            print("WARNING: Rejected a request: %s" % str(e), file = sys.stderr)
+            self._reply("ERROR: %s\n" % str(e))
+            return
+        if request is None:
+            return
+        (shapeID, params, points) = request
+
+        try:
+            matchTime = time.time()
+            (treeNodes, overBudget) = matchPoints(self.server.vistaGraph, points, shapeID, params)
+            "@type treeNodes: list<path_engine.PathEnd>"
+            matchTime = time.time() - matchTime
+            
+            outFile = StringIO()
+            path_engine.dumpStandardHeader(outFile)
+            path_engine.dumpStandardInfo(treeNodes, outFile)
+            if overBudget:
+                print("WARNING: The time limit was reached, so the search was narrowed.", file = outFile)
+        except Exception as e:
+            print("ERROR: Shape ID %s: matching failed: %s: %s" % (shapeID, type(e).__name__, str(e)),
+                  file = sys.stderr)
+            self._reply("ERROR: Matching failed: %s: %s\n" % (type(e).__name__, str(e)))
+            return
+        self._reply(outFile.getvalue())
+        print("INFO: Shape ID %s: matched %d points in %.3f s%s; answered in %.3f s." % (shapeID, len(points),
+            matchTime, " (time limit reached)" if overBudget else "", time.time() - startTime), file = sys.stderr)
+
+def _serverClass(unixSocket):
+    """
+    _serverClass returns a server class that handles each request in a forked process that shares the loaded
+    network copy-on-write, or in a thread where the platform can't fork.
+    @type unixSocket: bool
+    """
+    if hasattr(os, "fork"):
+        concurrency = socketserver.ForkingMixIn
+    else:
+        concurrency = socketserver.ThreadingMixIn
+    base = socketserver.UnixStreamServer if unixSocket else socketserver.TCPServer
+    return type("MatchServer", (concurrency, base), {"allow_reuse_address": True, "daemon_threads": True})
+
+def _isSocket(path):
+    """
+    _isSocket returns True if path is a Unix-domain socket file, as opposed to anything else or nothing at all.
+    @type path: str
+    @rtype bool
+    """
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+def _clearSocketPath(socketPath):
+    """
+    _clearSocketPath removes a socket file left behind at socketPath by a service that is no longer running.  An
+    IOError is raised if something else is there, or if a service is still listening on it.
+    @type socketPath: str
+    """
+    if not os.path.lexists(socketPath):
+        return
+    if not _isSocket(socketPath):
+        raise IOError("'%s' already exists and isn't a socket." % socketPath)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socketPath)
+    except socket.error:
+        os.remove(socketPath)
+        return
+    finally:
+        probe.close()
+    raise IOError("Another service is already listening on '%s'." % socketPath)
+
+def serve(vistaGraph, socketPath = None, port = None, maxClients = DEFAULT_MAX_CLIENTS):
+    """
+    serve answers match requests on the Unix-domain socket socketPath, or else on the localhost TCP port, until
+    interrupted.  A socket file that is left over at socketPath is replaced, but nothing else is.
+    @type vistaGraph: graph.GraphLib
+    @type socketPath: str
+    @type port: int
+    @type maxClients: int
+    """
+    # Build the search structures now so that every request finds them ready:
+    vistaGraph.compactGraph()
+
+    if socketPath is not None:
+        _clearSocketPath(socketPath)
+        server = _serverClass(True)(socketPath, MatchHandler)
+    else:
+        server = _serverClass(False)(("127.0.0.1", port), MatchHandler)
+    server.vistaGraph = vistaGraph
+    server.max_children = maxClients
+
+    # Clean up on SIGTERM as well as on an interrupt, so that the socket file doesn't linger:
+    def _stop(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, _stop)
+    print("INFO: Listening on %s." % (socketPath if socketPath is not None else "localhost port %d" % port),
+          file = sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socketPath is not None and _isSocket(socketPath):
+            os.remove(socketPath)
+    print("INFO: Done.", file = sys.stderr)
+
+def query(points, paramStrs, socketPath = None, port = None):
+    """
+    query sends a match request to a running service and returns its response.
+    @type points: list<(float, float)>
+    @param paramStrs: "name=value" strings as accepted by parseParams()
+    @type paramStrs: list<str>
+    @type socketPath: str
+    @type port: int
+    @rtype str
+    """
+    if socketPath is not None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socketPath)
+    else:
+        sock = socket.create_connection(("127.0.0.1", port))
+    try:
+        request = " ".join(["MATCH"] + list(paramStrs)) + "\n" + "".join(["%r,%r\n" % point for point in points])
+        sock.sendall(request.encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return b"".join(chunks).decode("utf-8")
+
+def main(argv):
+    # Initialize from command-line parameters:
+    queryMode = len(argv) > 1 and argv[1] == "--query"
+    if len(argv) < (3 if queryMode else 5):
+        syntax()
+    socketPath = None
+    port = None
+    graphCache = None
+    maxClients = DEFAULT_MAX_CLIENTS
+    positional = []
+    "@type positional: list<str>"
+    i = 2 if queryMode else 1
+    while i < len(argv):
+        if argv[i] == "--socket" and i < len(argv) - 1:
+            socketPath = argv[i + 1]
+            i += 1
+        elif argv[i] == "--port" and i < len(argv) - 1:
+            port = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+            graphCache = argv[i + 1]
+            i += 1
+        elif argv[i] == "--max-clients" and i < len(argv) - 1:
+            maxClients = int(argv[i + 1])
+            i += 1
+        else:
+            positional.append(argv[i])
+        i += 1
+    if (socketPath is None) == (port is None):
+        print("ERROR: Exactly one of --socket or --port must be given.", file = sys.stderr)
+        syntax()
+
+    if queryMode:
+        if not positional:
+            syntax()
+        points = []
+        "@type points: list<(float, float)>"
+        with open(positional[0], 'r') as inFile:
+            for line in inFile:
+                if line.strip():
+                    (lat, lng) = line.split(",")[0:2]
+                    points.append((float(lat), float(lng)))
+        startTime = time.time()
+        response = query(points, positional[1:], socketPath, port)
+        for line in response.splitlines(True):
+            # Keep the CSV on standard output clean:
+            if line.startswith("ERROR:") or line.startswith("WARNING:"):
+                sys.stderr.write(line)
+            else:
+                sys.stdout.write(line)
+        print("INFO: Sent %d points; the round trip took %.3f s." % (len(points), time.time() - startTime),
+              file = sys.stderr)
+        if response.startswith("ERROR:"):
+            sys.exit(1)
+        return
+
+    if len(positional) < 4:
+        syntax()
+    (dbServer, networkName, userName, password) = positional[0:4]
+    if socketPath is not None:
+        # Check on the socket before the network is read in:
+        try:
+            _clearSocketPath(socketPath)
+        except IOError as e:
+            print("ERROR: %s" % str(e), file = sys.stderr)
+            sys.exit(1)
+
+    # Read in the topology from the VISTA database, or from the graph cache, just once:
+    vistaGraph = vista_network.loadGraph(dbServer, networkName, userName, password, graphCache = graphCache)
+    serve(vistaGraph, socketPath, port, maxClients)
+
+# Boostrap:
+if __name__ == '__main__':
+    main(sys.argv)
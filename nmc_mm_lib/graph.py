@@ -25,7 +25,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
 from collections import deque
 from nmc_mm_lib import linear, gps 
-import sys, math, operator
+import array, sys, math, operator
 
 class GraphLink:
     """
@@ -124,6 +124,8 @@ class GraphLib:
     @type nodeMap: dict<int, GraphNode>
     @ivar linkMap: Collection of links
     @type linkMap: dict<int, GraphLink>
+    @ivar sourceChecksum: The vista_network.tableChecksum() of the tables that this was read from, if known
+    @type sourceChecksum: str
     """
     def __init__(self, gpsCtrLat, gpsCtrLng, useDirectDist=True):
         """
@@ -134,6 +136,8 @@ class GraphLib:
         self.nodeMap = {}
         self.linkMap = {}
         self.useDirectDist = useDirectDist
+        self.sourceChecksum = None
+        self._compactGraph = None
 
     def addNode(self, node):
         """
@@ -142,6 +146,7 @@ class GraphLib:
         """
         (node.coordX, node.coordY) = self.gps.gps2feet(node.gpsLat, node.gpsLng)
         self.nodeMap[node.id] = node
+        self._compactGraph = None
         
     def addLink(self, link):
         """
@@ -157,6 +162,17 @@ class GraphLib:
             # Otherwise, we must supply it ourselves.
         self.linkMap[link.id] = link
         self.nodeMap[link.origNode.id].outgoingLinkMap[link.id] = link
+        self._compactGraph = None
+    
+    def compactGraph(self):
+        """
+        compactGraph returns the CompactGraph form of this graph for WalkPathProcessor to search upon, building it
+        the first time and again after nodes or links are added.
+        @rtype CompactGraph
+        """
+        if self._compactGraph is None:
+            self._compactGraph = CompactGraph(self)
+        return self._compactGraph
         
     def findPointsOnLinks(self, pointX, pointY, radius, primaryRadius, secondaryRadius, prevPoints, limitClosestPoints = sys.maxsize):
         """
@@ -173,12 +189,24 @@ class GraphLib:
         @type limitClosestPoints: int
         @rtype list<PointOnLink>
         """
+        return self.filterPointsOnLinks(self.findLinksInRadius(pointX, pointY, radius), primaryRadius, secondaryRadius,
+                                        prevPoints, limitClosestPoints)
+    
+    def findLinksInRadius(self, pointX, pointY, radius):
+        """
+        findLinksInRadius is the first half of findPointsOnLinks(), which finds all PointOnLinks that are within the
+        radius.  This doesn't depend upon previous points, so the result can be kept and filtered with
+        filterPointsOnLinks() for different previous points.
+        @type pointX: float
+        @type pointY: float
+        @type radius: float
+        @return The squared distance from the point and the PointOnLink for each link within the radius
+        @rtype list<(float, PointOnLink)>
+        """
         # TODO: This brute-force implementation can be more efficient with quad trees, etc. rather than
         # scanning through all elements.
         radiusSq = radius ** 2
-        primaryRadiusSq = primaryRadius ** 2
-        secondaryRadiusSq = secondaryRadius ** 2
-        retSet = set()
+        ret = []
         
         # Find perpendicular and non-perpendicular PointOnLinks that are within radius.
         for link in self.linkMap.values():
@@ -186,31 +214,91 @@ class GraphLib:
             (distSq, linkDist, perpendicular) = linear.pointDistSq(pointX, pointY, link.origNode.coordX, link.origNode.coordY,
                                                                    link.destNode.coordX, link.destNode.coordY, link.distance)
             if distSq <= radiusSq:
-                pointOnLink = PointOnLink(link, linkDist, not perpendicular, math.sqrt(distSq))
-                
-                # We are within the initial search radius.  Are we then within the primary radius?
-                if distSq <= primaryRadiusSq:
-                    # Yes, easy.  Add to the list:
-                    retSet.add(pointOnLink)
-                else:
-                    # Check to see if the point is close to a previous point:
-                    for prevPoint in prevPoints:
-                        "@type prevPoint: PointOnLink"
-                        distSq = linear.getNormSq(pointOnLink.pointX, pointOnLink.pointY, prevPoint.pointX, prevPoint.pointY)
-                        if (distSq < secondaryRadiusSq):
-                            # We have a winner:
-                            retSet.add(pointOnLink)
-                            break
-                    
-        ret = list(retSet)
+                ret.append((distSq, PointOnLink(link, linkDist, not perpendicular, math.sqrt(distSq))))
+        return ret
+    
+    def filterPointsOnLinks(self, linksInRadius, primaryRadius, secondaryRadius, prevPoints,
+                            limitClosestPoints = sys.maxsize):
+        """
+        filterPointsOnLinks is the second half of findPointsOnLinks(), which keeps the links found by
+        findLinksInRadius() that are within primaryRadius distance of the GTFS point or secondaryRadius
+        distance from the previous VISTA points.
+        @type linksInRadius: list<(float, PointOnLink)>
+        @type primaryRadius: float
+        @type secondaryRadius: float
+        @type prevPoints: list<PointOnLink>
+        @type limitClosestPoints: int
+        @rtype list<PointOnLink>
+        """
+        primaryRadiusSq = primaryRadius ** 2
+        secondaryRadiusSq = secondaryRadius ** 2
+        ret = []
         
+        for (distSq, pointOnLink) in linksInRadius:
+            "@type pointOnLink: PointOnLink"
+            # We are within the initial search radius.  Are we then within the primary radius?
+            if distSq <= primaryRadiusSq:
+                # Yes, easy.  Add to the list:
+                ret.append(pointOnLink)
+            else:
+                # Check to see if the point is close to a previous point:
+                for prevPoint in prevPoints:
+                    "@type prevPoint: PointOnLink"
+                    distSq = linear.getNormSq(pointOnLink.pointX, pointOnLink.pointY, prevPoint.pointX, prevPoint.pointY)
+                    if (distSq < secondaryRadiusSq):
+                        # We have a winner:
+                        ret.append(pointOnLink)
+                        break
+                    
         # TODO: If there is a nonperpendicular link and distance = 0, and there also exists in the set a link
         # that leads to the first link's parent node, then get rid of that first link.
         
-        # Keep limited number of closest values 
+        # Keep limited number of closest values.  (The list is kept in link scan order rather than a set so that ties
+        # in refDist resolve the same way on every run and in every process.)
         ret.sort(key = operator.attrgetter('refDist'))
         return ret[0:limitClosestPoints]
 
+class CompactGraph:
+    """
+    CompactGraph is a frozen, compressed sparse row form of the links in a GraphLib.  Links and nodes are numbered
+    densely in the order that they had been added, and the links that leave each node are kept in the order of its
+    outgoingLinkMap, so that a search done on these arrays goes the same way as one done on the GraphLib.
+    
+    @ivar links: The GraphLink for each link index
+    @type links: list<GraphLink>
+    @ivar linkIndices: The link index for each link ID
+    @type linkIndices: dict<int, int>
+    @ivar offsets: Where the outgoing links of each node index begin in outgoing; the last is the end of outgoing
+    @type offsets: array<int>
+    @ivar outgoing: The link indices of the outgoing links of all of the nodes
+    @type outgoing: array<int>
+    @ivar origNodes: The origin node index of each link index
+    @type origNodes: array<int>
+    @ivar destNodes: The destination node index of each link index
+    @type destNodes: array<int>
+    @ivar lengths: The distance of each link index
+    @type lengths: array<float>
+    @ivar deadEnds: 1 for each link index whose destination node has only one outgoing link, or 0
+    @type deadEnds: array<int>
+    """
+    def __init__(self, graphLib):
+        """
+        @type graphLib: GraphLib
+        """
+        nodeIndices = dict([(node.id, index) for (index, node) in enumerate(graphLib.nodeMap.values())])
+        "@type nodeIndices: dict<int, int>"
+        self.links = list(graphLib.linkMap.values())
+        self.linkIndices = dict([(link.id, index) for (index, link) in enumerate(self.links)])
+        self.offsets = array.array("i", [0])
+        self.outgoing = array.array("i")
+        for node in graphLib.nodeMap.values():
+            self.outgoing.extend([self.linkIndices[linkID] for linkID in node.outgoingLinkMap])
+            self.offsets.append(len(self.outgoing))
+        self.origNodes = array.array("i", [nodeIndices[link.origNode.id] for link in self.links])
+        self.destNodes = array.array("i", [nodeIndices[link.destNode.id] for link in self.links])
+        self.lengths = array.array("d", [link.distance for link in self.links])
+        self.deadEnds = array.array("b", [1 if len(link.destNode.outgoingLinkMap) == 1 else 0 for link in self.links])
+
 class WalkPathProcessor:
     """
     WalkPathProcessor contains methods used to conduct the walkPath algorithm.  It maintains a cache that
@@ -232,6 +320,13 @@ class WalkPathProcessor:
     @type pointOnLinkOrig: PointOnLink
     @ivar pointOnLinkDest: For internal record-keeping
     @type pointOnLinkDest: PointOnLink
+    @ivar routeCache: Set this to a dict to keep walkPath results for reuse; see walkPath()
+    @type routeCache: dict<(int, int, int), (PointOnLink, PointOnLink, int, list<GraphLink>, float)>
+    @ivar backCacheChanges: Counts the changes to backCache for each destination link ID
+    @type backCacheChanges: dict<int, int>
+    @ivar compactGraph: Set this to the CompactGraph of the graph being searched to search upon its arrays rather
+        than upon the GraphLink objects.  backCache is then keyed by link index and holds link indices.
+    @type compactGraph: CompactGraph
     """        
     def __init__(self, limitRadius, limitDistance, limitRadiusRev, limitSteps):
         """
@@ -253,6 +348,9 @@ class WalkPathProcessor:
 
         # walkPath cache:
         self.backCache = {}
+        self.routeCache = None
+        self.backCacheChanges = {}
+        self.compactGraph = None
         
         # Keep the running score:
         self.backtrackScore = limitDistance
@@ -308,6 +406,34 @@ class WalkPathProcessor:
         evaluating target nodes, and maximum distance traversed.  Also specify a smaller radius for small distances backwards.
         If nothing is found, then None is returned.  An empty list signifies that the destination is on the same link as the
         origin.
+        If routeCache is set, a result is reused when the same pair of PointOnLinks is asked for again while the
+        backCache for the destination link is the same as it had been for the original search, so the result is
+        the same as that of a new search.
+        @type pointOnLinkOrig: PointOnLink
+        @type pointOnLinkDest: PointOnLink
+        @rtype list<GraphLink>, float
+        """
+        search = self._walkPathSearch if self.compactGraph is None else self._walkPathCompact
+        if self.routeCache is None:
+            return search(pointOnLinkOrig, pointOnLinkDest)
+        
+        key = (id(pointOnLinkOrig), id(pointOnLinkDest), self.limitSteps)
+        changes = self.backCacheChanges.get(pointOnLinkDest.link.id, 0)
+        if key in self.routeCache:
+            (cachedOrig, cachedDest, cachedChanges, traversed, distance) = self.routeCache[key]
+            if (cachedOrig is pointOnLinkOrig) and (cachedDest is pointOnLinkDest) and (cachedChanges == changes):
+                return (list(traversed) if traversed is not None else None, distance)
+        (traversed, distance) = search(pointOnLinkOrig, pointOnLinkDest)
+        
+        # Only keep the result if the search itself didn't change the backCache that it had relied upon:
+        if self.backCacheChanges.get(pointOnLinkDest.link.id, 0) == changes:
+            self.routeCache[key] = (pointOnLinkOrig, pointOnLinkDest, changes,
+                                    list(traversed) if traversed is not None else None, distance)
+        return (traversed, distance)
+    
+    def _walkPathSearch(self, pointOnLinkOrig, pointOnLinkDest):
+        """
+        _walkPathSearch does the search for walkPath().
         @type pointOnLinkOrig: PointOnLink
         @type pointOnLinkDest: PointOnLink
         @rtype list<GraphLink>, float
@@ -381,6 +507,8 @@ class WalkPathProcessor:
                             and (mappings[element.prevStruct.incomingLink.id] is element.incomingLink):
                         break
                     mappings[element.prevStruct.incomingLink.id] = element.incomingLink
+                    self.backCacheChanges[self.pointOnLinkDest.link.id] = \
+                        self.backCacheChanges.get(self.pointOnLinkDest.link.id, 0) + 1
                     element = element.prevStruct
                 
             # Process the next queue element:
@@ -417,3 +545,110 @@ class WalkPathProcessor:
             
             # Add to the queue for processing later:
             self.processingQueue.append(self._WalkPathNext(self, walkPathElem, link))
+
+    def _walkPathCompact(self, pointOnLinkOrig, pointOnLinkDest):
+        """
+        _walkPathCompact does the search for walkPath() upon the arrays of compactGraph.  It is the same
+        breadth-first search as _walkPathSearch() and _walkPath(), with each queue element held as a tuple of
+        (previous element, incoming link index, distance, step count, backtrack set).
+        @type pointOnLinkOrig: PointOnLink
+        @type pointOnLinkDest: PointOnLink
+        @rtype list<GraphLink>, float
+        """
+        # Are the points too far away to begin with?
+        if (pointOnLinkDest.pointX - pointOnLinkOrig.pointX) ** 2 \
+                + (pointOnLinkDest.pointY - pointOnLinkOrig.pointY) ** 2 > self.limitRadiusSq:
+            return (None, 0)
+        
+        compactGraph = self.compactGraph
+        offsets = compactGraph.offsets
+        outgoing = compactGraph.outgoing
+        origNodes = compactGraph.origNodes
+        destNodes = compactGraph.destNodes
+        lengths = compactGraph.lengths
+        deadEnds = compactGraph.deadEnds
+        limitSteps = self.limitSteps
+        uTurnInterPenalty = self.uTurnInterPenalty
+        uTurnDeadEndPenalty = self.uTurnDeadEndPenalty
+        
+        origIndex = compactGraph.linkIndices[pointOnLinkOrig.link.id]
+        destIndex = compactGraph.linkIndices[pointOnLinkDest.link.id]
+        destRemainder = lengths[destIndex] - pointOnLinkDest.dist
+        shortcuts = self.backCache.get(destIndex)
+        "@type shortcuts: dict<int, int>"
+        backtrackScore = self.limitDistance
+        winner = None
+        
+        # Preload the queue with the first starting location:
+        distance = lengths[origIndex] - pointOnLinkOrig.dist
+        if origIndex == destIndex:
+            distance -= destRemainder
+        processingQueue = deque([(None, origIndex, distance, 0, frozenset((origIndex,)))])
+        
+        # Do the breadth-first search:
+        while processingQueue:
+            walkPathElem = processingQueue.popleft()
+            (_, incomingIndex, distance, stepCount, backtrackSet) = walkPathElem
+            if stepCount >= limitSteps or distance >= backtrackScore:
+                continue
+            
+            # Are we at the destination?
+            if incomingIndex == destIndex:
+                winner = walkPathElem
+                backtrackScore = distance
+                
+                # Log the winner into the cache by looking at all of the parent elements:
+                if shortcuts is None:
+                    shortcuts = self.backCache[destIndex] = {}
+                element = walkPathElem[0]
+                if element is not None:
+                    while element[0] is not None:
+                        prevIndex = element[0][1]
+                        if shortcuts.get(prevIndex) == element[1]:
+                            break
+                        shortcuts[prevIndex] = element[1]
+                        self.backCacheChanges[pointOnLinkDest.link.id] = \
+                            self.backCacheChanges.get(pointOnLinkDest.link.id, 0) + 1
+                        element = element[0]
+                continue
+            
+            # Look at each link that comes out from the current node, or at the shortcut to our destination:
+            if (shortcuts is not None) and (incomingIndex in shortcuts):
+                nextIndices = (shortcuts[incomingIndex],)
+            else:
+                nodeIndex = destNodes[incomingIndex]
+                nextIndices = outgoing[offsets[nodeIndex]:offsets[nodeIndex + 1]]
+            stepCount += 1
+            for linkIndex in nextIndices:
+                # Filter out U-turns:
+                if destNodes[linkIndex] == origNodes[incomingIndex] and origNodes[linkIndex] == destNodes[incomingIndex]:
+                    if deadEnds[linkIndex] and uTurnDeadEndPenalty is not None:
+                        distance += uTurnDeadEndPenalty
+                    elif uTurnInterPenalty is None:
+                        continue
+                    else:
+                        distance += uTurnInterPenalty
+                
+                # Had we visited this before?
+                if linkIndex in backtrackSet:
+                    continue
+                
+                # Add to the queue for processing later:
+                nextDistance = distance + lengths[linkIndex]
+                if linkIndex == destIndex:
+                    nextDistance -= destRemainder
+                processingQueue.append((walkPathElem, linkIndex, nextDistance, stepCount,
+                                        backtrackSet.union((linkIndex,))))
+        
+        # Set up the return.  (Ignore the first link because we hadn't technically traversed it.)
+        if winner is not None:
+            links = compactGraph.links
+            retList = []
+            "@type retList: list<GraphLink>"
+            element = winner
+            while element[0] is not None:
+                retList.append(links[element[1]])
+                element = element[0]
+            retList.reverse()
+            return (retList, winner[2])
+        return (None, 0)
@@ -0,0 +1,686 @@
+"""
+graph_snapshot.py saves a loaded network to a binary snapshot file and loads it
+    back again, so that the topology doesn't need to be read from the database
+    and worked out on every run.  A network can also be saved in spatial tiles
+    that are paged in as they are needed, for networks too large to hold in
+    memory all at once.
+@author: Kenneth Perrine
+@contact: kperrine@utexas.edu
+@organization: Network Modeling Center, Center for Transportation Research,
+    Cockrell School of Engineering, The University of Texas at Austin
+@version: 1.0
+
+@copyright: (C) 2014, The University of Texas at Austin
+@license: GPL v3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+from nmc_mm_lib import graph, linear
+from bisect import bisect_left
+from collections import OrderedDict
+import array, hashlib, math, mmap, os, sys, weakref
+
+SNAPSHOT_MAGIC = b"NMCGRAPH 1\n"
+"@var SNAPSHOT_MAGIC: The first line of every snapshot file, which changes along with the format."
+
+# The arrays that make up a snapshot, in the order that they are written.  Each is (name, typecode).
+_NODE_ARRAYS = (("ids", "i"), ("gpsLats", "d"), ("gpsLngs", "d"), ("coordXs", "d"), ("coordYs", "d"))
+_LINK_ARRAYS = (("ids", "i"), ("origIDs", "i"), ("destIDs", "i"), ("distances", "d"))
+
+TILES_MAGIC = b"NMCTILES 2\n"
+"@var TILES_MAGIC: The first line of every tiled snapshot file, which changes along with the format."
+DEFAULT_MAX_TILES = 64
+"@var DEFAULT_MAX_TILES: The number of tiles that a TiledGraphLib keeps loaded by default."
+
+# The arrays that make up a tiled snapshot.  The tile table and the ID indices are read in whole; the node and link
+# arrays are grouped by tile, and only the parts for a tile are read in when the tile is needed.  Links are put in
+# the tile of their origin nodes.  Each tile records how far its links reach outside of its square, and each link the
+# coordinates of its destination node, so that links can be measured without reading in the tiles of their
+# destinations.
+_TILE_ARRAYS = (("tileXs", "i"), ("tileYs", "i"), ("tileReaches", "d"), ("tileNodeStarts", "i"),
+                ("tileLinkStarts", "i"))
+_INDEX_ARRAYS = (("nodeIndexIDs", "i"), ("nodeIndexTiles", "i"), ("linkIndexIDs", "i"), ("linkIndexTiles", "i"))
+_TILED_NODE_ARRAYS = (("nodeIDs", "i"), ("nodeGPSLats", "d"), ("nodeGPSLngs", "d"), ("nodeCoordXs", "d"),
+                      ("nodeCoordYs", "d"))
+_TILED_LINK_ARRAYS = (("linkIDs", "i"), ("linkOrigIDs", "i"), ("linkDestIDs", "i"), ("linkDestTiles", "i"),
+                      ("linkDestCoordXs", "d"), ("linkDestCoordYs", "d"), ("linkDistances", "d"), ("linkOrdinals", "i"))
+
+def snapshotFilename(cacheDir, dbServer, userName, networkName, useDirectDist, clipArea=None):
+    """
+    snapshotFilename returns the path of the snapshot file in cacheDir for the given network.
+    @type cacheDir: str
+    @type dbServer: str
+    @type userName: str
+    @type networkName: str
+    @type useDirectDist: bool
+    @param clipArea: The bounds and buffer that the network had been clipped to, or None if it wasn't
+    @type clipArea: tuple<float>
+    @rtype str
+    """
+    ident = "%s|%s|%s|%d" % (dbServer, userName, networkName, 1 if useDirectDist else 0)
+    if clipArea is not None:
+        ident += "|" + ",".join([repr(float(value)) for value in clipArea])
+    return os.path.join(cacheDir, "%s_%s_%s.graph" % (userName, networkName,
+        hashlib.md5(ident.encode("utf-8")).hexdigest()[:12]))
+
+def _formatKey(checksum):
+    """
+    _formatKey combines the table checksum with the sizes and byte order of the arrays on this platform, since
+    a snapshot is only good where these all match.
+    @type checksum: str
+    @rtype str
+    """
+    return "%s %s %d %d" % (checksum, sys.byteorder, array.array("i").itemsize, array.array("d").itemsize)
+
+def _toBytes(values):
+    """
+    _toBytes returns the raw contents of the given array.
+    @type values: array.array
+    @rtype bytes
+    """
+    return values.tobytes() if hasattr(values, "tobytes") else values.tostring()
+
+def _fromBytes(typecode, data):
+    """
+    _fromBytes makes an array out of raw contents.
+    @type typecode: str
+    @rtype array.array
+    """
+    ret = array.array(typecode)
+    if hasattr(ret, "frombytes"):
+        ret.frombytes(data)
+    else:
+        ret.fromstring(data)
+    return ret
+
+def saveSnapshot(graphLib, filename, checksum):
+    """
+    saveSnapshot writes out the nodes and links of graphLib, in the order that they had been added, along with the
+    GPS center and the link lengths that had been worked out.  The file is first written under another name and
+    then moved into place, so that a snapshot that is being read is never half-written.
+    @type graphLib: graph.GraphLib
+    @type filename: str
+    @param checksum: Identifies the contents of the tables that graphLib came from
+    @type checksum: str
+    """
+    nodes = list(graphLib.nodeMap.values())
+    "@type nodes: list<graph.GraphNode>"
+    links = list(graphLib.linkMap.values())
+    "@type links: list<graph.GraphLink>"
+    nodeArrays = [array.array("i", [node.id for node in nodes]), array.array("d", [node.gpsLat for node in nodes]),
+                  array.array("d", [node.gpsLng for node in nodes]), array.array("d", [node.coordX for node in nodes]),
+                  array.array("d", [node.coordY for node in nodes])]
+    linkArrays = [array.array("i", [link.id for link in links]), array.array("i", [link.origNode.id for link in links]),
+                  array.array("i", [link.destNode.id for link in links]),
+                  array.array("d", [float("nan") if link.distance is None else link.distance for link in links])]
+
+    header = "%s\n%r %r %d\n%d %d\n" % (_formatKey(checksum), float(graphLib.gps.latCtr), float(graphLib.gps.lngCtr),
+        1 if graphLib.useDirectDist else 0, len(nodes), len(links))
+    tempFilename = filename + ".tmp"
+    with open(tempFilename, "wb") as outFile:
+        outFile.write(SNAPSHOT_MAGIC)
+        outFile.write(header.encode("ascii"))
+        for values in nodeArrays + linkArrays:
+            outFile.write(_toBytes(values))
+    getattr(os, "replace", os.rename)(tempFilename, filename)
+
+def loadSnapshot(filename, checksum):
+    """
+    loadSnapshot restores the GraphLib that saveSnapshot() had written, or returns None if the file doesn't exist or
+    doesn't match the given checksum.  This saves the database reads and the coordinate and length calculations,
+    but every node and link object is still built anew, which takes on the order of a second for every few hundred
+    thousand of them.  For networks where that is too slow, see saveTiledSnapshot().
+    @type filename: str
+    @type checksum: str
+    @rtype graph.GraphLib
+    """
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        return None
+    with open(filename, "rb") as inFile:
+        data = mmap.mmap(inFile.fileno(), 0, access = mmap.ACCESS_READ)
+        try:
+            # Read the header:
+            headerEnd = 0
+            headerLines = []
+            "@type headerLines: list<str>"
+            for _ in range(4):
+                lineEnd = data.find(b"\n", headerEnd)
+                if lineEnd < 0:
+                    return None
+                headerLines.append(data[headerEnd:lineEnd + 1].decode("ascii", "replace"))
+                headerEnd = lineEnd + 1
+            if (headerLines[0].encode("ascii") != SNAPSHOT_MAGIC) or (headerLines[1].strip() != _formatKey(checksum)):
+                return None
+            (latCtr, lngCtr, useDirectDist) = headerLines[2].split()
+            (nodeCount, linkCount) = [int(value) for value in headerLines[3].split()]
+
+            # Pull out the arrays:
+            arrays = {}
+            "@type arrays: dict<str, array.array>"
+            position = headerEnd
+            for (prefix, specs, count) in (("node", _NODE_ARRAYS, nodeCount), ("link", _LINK_ARRAYS, linkCount)):
+                for (name, typecode) in specs:
+                    size = array.array(typecode).itemsize * count
+                    if position + size > len(data):
+                        return None
+                    arrays[prefix + name] = _fromBytes(typecode, data[position:position + size])
+                    position += size
+        finally:
+            data.close()
+
+    # Rebuild the graph.  Coordinates and lengths had already been worked out, so the nodes and links are put in
+    # place directly rather than through GraphLib.addNode() and GraphLib.addLink():
+    graphLib = graph.GraphLib(float(latCtr), float(lngCtr), useDirectDist == "1")
+    nodeMap = graphLib.nodeMap
+    linkMap = graphLib.linkMap
+    GraphNode = graph.GraphNode
+    GraphLink = graph.GraphLink
+    for (ident, gpsLat, gpsLng, coordX, coordY) in zip(*[arrays["node" + name].tolist() for (name, _) in _NODE_ARRAYS]):
+        node = GraphNode(ident, gpsLat, gpsLng)
+        node.coordX = coordX
+        node.coordY = coordY
+        nodeMap[ident] = node
+    for (ident, origID, destID, distance) in zip(*[arrays["link" + name].tolist() for (name, _) in _LINK_ARRAYS]):
+        origNode = nodeMap[origID]
+        link = GraphLink(ident, origNode, nodeMap[destID])
+        link.distance = None if distance != distance else distance
+        linkMap[ident] = link
+        origNode.outgoingLinkMap[ident] = link
+    return graphLib
+
+def tiledFilename(filename, tileSize):
+    """
+    tiledFilename returns the path of the tiled snapshot that goes along with the snapshot file name from
+    snapshotFilename().
+    @type filename: str
+    @type tileSize: float
+    @rtype str
+    """
+    return "%s_%g.tiles" % (os.path.splitext(filename)[0], tileSize)
+
+def _tileOvershoot(coordX, coordY, tileX, tileY, tileSize):
+    """
+    _tileOvershoot returns how far the given point lies outside of the square of the given tile along either axis,
+    or 0 if it is inside.
+    @type coordX: float
+    @type coordY: float
+    @type tileX: int
+    @type tileY: int
+    @type tileSize: float
+    @rtype float
+    """
+    return max(0.0, tileX * tileSize - coordX, coordX - (tileX + 1) * tileSize, tileY * tileSize - coordY,
+               coordY - (tileY + 1) * tileSize)
+
+def saveTiledSnapshot(graphLib, filename, checksum, tileSize):
+    """
+    saveTiledSnapshot writes out graphLib divided up into square tiles that are tileSize feet on a side, for
+    openTiledSnapshot() to page back in.  As with saveSnapshot(), the file is moved into place once it is written.
+    @type graphLib: graph.GraphLib
+    @type filename: str
+    @type checksum: str
+    @type tileSize: float
+    """
+    # Sort the nodes into tiles, keeping the order in which they had been added within each tile:
+    tileIndices = {}
+    "@type tileIndices: dict<(int, int), int>"
+    tileKeys = []
+    "@type tileKeys: list<(int, int)>"
+    tileNodes = []
+    "@type tileNodes: list<list<graph.GraphNode>>"
+    nodeTiles = {}
+    "@type nodeTiles: dict<int, int>"
+    for node in graphLib.nodeMap.values():
+        key = (int(math.floor(node.coordX / tileSize)), int(math.floor(node.coordY / tileSize)))
+        if key not in tileIndices:
+            tileIndices[key] = len(tileNodes)
+            tileKeys.append(key)
+            tileNodes.append([])
+        tileNodes[tileIndices[key]].append(node)
+        nodeTiles[node.id] = tileIndices[key]
+    
+    # The links go with the tiles of their origin nodes.  Keep track of where each had been in the graph, and of how
+    # far the links of each tile reach outside of its square:
+    tileLinks = [[] for _ in tileNodes]
+    "@type tileLinks: list<list<(int, graph.GraphLink)>>"
+    tileReaches = [0.0] * len(tileNodes)
+    "@type tileReaches: list<float>"
+    for (ordinal, link) in enumerate(graphLib.linkMap.values()):
+        tileIndex = nodeTiles[link.origNode.id]
+        tileLinks[tileIndex].append((ordinal, link))
+        (tileX, tileY) = tileKeys[tileIndex]
+        tileReaches[tileIndex] = max(tileReaches[tileIndex],
+            _tileOvershoot(link.origNode.coordX, link.origNode.coordY, tileX, tileY, tileSize),
+            _tileOvershoot(link.destNode.coordX, link.destNode.coordY, tileX, tileY, tileSize))
+    
+    arrays = dict([(name, array.array(typecode)) for (name, typecode) in _TILE_ARRAYS + _INDEX_ARRAYS
+                   + _TILED_NODE_ARRAYS + _TILED_LINK_ARRAYS])
+    "@type arrays: dict<str, array.array>"
+    for (tileIndex, key) in enumerate(tileKeys):
+        arrays["tileXs"].append(key[0])
+        arrays["tileYs"].append(key[1])
+        arrays["tileReaches"].append(tileReaches[tileIndex])
+        arrays["tileNodeStarts"].append(len(arrays["nodeIDs"]))
+        arrays["tileLinkStarts"].append(len(arrays["linkIDs"]))
+        for node in tileNodes[tileIndex]:
+            arrays["nodeIDs"].append(node.id)
+            arrays["nodeGPSLats"].append(node.gpsLat)
+            arrays["nodeGPSLngs"].append(node.gpsLng)
+            arrays["nodeCoordXs"].append(node.coordX)
+            arrays["nodeCoordYs"].append(node.coordY)
+        for (ordinal, link) in tileLinks[tileIndex]:
+            arrays["linkIDs"].append(link.id)
+            arrays["linkOrigIDs"].append(link.origNode.id)
+            arrays["linkDestIDs"].append(link.destNode.id)
+            arrays["linkDestTiles"].append(nodeTiles[link.destNode.id])
+            arrays["linkDestCoordXs"].append(link.destNode.coordX)
+            arrays["linkDestCoordYs"].append(link.destNode.coordY)
+            arrays["linkDistances"].append(float("nan") if link.distance is None else link.distance)
+            arrays["linkOrdinals"].append(ordinal)
+    arrays["tileNodeStarts"].append(len(arrays["nodeIDs"]))
+    arrays["tileLinkStarts"].append(len(arrays["linkIDs"]))
+    for (ident, tileIndex) in sorted(nodeTiles.items()):
+        arrays["nodeIndexIDs"].append(ident)
+        arrays["nodeIndexTiles"].append(tileIndex)
+    for link in sorted(graphLib.linkMap.values(), key = lambda link: link.id):
+        arrays["linkIndexIDs"].append(link.id)
+        arrays["linkIndexTiles"].append(nodeTiles[link.origNode.id])
+    
+    header = "%s\n%r %r %d\n%r\n%d %d %d\n" % (_formatKey(checksum), float(graphLib.gps.latCtr),
+        float(graphLib.gps.lngCtr), 1 if graphLib.useDirectDist else 0, float(tileSize),
+        len(arrays["nodeIDs"]), len(arrays["linkIDs"]), len(tileNodes))
+    tempFilename = filename + ".tmp"
+    with open(tempFilename, "wb") as outFile:
+        outFile.write(TILES_MAGIC)
+        outFile.write(header.encode("ascii"))
+        for (name, _) in _TILE_ARRAYS + _INDEX_ARRAYS + _TILED_NODE_ARRAYS + _TILED_LINK_ARRAYS:
+            outFile.write(_toBytes(arrays[name]))
+    getattr(os, "replace", os.rename)(tempFilename, filename)
+
+def openTiledSnapshot(filename, checksum, maxTiles=DEFAULT_MAX_TILES):
+    """
+    openTiledSnapshot opens the tiled snapshot that saveTiledSnapshot() had written as a TiledGraphLib, or returns
+    None if the file doesn't exist or doesn't match the given checksum.
+    @type filename: str
+    @type checksum: str
+    @type maxTiles: int
+    @rtype TiledGraphLib
+    """
+    if not os.path.isfile(filename) or os.path.getsize(filename) == 0:
+        return None
+    with open(filename, "rb") as inFile:
+        data = mmap.mmap(inFile.fileno(), 0, access = mmap.ACCESS_READ)
+    
+    # Read the header:
+    headerEnd = 0
+    headerLines = []
+    "@type headerLines: list<str>"
+    for _ in range(5):
+        lineEnd = data.find(b"\n", headerEnd)
+        if lineEnd < 0:
+            data.close()
+            return None
+        headerLines.append(data[headerEnd:lineEnd + 1].decode("ascii", "replace"))
+        headerEnd = lineEnd + 1
+    if (headerLines[0].encode("ascii") != TILES_MAGIC) or (headerLines[1].strip() != _formatKey(checksum)):
+        data.close()
+        return None
+    (latCtr, lngCtr, useDirectDist) = headerLines[2].split()
+    tileSize = float(headerLines[3])
+    (nodeCount, linkCount, tileCount) = [int(value) for value in headerLines[4].split()]
+    
+    # Find where each array begins, and read in the ones that are kept in memory:
+    counts = {"tileXs": tileCount, "tileYs": tileCount, "tileReaches": tileCount, "tileNodeStarts": tileCount + 1,
+              "tileLinkStarts": tileCount + 1, "nodeIndexIDs": nodeCount, "nodeIndexTiles": nodeCount,
+              "linkIndexIDs": linkCount, "linkIndexTiles": linkCount}
+    offsets = {}
+    "@type offsets: dict<str, int>"
+    arrays = {}
+    "@type arrays: dict<str, array.array>"
+    position = headerEnd
+    for (name, typecode) in _TILE_ARRAYS + _INDEX_ARRAYS + _TILED_NODE_ARRAYS + _TILED_LINK_ARRAYS:
+        offsets[name] = position
+        size = array.array(typecode).itemsize * counts.get(name, nodeCount if name.startswith("node") else linkCount)
+        if position + size > len(data):
+            data.close()
+            return None
+        if name in counts:
+            arrays[name] = _fromBytes(typecode, data[position:position + size])
+        position += size
+    return TiledGraphLib(float(latCtr), float(lngCtr), useDirectDist == "1", data, offsets, arrays, tileSize, maxTiles)
+
+class _Tile:
+    """
+    _Tile holds the nodes and links of one tile that a TiledGraphLib had loaded.
+    """
+    def __init__(self, index):
+        """
+        @type index: int
+        """
+        self.index = index
+        self.nodes = {}
+        "@type self.nodes: dict<int, graph.GraphNode>"
+        self.links = OrderedDict()
+        "@type self.links: OrderedDict<int, _TiledLink>"
+        self.ordinals = {}
+        "@type self.ordinals: dict<int, int>"
+
+class _TiledLink(graph.GraphLink, object):
+    """
+    _TiledLink is a GraphLink whose destination node is looked up as it is needed, which may bring in another tile.
+    No reference is kept to the destination node, so that links don't keep neighboring tiles in memory, but its
+    coordinates are, so that the link can be measured without it.
+    
+    @ivar destCoordX: The x-coordinate of the destination node
+    @type destCoordX: float
+    @ivar destCoordY: The y-coordinate of the destination node
+    @type destCoordY: float
+    """
+    def __init__(self, graphLib, ident, origNode, destID, destTile, destCoordX, destCoordY):
+        """
+        @type graphLib: TiledGraphLib
+        @type ident: int
+        @type origNode: graph.GraphNode
+        @type destID: int
+        @type destTile: int
+        @type destCoordX: float
+        @type destCoordY: float
+        """
+        self.id = ident
+        self.origNode = origNode
+        self.distance = 0.0
+        self.destCoordX = destCoordX
+        self.destCoordY = destCoordY
+        self._graphLib = graphLib
+        self._destID = destID
+        self._destTile = destTile
+    
+    @property
+    def destNode(self):
+        """
+        @rtype graph.GraphNode
+        """
+        node = self._graphLib._liveNodes.get(self._destID)
+        if node is None:
+            node = self._graphLib.tile(self._destTile).nodes[self._destID]
+        return node
+    
+    def pointOnLink(self, dist, nonPerpPenalty, refDist):
+        """
+        pointOnLink makes a PointOnLink on this link as graph.PointOnLink() does, but places it with the destination
+        coordinates that the link keeps rather than looking up the destination node and its tile.
+        @type dist: float
+        @type nonPerpPenalty: bool
+        @type refDist: float
+        @rtype graph.PointOnLink
+        """
+        ret = graph.PointOnLink(None, dist, nonPerpPenalty, refDist)
+        ret.link = self
+        if self.distance == 0:
+            (dist, norm) = (0, 1)
+        else:
+            norm = self.distance
+        ret.pointX = self.origNode.coordX + (self.destCoordX - self.origNode.coordX) * dist / norm
+        ret.pointY = self.origNode.coordY + (self.destCoordY - self.origNode.coordY) * dist / norm
+        return ret
+
+class _TiledMap(object):
+    """
+    _TiledMap stands in for the nodeMap or linkMap of a TiledGraphLib, bringing in the tile that holds an ID when
+    it is looked up.  Iterating through the values reads every tile in tile order, but only the tiles that were
+    already loaded are kept.
+    """
+    def __init__(self, graphLib, ids, tiles, attrName):
+        """
+        @type graphLib: TiledGraphLib
+        @param ids: The IDs, sorted
+        @type ids: array.array
+        @param tiles: The tile of each of the IDs
+        @type tiles: array.array
+        @param attrName: "nodes" or "links", the _Tile attribute that has the values
+        @type attrName: str
+        """
+        self._graphLib = graphLib
+        self._ids = ids
+        self._tiles = tiles
+        self._attrName = attrName
+    
+    def _tileOf(self, ident):
+        """
+        _tileOf returns the tile that has the given ID, or -1 if there is no such ID.
+        @type ident: int
+        @rtype int
+        """
+        index = bisect_left(self._ids, ident)
+        if index < len(self._ids) and self._ids[index] == ident:
+            return self._tiles[index]
+        return -1
+    
+    def __len__(self):
+        return len(self._ids)
+    
+    def __contains__(self, ident):
+        return self._tileOf(ident) >= 0
+    
+    def __getitem__(self, ident):
+        tileIndex = self._tileOf(ident)
+        if tileIndex < 0:
+            raise KeyError(ident)
+        return getattr(self._graphLib.tile(tileIndex), self._attrName)[ident]
+    
+    def get(self, ident, default=None):
+        tileIndex = self._tileOf(ident)
+        return getattr(self._graphLib.tile(tileIndex), self._attrName)[ident] if tileIndex >= 0 else default
+    
+    def __iter__(self):
+        return iter(self._ids)
+    
+    def keys(self):
+        return list(self._ids)
+    
+    def values(self):
+        for tileIndex in range(self._graphLib.tileCount):
+            tile = self._graphLib._loaded.get(tileIndex)
+            if tile is None:
+                # Read the tile in without adding it to the loaded tiles, so that the ones in use aren't let go:
+                tile = self._graphLib._loadTile(tileIndex)
+            for value in list(getattr(tile, self._attrName).values()):
+                yield value
+
+class TiledGraphLib(graph.GraphLib):
+    """
+    TiledGraphLib is a read-only GraphLib that pages in the tiles of a tiled snapshot as findPointsOnLinks() and
+    walkPath() get to them.  Up to maxTiles tiles are kept loaded; the ones that haven't been used for the longest
+    are let go beyond that.  Nodes and links that are still in use elsewhere, as in a path, stay in memory without
+    their tiles, and are reused if their tile is read in again so that the same link is always the same object.
+    Links are found in the same order as in the GraphLib that had been saved, so the results don't depend upon the
+    tiling.
+    
+    @ivar tileCount: The number of tiles in the snapshot
+    @type tileCount: int
+    @ivar loadCount: The number of times that a tile has been read in from the snapshot
+    @type loadCount: int
+    """
+    def __init__(self, gpsCtrLat, gpsCtrLng, useDirectDist, data, offsets, arrays, tileSize, maxTiles):
+        """
+        This is called by openTiledSnapshot().
+        @type gpsCtrLat: float
+        @type gpsCtrLng: float
+        @type useDirectDist: bool
+        @type data: mmap.mmap
+        @type offsets: dict<str, int>
+        @type arrays: dict<str, array.array>
+        @type tileSize: float
+        @type maxTiles: int
+        """
+        graph.GraphLib.__init__(self, gpsCtrLat, gpsCtrLng, useDirectDist)
+        self._data = data
+        self._offsets = offsets
+        self._arrays = arrays
+        self.tileSize = tileSize
+        self.maxTiles = max(maxTiles, 1)
+        self.tileCount = len(arrays["tileXs"])
+        self.loadCount = 0
+        self._tileIndices = dict([((arrays["tileXs"][index], arrays["tileYs"][index]), index)
+                                  for index in range(self.tileCount)])
+        "@type self._tileIndices: dict<(int, int), int>"
+        
+        # A few tiles may have links that reach past their neighbors.  These are checked one by one in
+        # findLinksInRadius(), so that the rest can be looked for within a narrow margin:
+        tileReaches = arrays["tileReaches"]
+        self._nearReach = max([0.0] + [reach for reach in tileReaches if reach <= tileSize])
+        self._farTiles = [index for index in range(self.tileCount) if tileReaches[index] > tileSize]
+        "@type self._farTiles: list<int>"
+        
+        self._loaded = OrderedDict()
+        "@type self._loaded: OrderedDict<int, _Tile>"
+        self._liveNodes = weakref.WeakValueDictionary()
+        "@type self._liveNodes: WeakValueDictionary<int, graph.GraphNode>"
+        self.nodeMap = _TiledMap(self, arrays["nodeIndexIDs"], arrays["nodeIndexTiles"], "nodes")
+        self.linkMap = _TiledMap(self, arrays["linkIndexIDs"], arrays["linkIndexTiles"], "links")
+    
+    def addNode(self, node):
+        raise TypeError("A TiledGraphLib can't be added to.")
+    
+    def addLink(self, link):
+        raise TypeError("A TiledGraphLib can't be added to.")
+    
+    def compactGraph(self):
+        """
+        compactGraph returns None, since a CompactGraph would need every tile to be loaded; walkPath() then follows
+        the links themselves.
+        @rtype graph.CompactGraph
+        """
+        return None
+    
+    def _read(self, name, typecode, start, end):
+        """
+        _read reads the part of an array in the snapshot that is between the start and end elements.
+        @type name: str
+        @type typecode: str
+        @type start: int
+        @type end: int
+        @rtype array.array
+        """
+        itemSize = array.array(typecode).itemsize
+        position = self._offsets[name]
+        return _fromBytes(typecode, self._data[position + start * itemSize:position + end * itemSize])
+    
+    def tile(self, tileIndex):
+        """
+        tile returns the tile with the given index, reading it in from the snapshot if it isn't already in memory.
+        @type tileIndex: int
+        @rtype _Tile
+        """
+        ret = self._loaded.pop(tileIndex, None)
+        if ret is None:
+            ret = self._loadTile(tileIndex)
+        self._loaded[tileIndex] = ret
+        while len(self._loaded) > self.maxTiles:
+            self._loaded.popitem(last = False)
+        return ret
+    
+    def _loadTile(self, tileIndex):
+        """
+        _loadTile reads in the nodes and links of a tile.  Nodes that are still in memory from an earlier time that the
+        tile had been loaded are reused, along with their outgoing links.
+        @type tileIndex: int
+        @rtype _Tile
+        """
+        ret = _Tile(tileIndex)
+        (start, end) = (self._arrays["tileNodeStarts"][tileIndex], self._arrays["tileNodeStarts"][tileIndex + 1])
+        values = [self._read(name, typecode, start, end) for (name, typecode) in _TILED_NODE_ARRAYS]
+        for (ident, gpsLat, gpsLng, coordX, coordY) in zip(*values):
+            node = self._liveNodes.get(ident)
+            if node is None:
+                node = graph.GraphNode(ident, gpsLat, gpsLng)
+                node.coordX = coordX
+                node.coordY = coordY
+                self._liveNodes[ident] = node
+            ret.nodes[ident] = node
+        (start, end) = (self._arrays["tileLinkStarts"][tileIndex], self._arrays["tileLinkStarts"][tileIndex + 1])
+        values = [self._read(name, typecode, start, end) for (name, typecode) in _TILED_LINK_ARRAYS]
+        for (ident, origID, destID, destTile, destCoordX, destCoordY, distance, ordinal) in zip(*values):
+            origNode = ret.nodes[origID]
+            link = origNode.outgoingLinkMap.get(ident)
+            if link is None:
+                link = _TiledLink(self, ident, origNode, destID, destTile, destCoordX, destCoordY)
+                link.distance = None if distance != distance else distance
+                origNode.outgoingLinkMap[ident] = link
+            ret.links[ident] = link
+            ret.ordinals[ident] = ordinal
+        self.loadCount += 1
+        return ret
+    
+    def _tileInRadius(self, tileIndex, pointX, pointY, radius):
+        """
+        _tileInRadius returns True if the links of the given tile could come within the radius of the point.
+        @type tileIndex: int
+        @type pointX: float
+        @type pointY: float
+        @type radius: float
+        @rtype bool
+        """
+        (tileX, tileY) = (self._arrays["tileXs"][tileIndex], self._arrays["tileYs"][tileIndex])
+        reach = self._arrays["tileReaches"][tileIndex]
+        gapX = max(0.0, tileX * self.tileSize - pointX, pointX - (tileX + 1) * self.tileSize) - reach
+        gapY = max(0.0, tileY * self.tileSize - pointY, pointY - (tileY + 1) * self.tileSize) - reach
+        return (max(gapX, 0.0) ** 2 + max(gapY, 0.0) ** 2) <= radius ** 2
+    
+    def findLinksInRadius(self, pointX, pointY, radius):
+        """
+        findLinksInRadius finds all PointOnLinks that are within the radius as GraphLib.findLinksInRadius() does,
+        looking only through the tiles that could have links that come that close.  Only those tiles are read in; the
+        PointOnLinks are placed with the destination coordinates that the links keep, so the tiles of the destination
+        nodes aren't needed.
+        @type pointX: float
+        @type pointY: float
+        @type radius: float
+        @rtype list<(float, graph.PointOnLink)>
+        """
+        # Gather the tiles whose links reach within the radius; first those nearby, then those from further away:
+        tileIndices = []
+        "@type tileIndices: list<int>"
+        margin = radius + self._nearReach
+        (minTileX, maxTileX) = (int(math.floor((pointX - margin) / self.tileSize)),
+                                int(math.floor((pointX + margin) / self.tileSize)))
+        (minTileY, maxTileY) = (int(math.floor((pointY - margin) / self.tileSize)),
+                                int(math.floor((pointY + margin) / self.tileSize)))
+        for tileX in range(minTileX, maxTileX + 1):
+            for tileY in range(minTileY, maxTileY + 1):
+                tileIndex = self._tileIndices.get((tileX, tileY))
+                if (tileIndex is not None) and self._tileInRadius(tileIndex, pointX, pointY, radius):
+                    tileIndices.append(tileIndex)
+        for tileIndex in self._farTiles:
+            (tileX, tileY) = (self._arrays["tileXs"][tileIndex], self._arrays["tileYs"][tileIndex])
+            if not ((minTileX <= tileX <= maxTileX) and (minTileY <= tileY <= maxTileY)) \
+                    and self._tileInRadius(tileIndex, pointX, pointY, radius):
+                tileIndices.append(tileIndex)
+        
+        radiusSq = radius ** 2
+        found = []
+        "@type found: list<(int, float, graph.PointOnLink)>"
+        for tileIndex in tileIndices:
+            tile = self.tile(tileIndex)
+            for link in tile.links.values():
+                (distSq, linkDist, perpendicular) = linear.pointDistSq(pointX, pointY, link.origNode.coordX,
+                    link.origNode.coordY, link.destCoordX, link.destCoordY, link.distance)
+                if distSq <= radiusSq:
+                    found.append((tile.ordinals[link.id], distSq,
+                                  link.pointOnLink(linkDist, not perpendicular, math.sqrt(distSq))))
+        
+        # Put these back into the order that the links had been in the original graph:
+        found.sort(key = lambda item: item[0])
+        return [(distSq, pointOnLink) for (_, distSq, pointOnLink) in found]
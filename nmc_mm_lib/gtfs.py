@@ -23,7 +23,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
-import os, operator, sys
+import os, operator, sys, hashlib
 from datetime import datetime, timedelta
 
 class ShapesEntry:
@@ -86,6 +86,65 @@ def fillShapes(filePath, gps):
     # Return the shapes file contents:
     return ret
 
+def shapeHash(shapeEntries):
+    """
+    shapeHash returns a digest of the sequence of (lat, lng) coordinates in a shape.  Shapes that have identical
+    geometry have the same digest regardless of their shape IDs and sequence numbers.
+    @type shapeEntries: list<ShapesEntry>
+    @rtype str
+    """
+    digest = hashlib.sha1()
+    for shapeEntry in shapeEntries:
+        "@type shapeEntry: ShapesEntry"
+        digest.update(("%r,%r;" % (shapeEntry.lat, shapeEntry.lng)).encode("ascii"))
+    return digest.hexdigest()
+
+def dumpShapeHashes(shapeHashes, outFile = sys.stdout, runKey = ""):
+    """
+    dumpShapeHashes writes out the shape digests that are produced by shapeHash() so that a later run can tell
+    which shapes had changed.
+    @type shapeHashes: dict<int, str>
+    @type outFile: file
+    @param runKey: Identifies the network and the matching settings that the shapes had been matched with
+    @type runKey: str
+    """
+    print("run_key,%s" % runKey, file = outFile)
+    print("shape_id,shape_hash", file = outFile)
+    shapeIDs = list(shapeHashes.keys())
+    shapeIDs.sort()
+    for shapeID in shapeIDs:
+        print("%s,%s" % (str(shapeID), shapeHashes[shapeID]), file = outFile)
+
+def readShapeHashes(inFile, shapeIDMaker = lambda x: int(x), runKey = ""):
+    """
+    readShapeHashes reads in shape digests that had been written by dumpShapeHashes().  If they had been written
+    with a different runKey, then none of them apply, and an empty map is returned.
+    @type inFile: file
+    @type shapeIDMaker: function
+    @type runKey: str
+    @return A map of shape_id to its digest
+    @rtype dict<int, str>
+    """
+    ret = {}
+    "@type ret: dict<int, str>"
+    
+    # Sanity check:
+    keyLine = inFile.readline()
+    fileLine = inFile.readline()
+    if not keyLine.startswith("run_key,") or not fileLine.startswith("shape_id,shape_hash"):
+        print("ERROR: The shape hash file doesn't have the expected header.", file = sys.stderr)
+        return None
+    if keyLine.strip()[len("run_key,"):] != runKey:
+        print("INFO: The shape hash file is for a different network or different matching settings.", file = sys.stderr)
+        return ret
+    
+    # Go through the lines of the file:
+    for fileLine in inFile:
+        if len(fileLine.strip()) > 0:
+            lineElems = fileLine.strip().split(',')
+            ret[shapeIDMaker(lineElems[0])] = lineElems[1]
+    return ret
+
 class RoutesEntry:
     """
     RoutesEntry is a single GTFS route with name.
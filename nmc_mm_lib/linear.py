@@ -113,6 +113,70 @@ def getNormSq(lineX1, lineY1, lineX2, lineY2):
     norm = (lineX2 - lineX1) ** 2 + (lineY2 - lineY1) ** 2
     return norm
 
+class PointGrid:
+    """
+    PointGrid files points into square cells so that the points near a given point can be found without going
+    through all of them.
+    @ivar cellSize: The width of each cell; queries are fastest with radii up to this
+    @type cellSize: float
+    @ivar cells: The points, (pointX, pointY, item), that fall in each cell
+    @type cells: dict<(int, int), list<(float, float, ?)>>
+    """
+    def __init__(self, cellSize):
+        """
+        @type cellSize: float
+        """
+        self.cellSize = float(cellSize)
+        self.cells = {}
+        
+    def _cell(self, pointX, pointY):
+        """
+        _cell returns the cell coordinates that the given point falls in.
+        @rtype (int, int)
+        """
+        return (int(math.floor(pointX / self.cellSize)), int(math.floor(pointY / self.cellSize)))
+        
+    def add(self, pointX, pointY, item = None):
+        """
+        add files the given point, along with something that it refers to.
+        @type pointX: float
+        @type pointY: float
+        """
+        cell = self._cell(pointX, pointY)
+        if cell not in self.cells:
+            self.cells[cell] = []
+        self.cells[cell].append((pointX, pointY, item))
+    
+    def findWithin(self, pointX, pointY, radius):
+        """
+        findWithin returns the items of the points that are less than radius from the given point.
+        @type pointX: float
+        @type pointY: float
+        @type radius: float
+        @rtype list
+        """
+        radiusSq = radius ** 2
+        reach = int(math.ceil(radius / self.cellSize))
+        (cellX, cellY) = self._cell(pointX, pointY)
+        ret = []
+        for indexX in range(cellX - reach, cellX + reach + 1):
+            for indexY in range(cellY - reach, cellY + reach + 1):
+                for (itemX, itemY, item) in self.cells.get((indexX, indexY), ()):
+                    if getNormSq(pointX, pointY, itemX, itemY) < radiusSq:
+                        ret.append(item)
+        return ret
+    
+    def anyWithin(self, pointX, pointY, radius):
+        """
+        anyWithin returns True if any point is less than radius from the given point.
+        @type pointX: float
+        @type pointY: float
+        @type radius: float
+        @rtype bool
+        """
+        return len(self.findWithin(pointX, pointY, radius)) > 0
+
+
 class TestLinear(unittest.TestCase):
 
     def test_horizontalLine(self):
@@ -151,6 +215,19 @@ class TestLinear(unittest.TestCase):
         
         self.assertEqual(pointDist(-2, -2, -2, -1, 1, 2), (1, 0, False), "Line (-2, -1)-(1, 2) and Point (-2, -2)")
 
+    def test_pointGrid(self):
+        """
+        Test 4: Point grid
+        """
+        grid = PointGrid(10)
+        grid.add(0, 0, "a")
+        grid.add(9, 0, "b")
+        grid.add(-25, 3, "c")
+        self.assertEqual(sorted(grid.findWithin(1, 0, 9)), ["a", "b"], "Points within 9 of (1, 0)")
+        self.assertEqual(grid.findWithin(1, 0, 8), ["a"], "Points within 8 of (1, 0); the edge is excluded")
+        self.assertEqual(sorted(grid.findWithin(-20, 3, 21)), ["a", "c"], "Points within 21 of (-20, 3), across cells")
+        self.assertFalse(grid.anyWithin(-12, -12, 5), "No points within 5 of (-12, -12)")
+
 if __name__ == '__main__':
     unittest.main()
     
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+parallel.py contains helpers for spreading independent matching work across
+    worker processes.
+@author: Kenneth Perrine
+@contact: kperrine@utexas.edu
+@organization: Network Modeling Center, Center for Transportation Research,
+    Cockrell School of Engineering, The University of Texas at Austin
+@version: 1.0
+
+@copyright: (C) 2014, The University of Texas at Austin
+@license: GPL v3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+import sys
+
+_workState = None
+"@var _workState: The work function and its arguments, inherited by forked worker processes."
+
+def _forkContext():
+    """
+    Returns the multiprocessing context that forks worker processes, or None if forking isn't available.
+    multiprocessing is slow to import, so it is only brought in here, when worker processes are asked for.
+    """
+    import multiprocessing
+    if not hasattr(multiprocessing, "get_context"):
+        # Python 2 always forks on platforms that can.
+        return multiprocessing if sys.platform != "win32" else None
+    try:
+        return multiprocessing.get_context("fork")
+    except ValueError:
+        return None
+
+def _runWork(item):
+    """
+    _runWork is the entry point for each item that is processed within a worker process.
+    """
+    (workFunc, args) = _workState
+    return workFunc(item, *args)
+
+def forkMap(workFunc, items, workers, *args):
+    """
+    forkMap calls workFunc(item, *args) for each of the items across a pool of forked worker processes,
+    and yields the return values in the order of items as soon as they are available.  workFunc and args are
+    inherited copy-on-write by the workers rather than pickled, so large structures such as graph.GraphLib
+    that are loaded once by the parent cost nothing to hand over.  Only the items and return values cross
+    process boundaries, so these should be kept compact.  If workers is 1 or less, or the platform can't
+    fork, the work is done serially in this process.
+    @type workFunc: function
+    @type items: list
+    @type workers: int
+    """
+    global _workState
+    context = _forkContext() if workers > 1 else None
+    if context is None:
+        if workers > 1:
+            print("WARNING: Worker processes aren't supported on this platform; running serially.", file = sys.stderr)
+        for item in items:
+            yield workFunc(item, *args)
+        return
+
+    _workState = (workFunc, args)
+    pool = context.Pool(workers)
+    try:
+        for result in pool.imap(_runWork, items):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _workState = None
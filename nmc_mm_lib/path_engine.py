@@ -24,8 +24,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
-from nmc_mm_lib import graph, linear, gtfs
-import operator, sys, copy
+from nmc_mm_lib import graph, linear, gtfs, parallel
+import operator, sys, copy, math, time, unittest, tempfile, shutil, os
 
 INSUFFICIENT_HINT_PENALTY = 5000
 "@var INSUFFICIET_HINT_PENALTY: The score to add to paths when a hint zone is exited and not all of the hints were traversed."
@@ -71,6 +71,83 @@ class PathEnd:
         """
         return PathEnd(self.shapeEntry, self.pointOnLink)
 
+class CorridorCache:
+    """
+    CorridorCache remembers runs of consecutive shape points that have been matched confidently, meaning that the
+    path had no restarts there and that all of the candidate paths had converged onto the same tree node at each
+    point.  When another shape shares a run of the same points, such as a trunk corridor that many routes traverse,
+    PathEngine.constructPath() splices in the remembered tree nodes instead of searching for them again.
+    
+    @ivar minPoints: The number of consecutive identical points needed to recognize a shared run
+    @type minPoints: int
+    @ivar segments: Maps a run of minPoints (lat, lng) pairs to a remembered run and the index within it
+    @type segments: dict<tuple, (list<PathEnd>, int)>
+    @ivar splicedPoints: The number of shape points that have been spliced in rather than searched
+    @type splicedPoints: int
+    """
+    def __init__(self, minPoints):
+        """
+        @type minPoints: int
+        """
+        self.minPoints = max(minPoints, 2)
+        self.segments = {}
+        self.splicedPoints = 0
+        
+    def add(self, treeNodes, shapeEntries, convergedNodes):
+        """
+        add remembers the confidently matched runs within a path that had just been found.
+        @type treeNodes: list<PathEnd>
+        @type shapeEntries: list<gtfs.ShapesEntry>
+        @param convergedNodes: The tree nodes that all candidate paths had converged onto
+        @type convergedNodes: set<PathEnd>
+        """
+        entryIndices = {}
+        "@type entryIndices: dict<int, int>"
+        for index, shapeEntry in enumerate(shapeEntries):
+            entryIndices[id(shapeEntry)] = index
+        
+        run = []
+        "@type run: list<PathEnd>"
+        for treeNode in treeNodes + [None]:
+            "@type treeNode: PathEnd"
+            if (treeNode is not None) and (treeNode in convergedNodes) and (id(treeNode.shapeEntry) in entryIndices) \
+                    and ((len(run) == 0) or (not treeNode.restart
+                    and entryIndices[id(treeNode.shapeEntry)] == entryIndices[id(run[-1].shapeEntry)] + 1)):
+                run.append(treeNode)
+                continue
+            
+            # The run has ended.  Remember each window within it:
+            for index in range(0, len(run) - self.minPoints + 1):
+                key = tuple([(node.shapeEntry.lat, node.shapeEntry.lng) for node in run[index:index + self.minPoints]])
+                if key not in self.segments:
+                    self.segments[key] = (run, index)
+            run = [treeNode] if (treeNode is not None) and (treeNode in convergedNodes) \
+                and (id(treeNode.shapeEntry) in entryIndices) else []
+    
+    def lookup(self, shapeEntries, startIndex):
+        """
+        lookup finds a remembered run that shares the points in shapeEntries that begin at startIndex.
+        @type shapeEntries: list<gtfs.ShapesEntry>
+        @type startIndex: int
+        @return The remembered tree nodes that correspond with the shared points, or an empty list if none
+        @rtype list<PathEnd>
+        """
+        if startIndex + self.minPoints > len(shapeEntries):
+            return []
+        key = tuple([(shapeEntry.lat, shapeEntry.lng) for shapeEntry in
+                     shapeEntries[startIndex:startIndex + self.minPoints]])
+        if key not in self.segments:
+            return []
+        (run, runIndex) = self.segments[key]
+        
+        # Extend the match for as long as the points continue to be shared:
+        count = self.minPoints
+        while (runIndex + count < len(run)) and (startIndex + count < len(shapeEntries)) \
+                and (run[runIndex + count].shapeEntry.lat == shapeEntries[startIndex + count].lat) \
+                and (run[runIndex + count].shapeEntry.lng == shapeEntries[startIndex + count].lng):
+            count += 1
+        return run[runIndex:runIndex + count]
+
 class PathEngine:
     """
     PathEngine contains constraints that guide the creation of a path.
@@ -110,6 +187,49 @@ class PathEngine:
         
         self.shapeScatterCache = None
         "@type self.shapeScatterCache: list<graph.PointOnLink>"
+        self._zoneScans = {}
+        "@type self._zoneScans: dict<int, list<(float, graph.PointOnLink)>>"
+        
+        self.corridorCache = None
+        "@type self.corridorCache: CorridorCache"
+        
+        # When set, the number of candidates that are kept for each point varies between limitClosestPointsMin and
+        # limitClosestPoints: only those within this many feet of the closest candidate's distance are kept.
+        self.candidateAmbiguity = None
+        "@type self.candidateAmbiguity: float"
+        self.limitClosestPointsMin = 2
+        self.candidateStats = [0, 0] # Points matched and candidates kept since the start of the last path
+        "@type self.candidateStats: list<int>"
+        
+        # When set, the number of proposed paths that are kept after each point varies between
+        # limitSimultaneousPathsMin and limitSimultaneousPaths: only those that cost no more than this much over the
+        # cheapest are kept.
+        self.beamMargin = None
+        "@type self.beamMargin: float"
+        self.limitSimultaneousPathsMin = 2
+        self.beamStats = [0, 0] # Points matched and proposed paths kept since the start of the last path
+        "@type self.beamStats: list<int>"
+        
+        # Number of successively tighter searches that are tried for each point before the full search: 
+        self.escalationSteps = 0
+        self.escalationStats = [0, 0] # Points matched and wider searches needed since the start of the last path
+        "@type self.escalationStats: list<int>"
+        
+        # When set, the number of seconds that can be spent on each shape.  Past half of this, the number of
+        # candidates, proposed paths and hops shrink, down to 1 each at the limit.
+        self.shapeTimeLimit = None
+        "@type self.shapeTimeLimit: float"
+        self.overBudgetShapes = [] # Shape IDs that reached the time limit
+        self._shapeStartTime = None
+        self._budget = 1.0
+        self._overBudget = False
+        
+        # When set, the links that are found within latticeRadius of each shape point are kept by (shapeID, shapeSeq)
+        # as (linkID, dist, nonPerpPenalty, distSq), so that later searches on the same point can filter them rather
+        # than scan the network again.  See dumpCandidateLattice() and readCandidateLattice().
+        self.candidateLattice = None
+        "@type self.candidateLattice: dict<(?, int), list<(int, float, bool, float)>>"
+        self.latticeRadius = 0.0
         
     def scoreFunction(self, prevGTFSPoint, distance, gtfsPoint):
         """
@@ -206,7 +326,7 @@ class PathEngine:
                         gtfsPointRestart = gtfsPointPrev
             
             # Mark a "break" in the continuity and link up with the newer candidates.  Keep a limited set.
-            gtfsPoints = gtfsPoints[0:self.limitSimultaneousPaths]
+            gtfsPoints = gtfsPoints[0:self._budgeted(self.limitSimultaneousPaths)]
             if gtfsPointRestart is not None:
                 for gtfsPoint in gtfsPoints:
                     "@type gtfsPoint: PathEnd"
@@ -222,7 +342,16 @@ class PathEngine:
         else:
             # Trim off lowest-scoring paths:
             gtfsPointsWork.sort(key = operator.attrgetter('totalCost'))
-            gtfsPoints = gtfsPointsWork[0:self.limitSimultaneousPaths]
+            gtfsPoints = gtfsPointsWork[0:self._budgeted(self.limitSimultaneousPaths)]
+            if (self.beamMargin is not None) and (len(gtfsPoints) > 0):
+                # Also trim off those that are too costly to be likely to catch up:
+                limitCost = gtfsPoints[0].totalCost + self.beamMargin
+                count = self.limitSimultaneousPathsMin
+                while (count < len(gtfsPoints)) and (gtfsPoints[count].totalCost <= limitCost):
+                    count += 1
+                gtfsPoints = gtfsPoints[0:count]
+                self.beamStats[0] += 1
+                self.beamStats[1] += len(gtfsPoints)
             
         return gtfsPoints            
 
@@ -234,54 +363,362 @@ class PathEngine:
         @type vistaGraph: graph.GraphLib
         @rtype: list<PathEnd>
         """
-        gtfsPointsPrev = []
-        "@type gtfsPointsPrev: list<PathEnd>"
-
         pathProcessor = graph.WalkPathProcessor(self.limitDirectDist, self.limitLinearDist, self.limitDirectDistRev,
             self.maxHops)
         "@type pathProcessor: graph.WalkPathProcessor"
+        pathProcessor.compactGraph = vistaGraph.compactGraph()
+        
+        convergedNodes = set()
+        "@type convergedNodes: set<PathEnd>"
         
-        shapeCtr = 0
         if self.logFile is not None:
             print("INFO: Building path...", file = self.logFile)
-        for shapeEntry in shapeEntries:
+        self.candidateStats = [0, 0]
+        self.beamStats = [0, 0]
+        self.escalationStats = [0, 0]
+        self._startBudget()
+        gtfsPointsPrev = self._buildTree(pathProcessor, shapeEntries, vistaGraph, [], convergedNodes)
+
+        # Now, extract the shortest path:
+        if self.logFile is not None:
+            if (self.candidateAmbiguity is not None) and (self.candidateStats[0] > 0):
+                print("INFO: Kept an average of %.1f of up to %d candidates per point." \
+                      % (float(self.candidateStats[1]) / self.candidateStats[0], self.limitClosestPoints),
+                      file = self.logFile)
+            if (self.beamMargin is not None) and (self.beamStats[0] > 0):
+                print("INFO: Kept an average of %.1f of up to %d proposed paths per point." \
+                      % (float(self.beamStats[1]) / self.beamStats[0], self.limitSimultaneousPaths),
+                      file = self.logFile)
+            if self.escalationStats[0] > 0:
+                print("INFO: Widened the search %d times over %d points." % (self.escalationStats[1],
+                      self.escalationStats[0]), file = self.logFile)
+            print("INFO: Finishing path...", file = self.logFile)
+        ret = self._extractPath(gtfsPointsPrev)
+        
+        # Remember the confidently matched runs for other shapes that share them:
+        if self.corridorCache is not None:
+            self.corridorCache.add(ret, shapeEntries, convergedNodes)
+        return ret
+    
+    def _buildTree(self, pathProcessor, shapeEntries, vistaGraph, gtfsPointsPrev, convergedNodes):
+        """
+        _buildTree adds a layer of tree nodes onto gtfsPointsPrev for each of the shapeEntries, and returns the last
+        layer.  gtfsPointsPrev is empty to start a new tree.
+        @type pathProcessor: graph.WalkPathProcessor
+        @type shapeEntries: list<ShapesEntry>
+        @type vistaGraph: graph.GraphLib
+        @type gtfsPointsPrev: list<PathEnd>
+        @type convergedNodes: set<PathEnd>
+        @rtype: list<PathEnd>
+        """
+        searchLevels = self._searchLevels(pathProcessor)
+        "@type searchLevels: list<(float, graph.WalkPathProcessor)>"
+        shapeIndex = 0
+        while shapeIndex < len(shapeEntries):
+            shapeEntry = shapeEntries[shapeIndex]
             "@type shapeEntry: ShapesEntry"
-            shapeCtr = shapeCtr + 1
-            if shapeCtr % 10 == 0:
+            self._updateBudget(searchLevels, shapeEntry)
+            shapeIndex += 1
+            if shapeIndex % 10 == 0:
                 if self.logFile is not None:
-                    print("INFO:   ... %d of %d" % (shapeCtr, len(shapeEntries)), file = self.logFile)
+                    print("INFO:   ... %d of %d" % (shapeIndex, len(shapeEntries)), file = self.logFile)
+
+            # Had another shape already confidently matched the points that come next?
+            if self.corridorCache is not None:
+                (spliceCount, splicedEnd) = self._spliceCorridor(pathProcessor, shapeEntries, shapeIndex - 1,
+                                                                 gtfsPointsPrev, vistaGraph, convergedNodes)
+                if spliceCount > 0:
+                    gtfsPointsPrev = [splicedEnd]
+                    shapeIndex += spliceCount - 1
+                    continue
 
+            # Search near the point first, and only widen the search if that doesn't connect:
             (pointX, pointY) = vistaGraph.gps.gps2feet(shapeEntry.lat, shapeEntry.lng)
-            closestVISTA = vistaGraph.findPointsOnLinks(pointX, pointY, self.pointSearchRadius, self.pointSearchPrimary,
-                                self.pointSearchSecondary, [gtfsPointPrev.pointOnLink for gtfsPointPrev in gtfsPointsPrev],
-                                self.limitClosestPoints)
-            "@type closestVISTA: list<graph.PointOnLink>"
-            
-            if len(closestVISTA) == 0:
-                if self.logFile is not None:
-                    print("WARNING: No closest VISTA points were found for GTFS shape %s, sequence %d." \
-                          % (str(shapeEntry.shapeID), shapeEntry.shapeSeq), file = self.logFile)
+            gtfsPointsNext = None
+            "@type gtfsPointsNext: list<PathEnd>"
+            for levelIndex, (factor, levelProcessor) in enumerate(searchLevels):
+                finalLevel = levelIndex == len(searchLevels) - 1
+                statsBefore = (list(self.candidateStats), list(self.beamStats))
+                closestVISTA = vistaGraph.filterPointsOnLinks(self._scanLinks(shapeEntry, pointX, pointY,
+                                    self.pointSearchRadius * factor, vistaGraph),
+                                    self.pointSearchPrimary * factor, self.pointSearchSecondary * factor,
+                                    [gtfsPointPrev.pointOnLink for gtfsPointPrev in gtfsPointsPrev],
+                                    self._budgeted(self.limitClosestPoints))
+                "@type closestVISTA: list<graph.PointOnLink>"
+                
+                if len(closestVISTA) == 0:
+                    if finalLevel and (self.logFile is not None):
+                        print("WARNING: No closest VISTA points were found for GTFS shape %s, sequence %d." \
+                              % (str(shapeEntry.shapeID), shapeEntry.shapeSeq), file = self.logFile)
+                    continue
+                if self.candidateAmbiguity is not None:
+                    closestVISTA = self._trimCandidates(closestVISTA)
+                
+                # Initialize blank GTFS tree entries:
+                gtfsPoints = []
+                "@type gtfsPoints: list<PathEnd>"
+                for vistaPoint in closestVISTA:
+                    "@type vistaPoint: graph.PointOnLink"
+                    gtfsPoints.append(PathEnd(shapeEntry, vistaPoint)) 
+                
+                # Find the shortest paths from gtfsPointsPrev to the handful of closestVISTA points:
+                # (We're adding another layer to the tree, and previous tree nodes can be found by accessing
+                # PathEnd.prevTreeNode)
+                gtfsPointsNext = self._findShortestPaths(levelProcessor, shapeEntry, gtfsPointsPrev, gtfsPoints,
+                                                         vistaGraph, 0 if finalLevel else 2)
+                if len(gtfsPointsNext) > 0:
+                    break
+                
+                # Only the search that is kept for the point counts toward the averages:
+                if not finalLevel:
+                    (self.candidateStats, self.beamStats) = statsBefore
+            if len(searchLevels) > 1:
+                self.escalationStats[0] += 1
+                self.escalationStats[1] += levelIndex
+            if gtfsPointsNext is None:
                 continue
+            gtfsPointsPrev = gtfsPointsNext
             
-            # Initialize blank GTFS tree entries:
-            gtfsPoints = []
-            "@type gtfsPoints: list<PathEnd>"
-            for vistaPoint in closestVISTA:
-                "@type vistaPoint: graph.PointOnLink"
-                gtfsPoints.append(PathEnd(shapeEntry, vistaPoint)) 
+            # Once all of the candidate paths go back through the same tree node, that node and its ancestors are
+            # certain to be on the final path:
+            if self.corridorCache is not None:
+                self._noteConvergence(gtfsPointsPrev, convergedNodes)
+        return gtfsPointsPrev
+    
+    def constructPathChunked(self, shapeEntries, vistaGraph, chunkSize, overlap = None, workers = 1):
+        """
+        constructPathChunked is like constructPath(), but splits a long shapeEntries list into windows of chunkSize
+        points that overlap the following window by overlap points.  The windows are matched independently, across
+        worker processes if workers is more than 1, and are stitched together where the best paths of neighboring
+        windows agree within the overlap.  Where they don't agree, a bridge is matched onward from the earlier
+        window's path until it agrees with the later window.
+        @type shapeEntries: list<ShapesEntry>
+        @type vistaGraph: graph.GraphLib
+        @type chunkSize: int
+        @param overlap: Number of points shared by neighboring windows; defaults to a fifth of chunkSize (at least 10)
+        @type overlap: int
+        @type workers: int
+        @rtype: list<PathEnd>
+        """
+        if overlap is None:
+            overlap = max(10, chunkSize // 5)
+        if len(shapeEntries) <= chunkSize + overlap:
+            return self.constructPath(shapeEntries, vistaGraph)
+        
+        # Lay out the windows:
+        windows = []
+        "@type windows: list<(int, int)>"
+        start = 0
+        while True:
+            end = min(start + chunkSize + overlap, len(shapeEntries))
+            windows.append((start, end))
+            if end == len(shapeEntries):
+                break
+            start += chunkSize
+        if self.logFile is not None:
+            print("INFO: Matching %d points in %d chunks..." % (len(shapeEntries), len(windows)), file = self.logFile)
+        
+        entryIndices = {}
+        "@type entryIndices: dict<int, int>"
+        for index, shapeEntry in enumerate(shapeEntries):
+            entryIndices[id(shapeEntry)] = index
+
+        ret = None
+        "@type ret: list<PathEnd>"
+        compactPaths = parallel.forkMap(_chunkWork, windows, workers, self, shapeEntries, vistaGraph)
+        for windowIndex, (compactNodes, lattice, overBudgetShapes) in enumerate(compactPaths):
+            if lattice is not None:
+                self.candidateLattice.update(lattice)
+            self._noteOverBudget(overBudgetShapes)
+            chunkPath = expandPath(compactNodes, shapeEntries, vistaGraph)
+            "@type chunkPath: list<PathEnd>"
+            if ret is None:
+                ret = chunkPath
+            else:
+                ret = self._stitchChunk(ret, chunkPath, windows[windowIndex], overlap, shapeEntries, entryIndices,
+                                        vistaGraph)
+        return ret
+    
+    def _noteOverBudget(self, overBudgetShapes):
+        """
+        _noteOverBudget records the shape IDs that a worker process found to have reached the time limit, once each.
+        @type overBudgetShapes: list
+        """
+        for shapeID in overBudgetShapes:
+            if shapeID not in self.overBudgetShapes:
+                self.overBudgetShapes.append(shapeID)
+    
+    def _stitchChunk(self, headPath, chunkPath, window, overlap, shapeEntries, entryIndices, vistaGraph):
+        """
+        _stitchChunk joins the path found for a window onto the path found so far.  Both paths cover the first
+        overlap points of the window.  The join is made at the agreeing point that is nearest to the middle of the
+        overlap.  Failing that, a bridge is matched onward from headPath at the beginning of the overlap, a stretch
+        at a time, until it agrees with chunkPath, or through the rest of the window if it never does.
+        @type headPath: list<PathEnd>
+        @type chunkPath: list<PathEnd>
+        @type window: (int, int)
+        @type overlap: int
+        @type shapeEntries: list<ShapesEntry>
+        @type entryIndices: dict<int, int>
+        @type vistaGraph: graph.GraphLib
+        @rtype: list<PathEnd>
+        """
+        (start, end) = window
+        middle = start + overlap // 2
+        self._startBudget()
+        headPositions = _pathPositions(headPath, entryIndices)
+        chunkPositions = _pathPositions(chunkPath, entryIndices)
+        
+        # Look for the agreeing point that is nearest to the middle of the overlap:
+        for offset in range(overlap):
+            index = middle + (offset + 1) // 2 * (1 if offset % 2 else -1)
+            if (start <= index < start + overlap) and _pathsAgree(headPath, headPositions, chunkPath, chunkPositions,
+                                                                   index):
+                return _joinPaths(headPath, headPositions[index], chunkPath, chunkPositions[index])
+        
+        # A bridge starts from headPath at the beginning of the overlap, where headPath is still well informed:
+        seedIndex = _lastIndexBefore(headPositions, start + 1, 0)
+        pathProcessor = graph.WalkPathProcessor(self.limitDirectDist, self.limitLinearDist, self.limitDirectDistRev,
+            self.maxHops)
+        "@type pathProcessor: graph.WalkPathProcessor"
+        pathProcessor.compactGraph = vistaGraph.compactGraph()
+        while seedIndex is not None:
+            # Match onward from the seed for twice the overlap, and stitch at the first point that agrees within
+            # the first half (the end of the bridge is shortsighted):
+            seedNode = headPath[headPositions[seedIndex]]
+            "@type seedNode: PathEnd"
+            bridgeStop = min(seedIndex + 1 + 2 * overlap, end)
+            gtfsPoints = self._buildTree(pathProcessor, shapeEntries[seedIndex + 1:bridgeStop], vistaGraph, [seedNode],
+                                         set())
+            headPath = headPath[:headPositions[seedIndex] + 1] + self._extractPath(gtfsPoints, seedNode)
+            headPositions = _pathPositions(headPath, entryIndices)
+            agreeStop = bridgeStop if bridgeStop == end else min(seedIndex + 1 + overlap, bridgeStop)
+            for index in range(seedIndex + 1, agreeStop):
+                if _pathsAgree(headPath, headPositions, chunkPath, chunkPositions, index):
+                    if self.logFile is not None:
+                        print("INFO: Bridged chunks at sequence %d through %d." % (shapeEntries[seedIndex].shapeSeq,
+                            shapeEntries[index].shapeSeq), file = self.logFile)
+                    return _joinPaths(headPath, headPositions[index], chunkPath, chunkPositions[index])
+            if bridgeStop == end:
+                if self.logFile is not None:
+                    print("INFO: Rematched the chunk that begins at sequence %d without stitching." \
+                          % shapeEntries[start].shapeSeq, file = self.logFile)
+                return headPath
             
-            # Find the shortest paths from gtfsPointsPrev to the handful of closestVISTA points:
-            # (We're adding another layer to the tree, and previous tree nodes can be found by accessing
-            # PathEnd.prevTreeNode)
-            gtfsPointsPrev = self._findShortestPaths(pathProcessor, shapeEntry, gtfsPointsPrev, gtfsPoints, vistaGraph)
+            # Keep the first half of the bridge and go again from there:
+            seedIndex = _lastIndexBefore(headPositions, seedIndex + 1 + overlap, seedIndex + 1)
 
-        # Now, extract the shortest path.  First, find the end that has the cheapest cost:
+        # There's nothing to bridge from, so pick up the window's path after a break in continuity:
         if self.logFile is not None:
-            print("INFO: Finishing path...", file = self.logFile)
+            print("WARNING: Chunks that begin at sequence %d couldn't be stitched." % shapeEntries[start].shapeSeq,
+                  file = self.logFile)
+        tailIndex = _lastIndexBefore(chunkPositions, _lastIndexBefore(headPositions, end, 0, -1) + 1, 0)
+        return _joinPaths(headPath, len(headPath) - 1, chunkPath,
+                          chunkPositions[tailIndex] if tailIndex is not None else -1, True)
+    
+    def _startBudget(self):
+        """
+        _startBudget starts the clock for shapeTimeLimit on a new shape.
+        """
+        self._shapeStartTime = time.time()
+        self._budget = 1.0
+        self._overBudget = False
+    
+    def _updateBudget(self, searchLevels, shapeEntry):
+        """
+        _updateBudget figures the share of the usual search effort that can still be afforded on the current shape:
+        all of it through the first half of shapeTimeLimit, and then shrinking to nothing at the limit.  The hop limit
+        of the path processor of each of the searchLevels is set accordingly.  The shape is reported the first time
+        that it reaches the limit.
+        @param searchLevels: The scale factors and path processors, as from _searchLevels()
+        @type searchLevels: list<(float, graph.WalkPathProcessor)>
+        @type shapeEntry: gtfs.ShapesEntry
+        """
+        if self.shapeTimeLimit is None:
+            return
+        elapsed = time.time() - self._shapeStartTime
+        self._budget = max(0.0, min(1.0, 2.0 * (1.0 - elapsed / self.shapeTimeLimit)))
+        for (factor, levelProcessor) in searchLevels:
+            levelProcessor.limitSteps = self._budgeted(self._levelHops(factor))
+        if (self._budget == 0.0) and not self._overBudget:
+            self._overBudget = True
+            self.overBudgetShapes.append(shapeEntry.shapeID)
+            if self.logFile is not None:
+                print("WARNING: Shape %s reached the time limit of %g s at sequence %d; finishing with the narrowest " \
+                      "search." % (str(shapeEntry.shapeID), self.shapeTimeLimit, shapeEntry.shapeSeq), file = self.logFile)
+    
+    def _budgeted(self, limit):
+        """
+        _budgeted scales the given limit by the share of search effort that can still be afforded on the current shape,
+        but to no less than 1.
+        @type limit: int
+        @rtype int
+        """
+        if self._budget >= 1.0:
+            return limit
+        return max(1, int(math.ceil(limit * self._budget)))
+
+    def _searchLevels(self, pathProcessor):
+        """
+        _searchLevels returns the scale factors and path processors for each of the successively wider searches that
+        are tried for a point.  The last is the full search with the given pathProcessor; each of the
+        escalationSteps before it halves the search radii, path distances and hops of the one after.
+        @type pathProcessor: graph.WalkPathProcessor
+        @rtype list<(float, graph.WalkPathProcessor)>
+        """
+        ret = []
+        "@type ret: list<(float, graph.WalkPathProcessor)>"
+        for step in range(self.escalationSteps, 0, -1):
+            factor = 0.5 ** step
+            levelProcessor = graph.WalkPathProcessor(self.limitDirectDist * factor, self.limitLinearDist * factor,
+                self.limitDirectDistRev, self._levelHops(factor))
+            levelProcessor.compactGraph = pathProcessor.compactGraph
+            ret.append((factor, levelProcessor))
+        ret.append((1.0, pathProcessor))
+        return ret
+    
+    def _levelHops(self, factor):
+        """
+        _levelHops returns the hop limit of the search level that has the given scale factor, before any budgeting.
+        @type factor: float
+        @rtype int
+        """
+        if factor >= 1.0:
+            return self.maxHops
+        return max(1, int(round(self.maxHops * factor)))
+
+    def _trimCandidates(self, closestVISTA):
+        """
+        _trimCandidates keeps the candidates that are within candidateAmbiguity feet of the closest one, but no
+        fewer than limitClosestPointsMin of them.  A point that is clearly nearest to one link thus gets few
+        candidates, while a point among many nearly equidistant links keeps up to all that were found.
+        @param closestVISTA: Candidates, sorted by distance from the point
+        @type closestVISTA: list<graph.PointOnLink>
+        @rtype list<graph.PointOnLink>
+        """
+        limitDist = closestVISTA[0].refDist + self.candidateAmbiguity
+        count = self.limitClosestPointsMin
+        while (count < len(closestVISTA)) and (closestVISTA[count].refDist <= limitDist):
+            count += 1
+        closestVISTA = closestVISTA[0:count]
+        self.candidateStats[0] += 1
+        self.candidateStats[1] += len(closestVISTA)
+        return closestVISTA
+
+    @staticmethod
+    def _extractPath(gtfsPoints, stopNode = None):
+        """
+        _extractPath follows the cheapest of the given tree nodes back to the beginning, or to just after stopNode
+        if that is given, and returns the path from start to end.
+        @type gtfsPoints: list<PathEnd>
+        @type stopNode: PathEnd
+        @rtype: list<PathEnd>
+        """
+        # First, find the end that has the cheapest cost:
         gtfsPoint = None
         "@type gtfsPoint: PathEnd"
-        if len(gtfsPointsPrev) > 0:
-            for gtfsPointPrev in gtfsPointsPrev:
+        if len(gtfsPoints) > 0:
+            for gtfsPointPrev in gtfsPoints:
                 "@type gtfsPointPrev: PathEnd"
                 if (gtfsPoint is None) or (gtfsPointPrev.totalCost < gtfsPoint.totalCost):
                     gtfsPoint = gtfsPointPrev
@@ -289,12 +726,77 @@ class PathEngine:
         # Then, follow that end to the beginning:
         ret = []
         "@type ret: list<PathEnd>"
-        while gtfsPoint is not None:
+        while (gtfsPoint is not None) and (gtfsPoint is not stopNode):
             ret.append(gtfsPoint)
             gtfsPoint = gtfsPoint.prevTreeNode
             
         # Reverse the order of the list to go from start to end.
-        return ret[::-1]
+        ret.reverse()
+        return ret
+    
+    @staticmethod
+    def _noteConvergence(gtfsPoints, convergedNodes):
+        """
+        _noteConvergence walks back from the current candidate paths to the most recent tree node that they all share,
+        and adds that node and its ancestors to convergedNodes.
+        @type gtfsPoints: list<PathEnd>
+        @type convergedNodes: set<PathEnd>
+        """
+        treeNodes = set(gtfsPoints)
+        "@type treeNodes: set<PathEnd>"
+        while (len(treeNodes) > 1) and (None not in treeNodes):
+            treeNodes = set([treeNode.prevTreeNode for treeNode in treeNodes])
+        if len(treeNodes) == 1:
+            treeNode = treeNodes.pop()
+            while (treeNode is not None) and (treeNode not in convergedNodes):
+                convergedNodes.add(treeNode)
+                treeNode = treeNode.prevTreeNode
+
+    def _spliceCorridor(self, pathProcessor, shapeEntries, shapeIndex, gtfsPointsPrev, vistaGraph, convergedNodes):
+        """
+        _spliceCorridor checks whether the points that begin at shapeIndex had been confidently matched for another
+        shape.  If so, it finds paths from gtfsPointsPrev to the beginning of that run and then copies the rest of
+        the run's tree nodes.
+        @type pathProcessor: graph.WalkPathProcessor
+        @type shapeEntries: list<ShapesEntry>
+        @type shapeIndex: int
+        @type gtfsPointsPrev: list<PathEnd>
+        @type vistaGraph: graph.GraphLib
+        @type convergedNodes: set<PathEnd>
+        @return The number of shape points that were spliced in (0 for none), and the last new tree node
+        @rtype int, PathEnd
+        """
+        run = self.corridorCache.lookup(shapeEntries, shapeIndex)
+        "@type run: list<PathEnd>"
+        if len(run) == 0:
+            return (0, None)
+        
+        # Link up to the beginning of the run.  If that can't be done, then carry on with the normal search:
+        gtfsPoints = self._findShortestPaths(pathProcessor, shapeEntries[shapeIndex], gtfsPointsPrev,
+                                             [PathEnd(shapeEntries[shapeIndex], run[0].pointOnLink)], vistaGraph, 2)
+        if len(gtfsPoints) == 0:
+            return (0, None)
+        gtfsPoint = gtfsPoints[0]
+        "@type gtfsPoint: PathEnd"
+        if gtfsPoint.prevTreeNode is not None:
+            convergedNodes.add(gtfsPoint.prevTreeNode)
+        
+        # Copy the rest of the run, carrying over the cost and distance of each step:
+        for index in range(1, len(run)):
+            convergedNodes.add(gtfsPoint)
+            newPoint = PathEnd(shapeEntries[shapeIndex + index], run[index].pointOnLink)
+            "@type newPoint: PathEnd"
+            newPoint.prevTreeNode = gtfsPoint
+            newPoint.routeInfo = list(run[index].routeInfo)
+            newPoint.totalCost = gtfsPoint.totalCost + run[index].totalCost - run[index - 1].totalCost
+            newPoint.totalDist = gtfsPoint.totalDist + run[index].totalDist - run[index - 1].totalDist
+            gtfsPoint = newPoint
+        
+        self.corridorCache.splicedPoints += len(run)
+        if self.logFile is not None:
+            print("INFO: Reusing corridor match from shape %s for seq %d through %d." % (str(run[0].shapeEntry.shapeID),
+                shapeEntries[shapeIndex].shapeSeq, shapeEntries[shapeIndex + len(run) - 1].shapeSeq), file = self.logFile)
+        return (len(run), gtfsPoint)
 
     @staticmethod
     def _findNextRestart(gtfsPath, startIndex = 0):
@@ -325,10 +827,11 @@ class PathEngine:
         self.termRefactorRadiusSq = termRefactorRadius ** 2        
 
     def _tryTreeStack(self, pathProcessor, oldTreeNode, prevOldShape, prevTreeNodes, hintEntries, hintStatus, vistaGraph,
-            evalCode, firstFlag):
+            evalCode):
         """
-        _tryTreeStack() is a potentially recursively called internal worker method that reevaluates tree indices and
-        generates new tree nodes.
+        _tryTreeStack() reevaluates tree indices and generates new tree nodes for oldTreeNode.  Where a hint is near,
+        the chain of hints that are each near the one before is followed, keeping the tree nodes of each hint level on
+        a stack.  The shape point is then evaluated from each level of the stack, from the last hint back to the first.
         @type pathProcessor: graph.WalkPathProcessor
         @type oldTreeNode: PathEnd
         @type prevOldShape: gtfs.ShapesEntry
@@ -338,18 +841,15 @@ class PathEngine:
         @type vistaGraph: graph.GraphLib
         @param evalCode: Use 0: no evaluation, 1: full evaluation, 2: wrap up loose ends
         @type evalCode: int
-        @type firstFlag: bool
         @return The list of new tree nodes as well as an integer expressing the first active hint, or -1 for none, and
             then the eval code that was most recently used. 
         @rtype: list<PathEnd>, int, int        
         """
-        curListAllHints = [] # For this iteration and recursions
+        curListAllHints = []
         curListAllNonHints = []
         "@type curListALl: list<PathEnd>"
         prevPointsOnLinks = [prevTreeNode.pointOnLink for prevTreeNode in prevTreeNodes]
-
-        if firstFlag:        
-            self.shapeScatterCache = None
+        self.shapeScatterCache = None
         
         hitHint = False
         
@@ -364,134 +864,264 @@ class PathEngine:
         
         for prevTreeNodesForHint in treeNodesByHint.values():
             "@type prevTreeNodesForHint: list<PathEnd>"
-            hintIndex = prevTreeNodesForHint[0].hintIndex
-            if hintIndex + 1 < len(hintEntries):
+            # Follow the chain of hints, each within proximity of the point before:
+            levelStack = []
+            "@type levelStack: list<(list<PathEnd>, list<graph.PointOnLink>)>"
+            (levelNodes, levelPoints, levelShape) = (prevTreeNodesForHint, prevPointsOnLinks, prevOldShape)
+            while len(levelNodes) > 0:
+                levelStack.append((levelNodes, levelPoints))
+                hintIndex = levelNodes[0].hintIndex
+                if hintIndex + 1 >= len(hintEntries):
+                    break
                 hintEntry = hintEntries[hintIndex + 1]
                 "@type hintEntry: gtfs.ShapesEntry"
-                # Is the previous point we're dealing with within proximity of the next hint point?
-                if (prevOldShape is not None) and (linear.getNormSq(prevOldShape.pointX, prevOldShape.pointY,
-                            hintEntry.pointX, hintEntry.pointY) < self.hintRefactorRadiusSq):
-                    
-                    # Set the hintStatus variable to be the next hint index.
-                    if hintIndex + 1 > hintStatus:
-                        hintStatus = hintIndex + 1
-                        print("INFO: Enter hint# %d zone at shapeID %s, seq %d..." % (hintEntries[hintStatus].shapeSeq,
-                            str(oldTreeNode.shapeEntry.shapeID), oldTreeNode.shapeEntry.shapeSeq), file = self.logFile)
-                    
-                    # TODO: Cache these so that we don't need to find the points for each hint again.
-                    closestVISTA = vistaGraph.findPointsOnLinks(hintEntry.pointX, hintEntry.pointY, self.pointSearchRadius,
-                        self.pointSearchPrimary, self.pointSearchSecondary, prevPointsOnLinks, self.limitHintClosest)
-                    "@type closestVISTA: list<graph.PointOnLink>"
-        
-                    if len(closestVISTA) == 0:
-                        if self.logFile is not None:
-                            print("WARNING: No closest VISTA points were found for hint for shape %s, sequence %d." \
-                                  % (str(hintEntry.shapeID), hintEntry.shapeSeq), file = self.logFile)
-                    else:
-                        # Initialize blank GTFS tree entries for each found hint proximity point:
+                if (levelShape is None) or (linear.getNormSq(levelShape.pointX, levelShape.pointY, hintEntry.pointX,
+                        hintEntry.pointY) >= self.hintRefactorRadiusSq):
+                    break
+                
+                # Set the hintStatus variable to be the next hint index.
+                if hintIndex + 1 > hintStatus:
+                    hintStatus = hintIndex + 1
+                    print("INFO: Enter hint# %d zone at shapeID %s, seq %d..." % (hintEntries[hintStatus].shapeSeq,
+                        str(oldTreeNode.shapeEntry.shapeID), oldTreeNode.shapeEntry.shapeSeq), file = self.logFile)
+                
+                closestVISTA = self._findZonePoints(hintEntry, levelPoints, self._budgeted(self.limitHintClosest),
+                                                    vistaGraph)
+                "@type closestVISTA: list<graph.PointOnLink>"
+                if len(closestVISTA) == 0:
+                    if self.logFile is not None:
+                        print("WARNING: No closest VISTA points were found for hint for shape %s, sequence %d." \
+                              % (str(hintEntry.shapeID), hintEntry.shapeSeq), file = self.logFile)
+                    break
+                
+                # Initialize blank GTFS tree entries for each found hint proximity point:
+                gtfsPoints = []
+                "@type gtfsPoints: list<PathEnd>"
+                for vistaPoint in closestVISTA:                            
+                    "@type vistaPoint: graph.PointOnLink"
+                    gtfsPoint = PathEnd(hintEntry, vistaPoint)
+                    "@type gtfsPoint: PathEnd"
+                    gtfsPoint.hintIndex = hintIndex + 1 # Increment the hint index for future reference.
+                    gtfsPoints.append(gtfsPoint) 
+                
+                # Find the shortest paths from the previous level to the handful of closestVISTA points, and then see
+                # if there are more hints in this common area that need to be dealt with:
+                levelNodes = self._findShortestPaths(pathProcessor, hintEntry, levelNodes, gtfsPoints, vistaGraph, 2)
+                levelPoints = [levelNode.pointOnLink for levelNode in levelNodes]
+                levelShape = hintEntry
+                if len(levelStack) == 1:
+                    evalCode = 1 # Hint levels are always fully evaluated.                        
+                    hitHint = True
+
+            # Now deal with shape points for each level, starting with the last hint:
+            levelResults = []
+            "@type levelResults: list<PathEnd>"
+            for level in range(len(levelStack) - 1, -1, -1):
+                (levelNodes, levelPoints) = levelStack[level]
+                hintIndex = levelNodes[0].hintIndex
+                firstFlag = level == 0
+                levelEvalCode = evalCode if firstFlag else 1
+                curListNonHints = []
+                "@type curListNonHints: list<PathEnd>"
+                
+                # Are we in an area that requires reevaluation?
+                if levelEvalCode > 0:
+                    if levelEvalCode == 1:
+                        # Check if we had found all of the shape proximity points already:
+                        if self.shapeScatterCache is None:
+                            # Search for nearest points to the shape point:
+                            self.shapeScatterCache = self._findZonePoints(oldTreeNode.shapeEntry, levelPoints,
+                                self._budgeted(self.limitClosestPoints), vistaGraph)
+                        
+                        # Create new PathEnd objects:
                         gtfsPoints = []
                         "@type gtfsPoints: list<PathEnd>"
-                        for vistaPoint in closestVISTA:                            
+                        for vistaPoint in self.shapeScatterCache:
                             "@type vistaPoint: graph.PointOnLink"
-                            gtfsPoint = PathEnd(hintEntry, vistaPoint)
+                            gtfsPoint = PathEnd(oldTreeNode.shapeEntry, vistaPoint)
                             "@type gtfsPoint: PathEnd"
-                            gtfsPoint.hintIndex = hintIndex + 1 # Increment the hint index for future reference.
-                            gtfsPoints.append(gtfsPoint) 
-                        
+                            gtfsPoint.hintIndex = hintIndex
+                            gtfsPoints.append(gtfsPoint)
+                    else:
+                        # We are getting all previous points to converge down on one point, preserving the best one:
+                        gtfsPoints = [oldTreeNode.cleanCopy()]
+                        "@type gtfsPoints: list<PathEnd>"
+                        gtfsPoints[0].hintIndex = hintIndex
+            
+                    if len(gtfsPoints) > 0:
                         # Find the shortest paths from gtfsPointsPrev to the handful of closestVISTA points:
-                        curList = self._findShortestPaths(pathProcessor, hintEntry, prevTreeNodesForHint, gtfsPoints, vistaGraph, 2)
-                            
-                        # Then, see if there are more hints in this common area that need to be dealt with:
-                        (curList, hintStatus, evalCode) = self._tryTreeStack(pathProcessor, oldTreeNode, hintEntry, curList, hintEntries, hintStatus,
-                            vistaGraph, 1, False)
-                        curListAllHints.extend(curList)
-    
-                        evalCode = 1 # Stomp return for children; force this to 1 as before.                        
-                        hitHint = True
-                    
-            # Are we in an area that requires reevaluation?  Deal with shape points here:
-            if evalCode > 0:
-                if evalCode == 1:
-                    # Check if we had found all of the shape proximity points already:
-                    if self.shapeScatterCache is None:
-                        # Search for nearest points to the shape point:
-                        self.shapeScatterCache = vistaGraph.findPointsOnLinks(oldTreeNode.shapeEntry.pointX,
-                            oldTreeNode.shapeEntry.pointY, self.pointSearchRadius, self.pointSearchPrimary,
-                            self.pointSearchSecondary, prevPointsOnLinks, self.limitClosestPoints)
-                    
-                    # Create new PathEnd objects:
-                    gtfsPoints = len(self.shapeScatterCache) * []
-                    "@type gtfsPoints: list<PathEnd>"
-                    for vistaPoint in self.shapeScatterCache:
-                        "@type vistaPoint: graph.PointOnLink"
-                        gtfsPoint = PathEnd(oldTreeNode.shapeEntry, vistaPoint)
-                        "@type gtfsPoint: PathEnd"
-                        gtfsPoint.hintIndex = hintIndex
-                        gtfsPoints.append(gtfsPoint)
-                elif evalCode == 2:
-                    # We are getting all previous points to converge down on one point, preserving the best one:
-                    gtfsPoints = [oldTreeNode.cleanCopy()]
-                    "@type gtfsPoints: list<PathEnd>"
-                    gtfsPoints[0].hintIndex = hintIndex
-        
-                if len(gtfsPoints) > 0:
-                    # Find the shortest paths from gtfsPointsPrev to the handful of closestVISTA points:
-                    curList = self._findShortestPaths(pathProcessor, oldTreeNode.shapeEntry, prevTreeNodesForHint,
-                        gtfsPoints, vistaGraph, 1 if firstFlag else 2)
-                    # Check for restarts and penalize.  Only keep the first (cheapest) restart.  Meanwhile, append to
-                    # the results list:
-                    restartFlag = False
-                    for gtfsPoint in curList:
-                        if gtfsPoint.restart:
-                            if not restartFlag:
-                                gtfsPoint.totalCost *= HINT_RESTART_PENALTY_MULT
-                                curListAllNonHints.append(gtfsPoint)
-                                restartFlag = True
-                        else:
-                            curListAllNonHints.append(gtfsPoint)
-                            
-            elif firstFlag:
-                # This happens if we are not reevaluating the existing paths at all.
-                # TODO: The total cost isn't being added up properly here.  Try combining the evalCode 0 and 2 parts to
-                # get the system to retrace the steps that had been traversed before.
-                curTreeNode = copy.copy(oldTreeNode)
-                "@type curTreeNode: PathEnd"
-                assert len(prevTreeNodesForHint) == 1 # There should just be one of these.
-                curTreeNode.prevTreeNode = prevTreeNodesForHint[0] 
-                curTreeNode.hintIndex = hintIndex
-                curListAllNonHints.append(curTreeNode)
+                        curList = self._findShortestPaths(pathProcessor, oldTreeNode.shapeEntry, levelNodes,
+                            gtfsPoints, vistaGraph, 1 if firstFlag else 2)
+                        # Check for restarts and penalize.  Only keep the first (cheapest) restart.  Meanwhile, append
+                        # to the results list:
+                        restartFlag = False
+                        for gtfsPoint in curList:
+                            if gtfsPoint.restart:
+                                if not restartFlag:
+                                    gtfsPoint.totalCost *= HINT_RESTART_PENALTY_MULT
+                                    curListNonHints.append(gtfsPoint)
+                                    restartFlag = True
+                            else:
+                                curListNonHints.append(gtfsPoint)
+                                
+                elif firstFlag:
+                    # This happens if we are not reevaluating the existing paths at all.
+                    # TODO: The total cost isn't being added up properly here.  Try combining the evalCode 0 and 2 parts
+                    # to get the system to retrace the steps that had been traversed before.
+                    curTreeNode = copy.copy(oldTreeNode)
+                    "@type curTreeNode: PathEnd"
+                    assert len(levelNodes) == 1 # There should just be one of these.
+                    curTreeNode.prevTreeNode = levelNodes[0] 
+                    curTreeNode.hintIndex = hintIndex
+                    curListNonHints.append(curTreeNode)
                 
-        if firstFlag:
-            if evalCode == 2:
-                # Only keep the best non-hint result when we converge down to one point:
-                curListAllNonHints.sort(key = operator.attrgetter('totalCost'))
-                curListAllNonHints = [curListAllNonHints[0]]
-            elif not hitHint and (hintStatus >= 0):
-                # We have exited the hint zone.  Check to see if we had hit all of the hints:
-                curListAll = list(curListAllHints)
-                curListAll.extend(curListAllNonHints)
-                for gtfsPoint in curListAll:
-                    if gtfsPoint.hintIndex < hintStatus:
-                        # Whoops.  In this one we hadn't.  Penalize it:
-                        gtfsPoint.totalCost += INSUFFICIENT_HINT_PENALTY * (hintStatus - gtfsPoint.hintIndex) 
-                hintStatus = -1 # We are no longer in a hint zone.
-        
-        # Limit the number of results:            
-        #curListAllHints.sort(key = operator.attrgetter('totalCost'))
-        #curListAllHints = curListAllHints[0:self.limitSimultaneousPaths]
-        #curListAllNonHints.sort(key = operator.attrgetter('totalCost'))
-        #curListAllNonHints = curListAllNonHints[0:self.limitSimultaneousPaths]
+                if firstFlag:
+                    curListAllNonHints.extend(curListNonHints)
+                    curListAllHints.extend(levelResults)
+                else:
+                    levelResults = curListNonHints + levelResults
+                
+        if evalCode == 2:
+            # Only keep the best non-hint result when we converge down to one point:
+            curListAllNonHints.sort(key = operator.attrgetter('totalCost'))
+            curListAllNonHints = [curListAllNonHints[0]]
+        elif not hitHint and (hintStatus >= 0):
+            # We have exited the hint zone.  Check to see if we had hit all of the hints:
+            curListAll = list(curListAllHints)
+            curListAll.extend(curListAllNonHints)
+            for gtfsPoint in curListAll:
+                if gtfsPoint.hintIndex < hintStatus:
+                    # Whoops.  In this one we hadn't.  Penalize it:
+                    gtfsPoint.totalCost += INSUFFICIENT_HINT_PENALTY * (hintStatus - gtfsPoint.hintIndex) 
+            hintStatus = -1 # We are no longer in a hint zone.
         
         curListAll = curListAllNonHints
         curListAll.extend(curListAllHints)
-        #curListAll.sort(key = operator.attrgetter('totalCost'))
         
         return (curListAll, hintStatus, evalCode)
 
+    def _scanLinks(self, shapeEntry, pointX, pointY, radius, vistaGraph):
+        """
+        _scanLinks is like vistaGraph.findLinksInRadius(), but goes through candidateLattice if one is kept.  A shape
+        point that isn't in the lattice yet is scanned out to latticeRadius and added to it; the links within radius
+        are then filtered from the lattice.  Hints, and radii beyond latticeRadius, are always scanned directly.
+        @type shapeEntry: gtfs.ShapesEntry
+        @type pointX: float
+        @type pointY: float
+        @type radius: float
+        @type vistaGraph: graph.GraphLib
+        @rtype list<(float, graph.PointOnLink)>
+        """
+        if (self.candidateLattice is None) or shapeEntry.hintFlag or (radius > self.latticeRadius):
+            return vistaGraph.findLinksInRadius(pointX, pointY, radius)
+        key = (shapeEntry.shapeID, shapeEntry.shapeSeq)
+        if key not in self.candidateLattice:
+            self.candidateLattice[key] = [(pointOnLink.link.id, pointOnLink.dist, pointOnLink.nonPerpPenalty, distSq)
+                for (distSq, pointOnLink) in vistaGraph.findLinksInRadius(pointX, pointY, self.latticeRadius)]
+        radiusSq = radius ** 2
+        return [(distSq, graph.PointOnLink(vistaGraph.linkMap[linkID], dist, nonPerpPenalty, math.sqrt(distSq)))
+                for (linkID, dist, nonPerpPenalty, distSq) in self.candidateLattice[key] if distSq <= radiusSq]
+
+    def fillLattice(self, shapeEntries, vistaGraph):
+        """
+        fillLattice adds the links around each of the given shape points to candidateLattice, as matching them would,
+        for shapes whose paths are had from elsewhere.
+        @type shapeEntries: list<gtfs.ShapesEntry>
+        @type vistaGraph: graph.GraphLib
+        """
+        for shapeEntry in shapeEntries:
+            (pointX, pointY) = vistaGraph.gps.gps2feet(shapeEntry.lat, shapeEntry.lng)
+            self._scanLinks(shapeEntry, pointX, pointY, self.latticeRadius, vistaGraph)
+
+    def _findZonePoints(self, shapeEntry, prevPoints, limitClosestPoints, vistaGraph):
+        """
+        _findZonePoints is like vistaGraph.findPointsOnLinks() for the given shape or hint entry, but the scan for
+        links within pointSearchRadius is kept for as long as the current refine zone lasts.
+        @type shapeEntry: gtfs.ShapesEntry
+        @type prevPoints: list<graph.PointOnLink>
+        @type limitClosestPoints: int
+        @type vistaGraph: graph.GraphLib
+        @rtype list<graph.PointOnLink>
+        """
+        if id(shapeEntry) not in self._zoneScans:
+            self._zoneScans[id(shapeEntry)] = self._scanLinks(shapeEntry, shapeEntry.pointX, shapeEntry.pointY,
+                                                              self.pointSearchRadius, vistaGraph)
+        return vistaGraph.filterPointsOnLinks(self._zoneScans[id(shapeEntry)], self.pointSearchPrimary,
+                                              self.pointSearchSecondary, prevPoints, limitClosestPoints)
+
+    def _findQuietRuns(self, oldGTFSPath, hintEntries):
+        """
+        _findQuietRuns finds the stretches of oldGTFSPath that refinePath() would carry over unchanged: shape points
+        that aren't within termRefactorRadius of any restart, and whose previous shape point isn't within
+        hintRefactorRadius of any hint.  The hint and restart zones are worked out here once, so that the stretches
+        in between can be passed through without visiting each point.
+        @type oldGTFSPath: list<PathEnd>
+        @type hintEntries: list<gtfs.ShapesEntry>
+        @return For each index that begins a passable stretch, the index just past the end of the stretch, or else 0.
+        @rtype list<int>
+        """
+        # File the restart points and hints into grids so that each shape point can be checked against the nearby
+        # ones only:
+        restartGrid = linear.PointGrid(max(self.termRefactorRadius, 1.0))
+        "@type restartGrid: linear.PointGrid"
+        for index in range(1, len(oldGTFSPath)):
+            if oldGTFSPath[index].restart:
+                for restartPoint in (oldGTFSPath[index - 1].pointOnLink, oldGTFSPath[index].pointOnLink):
+                    restartGrid.add(restartPoint.pointX, restartPoint.pointY)
+        hintGrid = linear.PointGrid(max(self.hintRefactorRadius, 1.0))
+        "@type hintGrid: linear.PointGrid"
+        for hintEntry in hintEntries:
+            hintGrid.add(hintEntry.pointX, hintEntry.pointY)
+        
+        quiet = [False] * len(oldGTFSPath)
+        prevShape = None
+        "@type prevShape: gtfs.ShapesEntry"
+        for index, treeNode in enumerate(oldGTFSPath):
+            "@type treeNode: PathEnd"
+            if treeNode.shapeEntry.hintFlag:
+                continue
+            if prevShape is not None:
+                quiet[index] = not restartGrid.anyWithin(treeNode.pointOnLink.pointX, treeNode.pointOnLink.pointY,
+                    self.termRefactorRadius) and not hintGrid.anyWithin(prevShape.pointX, prevShape.pointY,
+                    self.hintRefactorRadius)
+            prevShape = treeNode.shapeEntry
+        
+        # Link up the stretches, working backwards:
+        ret = [0] * len(oldGTFSPath)
+        "@type ret: list<int>"
+        for index in range(len(oldGTFSPath) - 1, -1, -1):
+            if quiet[index]:
+                ret[index] = index + 1
+                if index + 1 < len(oldGTFSPath) and ret[index + 1] > 0 \
+                        and oldGTFSPath[index + 1].prevTreeNode is oldGTFSPath[index]:
+                    ret[index] = ret[index + 1]
+        return ret
+
+    @staticmethod
+    def needsRefine(oldGTFSPath, hintEntries):
+        """
+        needsRefine returns False if refinePath() would return the same path that it was given, which is the case
+        when there are no hints and the path has no restarts and no hint points.
+        @type oldGTFSPath: list<PathEnd>
+        @type hintEntries: list<gtfs.ShapesEntry>
+        @rtype bool
+        """
+        if len(hintEntries) > 0:
+            return True
+        for index, treeNode in enumerate(oldGTFSPath):
+            "@type treeNode: PathEnd"
+            if (treeNode.restart and index > 0) or treeNode.shapeEntry.hintFlag:
+                return True
+        return False
+
     def refinePath(self, oldGTFSPath, vistaGraph, hintEntries):
         """
         refinePath goes through existing GTFS points and uses hints to redo sections of paths.  It also
-        tries to route from a restart.  Uses hintRefactorRadius and termRefactorRadius.
+        tries to route from a restart.  Uses hintRefactorRadius and termRefactorRadius.  Stretches of oldGTFSPath
+        that lie outside of all hint and restart zones are carried over as they are.  Up to where the new path first
+        departs from the old one, its tree nodes are shared with oldGTFSPath, and such a stretch is handed over in one
+        step.  After that, the stretches are copied node by node, because their old tree nodes link back to the old
+        path; oldGTFSPath itself isn't modified.
         @type oldGTFSPath: list<PathEnd>
         @type vistaGraph: graph.GraphLib
         @type hintEntries: list<gtfs.ShapesEntry>
@@ -509,6 +1139,10 @@ class PathEngine:
         pathProcessor = graph.WalkPathProcessor(self.limitDirectDist, self.limitLinearDist, self.limitDirectDistRev,
             self.maxHops)
         "@type pathProcessor: graph.WalkPathProcessor"
+        pathProcessor.compactGraph = vistaGraph.compactGraph()
+        pathProcessor.routeCache = {}
+        self._startBudget()
+        self._zoneScans = {}
 
         # Preload the first point as the previous point:
         #if len(oldGTFSPath) > 0:
@@ -517,9 +1151,46 @@ class PathEngine:
         oldTreeNodeIndex = 0
         nextRestartIndex = -1
         evalCode = 0
+        quietRuns = self._findQuietRuns(oldGTFSPath, hintEntries)
+        passedCount = 0
         while oldTreeNodeIndex < len(oldGTFSPath):
+            # Outside of any zone, pass through an untouched stretch of the old path all at once:
+            if (not firstFlag) and (evalCode == 0) and (hintStatus == -1) and (len(treeNodes) == 1) \
+                    and (quietRuns[oldTreeNodeIndex] > 0):
+                runEnd = quietRuns[oldTreeNodeIndex]
+                curTreeNode = treeNodes[0]
+                "@type curTreeNode: PathEnd"
+                if (oldGTFSPath[oldTreeNodeIndex].prevTreeNode is curTreeNode) \
+                        and (oldGTFSPath[oldTreeNodeIndex].hintIndex == curTreeNode.hintIndex):
+                    # The new path hasn't departed from the old one yet, so the stretch is shared as it is:
+                    curTreeNode = oldGTFSPath[runEnd - 1]
+                else:
+                    for index in range(oldTreeNodeIndex, runEnd):
+                        # Link in copies so that oldGTFSPath is left as it is:
+                        newTreeNode = copy.copy(oldGTFSPath[index])
+                        "@type newTreeNode: PathEnd"
+                        newTreeNode.prevTreeNode = curTreeNode
+                        newTreeNode.hintIndex = curTreeNode.hintIndex
+                        curTreeNode = newTreeNode
+                treeNodes = [curTreeNode]
+                
+                # Catch up on the restarts that the point-by-point checks would have stepped past:
+                index = oldTreeNodeIndex
+                while (nextRestartIndex != -1) and (index < runEnd):
+                    if nextRestartIndex < index:
+                        nextRestartIndex = self._findNextRestart(oldGTFSPath, nextRestartIndex + 1)
+                        index += 1
+                    else:
+                        index = nextRestartIndex + 1
+                prevOldShape = oldGTFSPath[runEnd - 1].shapeEntry
+                self._updateBudget([(1.0, pathProcessor)], prevOldShape)
+                passedCount += runEnd - oldTreeNodeIndex
+                oldTreeNodeIndex = runEnd
+                continue
+            
             # Is this a legitimate tree node that has a good shape point?
             if not oldGTFSPath[oldTreeNodeIndex].shapeEntry.hintFlag:
+                self._updateBudget([(1.0, pathProcessor)], oldGTFSPath[oldTreeNodeIndex].shapeEntry)
                 # Check to see if we need to find the next restart:
                 if (oldTreeNodeIndex == 0) or ((evalCode != 1) and (nextRestartIndex != -1) and (nextRestartIndex < oldTreeNodeIndex)):
                     nextRestartIndex = self._findNextRestart(oldGTFSPath, nextRestartIndex + 1)
@@ -553,15 +1224,27 @@ class PathEngine:
                 # Visit this shape point further and figure out how to reevaluate it.
                 if not firstFlag:                
                     (treeNodes, hintStatus, evalCode) = self._tryTreeStack(pathProcessor, oldGTFSPath[oldTreeNodeIndex],
-                        prevOldShape, treeNodes, hintEntries, hintStatus, vistaGraph, evalCode, True)
+                        prevOldShape, treeNodes, hintEntries, hintStatus, vistaGraph, evalCode)
                 else:
                     treeNodes = [oldGTFSPath[0]]
                 prevOldShape = oldGTFSPath[oldTreeNodeIndex].shapeEntry
                 
+                if (len(treeNodes) == 1) and (evalCode == 0) and (hintStatus == -1) \
+                        and (treeNodes[0].prevTreeNode is oldGTFSPath[oldTreeNodeIndex].prevTreeNode) \
+                        and (treeNodes[0].hintIndex == oldGTFSPath[oldTreeNodeIndex].hintIndex) \
+                        and (treeNodes[0].totalCost == oldGTFSPath[oldTreeNodeIndex].totalCost):
+                    # Nothing has changed here, so keep following the old path itself:
+                    treeNodes = [oldGTFSPath[oldTreeNodeIndex]]
+                
                 if evalCode == 2:
                     # We have tied up loose ends; now reset.
                     # TODO: To always trace current paths for sanity-check, never set evalCode to 0.
                     evalCode = 0
+                if (evalCode == 0) and (hintStatus == -1):
+                    # Outside of any zone, the link scans and routes that had been kept for the zone are no longer
+                    # needed:
+                    self._zoneScans.clear()
+                    pathProcessor.routeCache.clear()
                 
                 # Check to see if we have a complete path:
                 if not firstFlag:
@@ -580,6 +1263,8 @@ class PathEngine:
         # Now, extract the shortest path.  First, find the end that has the cheapest cost:
         # TODO: Check to see if all of the hints were traversed.
         if self.logFile is not None:
+            print("INFO: Passed through %d of %d points outside of hint and restart zones." % (passedCount,
+                len(oldGTFSPath)), file = self.logFile)
             print("INFO: Finishing path...", file = self.logFile)
         gtfsPoint = None
         "@type gtfsPoint: PathEnd"
@@ -628,13 +1313,65 @@ def dumpStandardInfo(treeNodes, outFile = sys.stdout):
                 outStr = outStr + ",%d" % routeTraverse.id
         print(outStr, file = outFile)
 
-def readStandardDump(vistaGraph, gtfsShapes, inFile, shapeIDMaker = lambda x: int(x)):
+def dumpCandidateLattice(candidateLattice, latticeRadius, outFile = sys.stdout):
+    """
+    dumpCandidateLattice writes out a PathEngine.candidateLattice with one line per shape point.  Numbers are written
+    in full so that readCandidateLattice() restores them exactly.
+    @type candidateLattice: dict<(?, int), list<(int, float, bool, float)>>
+    @type latticeRadius: float
+    @type outFile: file
+    """
+    print("latticeRadius,%r" % float(latticeRadius), file = outFile)
+    print("shapeID,shapeSeq,linkIDs,dists,nonPerps,distSqs", file = outFile)
+    for (shapeID, shapeSeq) in sorted(candidateLattice.keys()):
+        entries = candidateLattice[(shapeID, shapeSeq)]
+        "@type entries: list<(int, float, bool, float)>"
+        print("%s,%d,%s,%s,%s,%s" % (str(shapeID), shapeSeq, " ".join([str(entry[0]) for entry in entries]),
+            " ".join([repr(entry[1]) for entry in entries]), "".join(["1" if entry[2] else "0" for entry in entries]),
+            " ".join([repr(entry[3]) for entry in entries])), file = outFile)
+
+def readCandidateLattice(vistaGraph, inFile, shapeIDMaker = lambda x: int(x)):
+    """
+    readCandidateLattice reads back what dumpCandidateLattice() had written.  Shape points that refer to links that
+    aren't in vistaGraph are left out.
+    @type vistaGraph: graph.GraphLib
+    @type inFile: file
+    @type shapeIDMaker: function
+    @return The lattice radius and the candidate lattice, or None if the file isn't a candidate lattice
+    @rtype (float, dict<(?, int), list<(int, float, bool, float)>>)
+    """
+    # Sanity check:
+    radiusLine = inFile.readline()
+    fileLine = inFile.readline()
+    if not (radiusLine.startswith("latticeRadius,") and fileLine.startswith("shapeID,shapeSeq,linkIDs,dists,nonPerps,distSqs")):
+        print("ERROR: The candidate lattice file doesn't have the expected header.", file = sys.stderr)
+        return None
+    latticeRadius = float(radiusLine.split(',')[1])
+    
+    ret = {}
+    "@type ret: dict<(?, int), list<(int, float, bool, float)>>"
+    for fileLine in inFile:
+        lineElems = fileLine.strip().split(',')
+        if len(lineElems) < 6:
+            continue
+        linkIDs = [int(linkID) for linkID in lineElems[2].split()]
+        missingIDs = [linkID for linkID in linkIDs if linkID not in vistaGraph.linkMap]
+        if len(missingIDs) > 0:
+            print("WARNING: The candidate lattice file refers to a nonexistent link ID %d." % missingIDs[0], file = sys.stderr)
+            continue
+        ret[(shapeIDMaker(lineElems[0]), int(lineElems[1]))] = list(zip(linkIDs, [float(dist) for dist in lineElems[3].split()],
+            [nonPerp == "1" for nonPerp in lineElems[4]], [float(distSq) for distSq in lineElems[5].split()]))
+    return (latticeRadius, ret)
+
+def readStandardDump(vistaGraph, gtfsShapes, inFile, shapeIDMaker = lambda x: int(x), restrictShapeIDs = None):
     """
     readStandardDump reconstructs the tree entries that PathEngine had created.
     @type vistaGraph: graph.GraphLib
     @type gtfsShapes: dict<int, list<gtfs.ShapesEntry>>
     @type inFile: file
     @type shapeIDMaker: function
+    @param restrictShapeIDs: If specified, lines for all other shape IDs are quietly skipped
+    @type restrictShapeIDs: set<int>
     @return A dictionary of shapeID to a list of PathEnds
     @rtype dict<int, list<PathEnd>>
     """
@@ -659,6 +1396,8 @@ def readStandardDump(vistaGraph, gtfsShapes, inFile, shapeIDMaker = lambda x: in
         if len(fileLine) > 0:
             lineElems = fileLine.split(',')
             shapeID = shapeIDMaker(lineElems[0])
+            if (restrictShapeIDs is not None) and (shapeID not in restrictShapeIDs):
+                continue
             shapeSeq = int(lineElems[1])
             hintFlag = int(lineElems[2]) != 0
             linkID = int(lineElems[3])
@@ -760,3 +1499,611 @@ def readStandardDump(vistaGraph, gtfsShapes, inFile, shapeIDMaker = lambda x: in
     # Return the tree nodes:
     return ret
 
+def clonePath(treeNodes, srcEntries, destEntries):
+    """
+    clonePath copies a path that had been found for the shape srcEntries over to destEntries, a shape that has
+    identical geometry.  The copied tree nodes refer to the entries in destEntries, and thus to its shape ID and
+    sequence numbers.
+    @type treeNodes: list<PathEnd>
+    @type srcEntries: list<gtfs.ShapesEntry>
+    @type destEntries: list<gtfs.ShapesEntry>
+    @rtype list<PathEnd>
+    """
+    entryIndices = {}
+    "@type entryIndices: dict<int, int>"
+    for index, shapeEntry in enumerate(srcEntries):
+        entryIndices[id(shapeEntry)] = index
+
+    ret = []
+    "@type ret: list<PathEnd>"
+    for treeNode in treeNodes:
+        "@type treeNode: PathEnd"
+        newEntry = copy.copy(treeNode)
+        "@type newEntry: PathEnd"
+        if id(treeNode.shapeEntry) in entryIndices:
+            newEntry.shapeEntry = destEntries[entryIndices[id(treeNode.shapeEntry)]]
+        newEntry.routeInfo = list(treeNode.routeInfo)
+        newEntry.prevTreeNode = ret[-1] if len(ret) > 0 else None
+        ret.append(newEntry)
+    return ret
+
+def compactPath(treeNodes, shapeEntries):
+    """
+    compactPath reduces a path to plain tuples that are cheap to send between processes.  Links are referred to
+    by ID and shape entries by their index in shapeEntries; an entry that isn't in shapeEntries is written out
+    in full.  Use expandPath() to restore it.
+    @type treeNodes: list<PathEnd>
+    @type shapeEntries: list<gtfs.ShapesEntry>
+    @rtype list<tuple>
+    """
+    entryIndices = {}
+    "@type entryIndices: dict<int, int>"
+    for index, shapeEntry in enumerate(shapeEntries):
+        entryIndices[id(shapeEntry)] = index
+    
+    ret = []
+    "@type ret: list<tuple>"
+    for treeNode in treeNodes:
+        "@type treeNode: PathEnd"
+        shapeEntry = treeNode.shapeEntry
+        "@type shapeEntry: gtfs.ShapesEntry"
+        if id(shapeEntry) in entryIndices:
+            entryRef = entryIndices[id(shapeEntry)]
+        else:
+            entryRef = (shapeEntry.shapeID, shapeEntry.shapeSeq, shapeEntry.lat, shapeEntry.lng, shapeEntry.hintFlag,
+                        shapeEntry.pointX, shapeEntry.pointY)
+        pointOnLink = treeNode.pointOnLink
+        "@type pointOnLink: graph.PointOnLink"
+        ret.append((entryRef, pointOnLink.link.id, pointOnLink.dist, pointOnLink.nonPerpPenalty, pointOnLink.refDist,
+                    treeNode.totalCost, treeNode.totalDist, treeNode.restart, treeNode.hintIndex,
+                    [link.id for link in treeNode.routeInfo]))
+    return ret
+
+def expandPath(compactNodes, shapeEntries, vistaGraph):
+    """
+    expandPath restores a path that had been reduced with compactPath().
+    @type compactNodes: list<tuple>
+    @type shapeEntries: list<gtfs.ShapesEntry>
+    @type vistaGraph: graph.GraphLib
+    @rtype list<PathEnd>
+    """
+    ret = []
+    "@type ret: list<PathEnd>"
+    for (entryRef, linkID, dist, nonPerpPenalty, refDist, totalCost, totalDist, restart, hintIndex, routeIDs) \
+            in compactNodes:
+        if isinstance(entryRef, tuple):
+            (shapeID, shapeSeq, lat, lng, hintFlag, pointX, pointY) = entryRef
+            shapeEntry = gtfs.ShapesEntry(shapeID, shapeSeq, lat, lng, hintFlag)
+            (shapeEntry.pointX, shapeEntry.pointY) = (pointX, pointY)
+        else:
+            shapeEntry = shapeEntries[entryRef]
+        newEntry = PathEnd(shapeEntry, graph.PointOnLink(vistaGraph.linkMap[linkID], dist, nonPerpPenalty, refDist))
+        newEntry.totalCost = totalCost
+        newEntry.totalDist = totalDist
+        newEntry.restart = restart
+        newEntry.hintIndex = hintIndex
+        newEntry.routeInfo = [vistaGraph.linkMap[routeID] for routeID in routeIDs]
+        if len(ret) > 0:
+            newEntry.prevTreeNode = ret[-1]
+        ret.append(newEntry)
+    return ret
+
+def _pathPositions(treeNodes, entryIndices):
+    """
+    _pathPositions maps the shape entry index of each tree node to its position within treeNodes.
+    @type treeNodes: list<PathEnd>
+    @type entryIndices: dict<int, int>
+    @rtype dict<int, int>
+    """
+    ret = {}
+    "@type ret: dict<int, int>"
+    for position, treeNode in enumerate(treeNodes):
+        ret[entryIndices[id(treeNode.shapeEntry)]] = position
+    return ret
+
+def _pathsAgree(pathA, positionsA, pathB, positionsB, index):
+    """
+    _pathsAgree returns True if both paths place the shape entry at index on the same spot of the same link.
+    @type pathA: list<PathEnd>
+    @type positionsA: dict<int, int>
+    @type pathB: list<PathEnd>
+    @type positionsB: dict<int, int>
+    @type index: int
+    @rtype bool
+    """
+    if (index not in positionsA) or (index not in positionsB):
+        return False
+    pointA = pathA[positionsA[index]].pointOnLink
+    pointB = pathB[positionsB[index]].pointOnLink
+    return (pointA.link.id == pointB.link.id) and (pointA.dist == pointB.dist)
+
+def _lastIndexBefore(positions, stopIndex, startIndex, default = None):
+    """
+    _lastIndexBefore returns the greatest shape entry index in positions that is within [startIndex, stopIndex), or
+    default if there is none.
+    @type positions: dict<int, int>
+    @type stopIndex: int
+    @type startIndex: int
+    @rtype int
+    """
+    for index in range(stopIndex - 1, startIndex - 1, -1):
+        if index in positions:
+            return index
+    return default
+
+def _joinPaths(headPath, headPosition, tailPath, tailPosition, restart = False):
+    """
+    _joinPaths returns headPath up through headPosition followed by tailPath after tailPosition.  The tail's
+    tree nodes are relinked onto the head, and their total costs and distances are carried on from the head.
+    If restart is True, the tail's position doesn't coincide with the head's, and the join is marked as a break
+    in continuity.
+    @type headPath: list<PathEnd>
+    @type headPosition: int
+    @type tailPath: list<PathEnd>
+    @type tailPosition: int
+    @type restart: bool
+    @rtype list<PathEnd>
+    """
+    ret = headPath[:headPosition + 1]
+    "@type ret: list<PathEnd>"
+    (costOffset, distOffset) = (0, 0)
+    if len(ret) > 0:
+        (costOffset, distOffset) = (ret[-1].totalCost, ret[-1].totalDist)
+        if tailPosition >= 0:
+            costOffset -= tailPath[tailPosition].totalCost
+            distOffset -= tailPath[tailPosition].totalDist
+        if restart and (tailPosition + 1 < len(tailPath)):
+            tailPath[tailPosition + 1].restart = True
+            tailPath[tailPosition + 1].routeInfo = []
+    for treeNode in tailPath[tailPosition + 1:]:
+        "@type treeNode: PathEnd"
+        treeNode.prevTreeNode = ret[-1] if len(ret) > 0 else None
+        treeNode.totalCost += costOffset
+        treeNode.totalDist += distOffset
+        ret.append(treeNode)
+    return ret
+
+def _latticeFor(pathFinder, shapeEntries):
+    """
+    _latticeFor picks out the part of pathFinder.candidateLattice that covers shapeEntries so that a worker process
+    can send it back along with a path, or returns None if no lattice is kept.
+    @type pathFinder: PathEngine
+    @type shapeEntries: list<gtfs.ShapesEntry>
+    @rtype dict<(?, int), list<(int, float, bool, float)>>
+    """
+    if pathFinder.candidateLattice is None:
+        return None
+    ret = {}
+    "@type ret: dict<(?, int), list<(int, float, bool, float)>>"
+    for shapeEntry in shapeEntries:
+        key = (shapeEntry.shapeID, shapeEntry.shapeSeq)
+        if key in pathFinder.candidateLattice:
+            ret[key] = pathFinder.candidateLattice[key]
+    return ret
+
+def _chunkWork(window, pathFinder, shapeEntries, vistaGraph):
+    """
+    _chunkWork finds the path for one window of a chunked shape, possibly within a worker process, and returns it
+    in compact form along with its candidate lattice and the shape IDs that had reached the time limit.
+    """
+    (start, end) = window
+    overBudgetCount = len(pathFinder.overBudgetShapes)
+    return (compactPath(pathFinder.constructPath(shapeEntries[start:end], vistaGraph), shapeEntries),
+            _latticeFor(pathFinder, shapeEntries[start:end]), pathFinder.overBudgetShapes[overBudgetCount:])
+
+def _constructWork(shapeID, pathFinder, shapes, vistaGraph, label):
+    """
+    _constructWork finds the path for one shape within a worker process and returns it in compact form along with
+    its candidate lattice and the shape IDs that had reached the time limit.  Which shapes a worker had matched
+    before depends upon how they happened to be handed out, so the corridor cache is emptied for each shape;
+    otherwise the path could change from run to run.
+    """
+    print("INFO: -- %s %s --" % (label, str(shapeID)), file = sys.stderr)
+    if pathFinder.corridorCache is not None:
+        pathFinder.corridorCache = CorridorCache(pathFinder.corridorCache.minPoints)
+    overBudgetCount = len(pathFinder.overBudgetShapes)
+    return (compactPath(pathFinder.constructPath(shapes[shapeID], vistaGraph), shapes[shapeID]),
+            _latticeFor(pathFinder, shapes[shapeID]), pathFinder.overBudgetShapes[overBudgetCount:])
+
+def constructPaths(pathFinder, shapes, shapeIDs, vistaGraph, workers = 1, label = "Shape ID", chunkSize = None):
+    """
+    constructPaths runs pathFinder.constructPath() for each of the given shape IDs and yields each shape ID
+    with its path in the order of shapeIDs.  If workers is more than 1, the shapes are matched in that many
+    forked processes that share the already-loaded vistaGraph; the result is the same as a serial run, except that
+    with a corridor cache, each shape is matched without the corridors of the others.  If chunkSize is given, each
+    shape is instead matched in turn with pathFinder.constructPathChunked(), and the workers are spent on the chunks
+    of each shape.
+    @type pathFinder: PathEngine
+    @type shapes: dict<?, list<gtfs.ShapesEntry>>
+    @type shapeIDs: list
+    @type vistaGraph: graph.GraphLib
+    @type workers: int
+    @param label: Describes the shape IDs in the log
+    @type label: str
+    @type chunkSize: int
+    @rtype generator<(?, list<PathEnd>)>
+    """
+    if chunkSize is not None:
+        for shapeID in shapeIDs:
+            print("INFO: -- %s %s --" % (label, str(shapeID)), file = sys.stderr)
+            yield (shapeID, pathFinder.constructPathChunked(shapes[shapeID], vistaGraph, chunkSize, workers = workers))
+    elif workers <= 1:
+        for shapeID in shapeIDs:
+            print("INFO: -- %s %s --" % (label, str(shapeID)), file = sys.stderr)
+            yield (shapeID, pathFinder.constructPath(shapes[shapeID], vistaGraph))
+    else:
+        compactPaths = parallel.forkMap(_constructWork, shapeIDs, workers, pathFinder, shapes, vistaGraph, label)
+        for index, (compactNodes, lattice, overBudgetShapes) in enumerate(compactPaths):
+            if lattice is not None:
+                pathFinder.candidateLattice.update(lattice)
+            pathFinder._noteOverBudget(overBudgetShapes)
+            yield (shapeIDs[index], expandPath(compactNodes, shapes[shapeIDs[index]], vistaGraph))
+
+def _fixtureGraph(size = 8, spacing = 600.0):
+    """
+    _fixtureGraph builds a grid of two-way streets that are spacing feet apart.
+    @type size: int
+    @type spacing: float
+    @rtype graph.GraphLib
+    """
+    vistaGraph = graph.GraphLib(30.27, -97.74)
+    for row in range(size):
+        for col in range(size):
+            (lat, lng) = vistaGraph.gps.feet2gps(col * spacing, row * spacing)
+            vistaGraph.addNode(graph.GraphNode(row * size + col + 1, lat, lng))
+    linkID = 1
+    for row in range(size):
+        for col in range(size):
+            nodeID = row * size + col + 1
+            for (neighborID, flag) in ((nodeID + 1, col < size - 1), (nodeID + size, row < size - 1)):
+                if flag:
+                    for (origID, destID) in ((nodeID, neighborID), (neighborID, nodeID)):
+                        vistaGraph.addLink(graph.GraphLink(linkID, vistaGraph.nodeMap[origID],
+                                                           vistaGraph.nodeMap[destID]))
+                        linkID += 1
+    return vistaGraph
+
+def _fixtureShape(vistaGraph, shapeID, coords, hintFlag = False):
+    """
+    _fixtureShape makes shape entries out of the given coordinates in feet.
+    @type vistaGraph: graph.GraphLib
+    @type coords: list<(float, float)>
+    @type hintFlag: bool
+    @rtype list<gtfs.ShapesEntry>
+    """
+    ret = []
+    "@type ret: list<gtfs.ShapesEntry>"
+    for (index, (coordX, coordY)) in enumerate(coords):
+        (lat, lng) = vistaGraph.gps.feet2gps(coordX, coordY)
+        shapeEntry = gtfs.ShapesEntry(shapeID, index + 1, lat, lng, hintFlag)
+        (shapeEntry.pointX, shapeEntry.pointY) = vistaGraph.gps.gps2feet(lat, lng)
+        ret.append(shapeEntry)
+    return ret
+
+def _fixtureCoords():
+    """
+    _fixtureCoords lays out a shape that wanders from side to side along the bottom street and then heads up
+    the street on the right side.
+    @rtype list<(float, float)>
+    """
+    return [(coordX, 20.0 if (coordX // 100) % 2 else -15.0) for coordX in range(0, 3600, 100)] \
+        + [(3600 + (15.0 if coordY % 200 else -20.0), coordY) for coordY in range(100, 3600, 100)]
+
+def _fixtureRestartCoords():
+    """
+    _fixtureRestartCoords lays out a shape that heads up the street on the left side and then jumps across the grid
+    to head down the street on the right side, which makes for a restart.
+    @rtype list<(float, float)>
+    """
+    return [(10.0, coordY) for coordY in range(50, 2400, 100)] \
+        + [(4200 - 10.0, coordY) for coordY in range(2450, 0, -100)]
+
+def _fixtureShapes(vistaGraph):
+    """
+    _fixtureShapes makes the two fixture shapes, 7 and 8.
+    @type vistaGraph: graph.GraphLib
+    @rtype dict<int, list<gtfs.ShapesEntry>>
+    """
+    return {7: _fixtureShape(vistaGraph, 7, _fixtureCoords()), 8: _fixtureShape(vistaGraph, 8, _fixtureRestartCoords())}
+
+def _dumpPath(treeNodes):
+    """
+    _dumpPath returns what dumpStandardInfo() writes out for the path.
+    @type treeNodes: list<PathEnd>
+    @rtype str
+    """
+    try:
+        from cStringIO import StringIO # Python 2
+    except ImportError:
+        from io import StringIO
+    outFile = StringIO()
+    dumpStandardInfo(treeNodes, outFile)
+    return outFile.getvalue()
+
+class _RecursivePathEngine(PathEngine):
+    """
+    _RecursivePathEngine refines paths with the recursive hint-zone search that _tryTreeStack() used to do, with no
+    link scans or routes kept across calls, so that the iterative search can be checked against it.
+    """
+    def _tryTreeStack(self, pathProcessor, oldTreeNode, prevOldShape, prevTreeNodes, hintEntries, hintStatus, vistaGraph,
+            evalCode):
+        routeCache = pathProcessor.routeCache
+        pathProcessor.routeCache = None
+        try:
+            return self._tryTreeStackRecursive(pathProcessor, oldTreeNode, prevOldShape, prevTreeNodes, hintEntries,
+                hintStatus, vistaGraph, evalCode, True)
+        finally:
+            pathProcessor.routeCache = routeCache
+
+    def _tryTreeStackRecursive(self, pathProcessor, oldTreeNode, prevOldShape, prevTreeNodes, hintEntries, hintStatus,
+            vistaGraph, evalCode, firstFlag):
+        """
+        _tryTreeStackRecursive() is a potentially recursively called internal worker method that reevaluates tree
+        indices and generates new tree nodes.
+        @rtype: list<PathEnd>, int, int
+        """
+        curListAllHints = []
+        curListAllNonHints = []
+        prevPointsOnLinks = [prevTreeNode.pointOnLink for prevTreeNode in prevTreeNodes]
+        if firstFlag:
+            self.shapeScatterCache = None
+        hitHint = False
+        
+        treeNodesByHint = {}
+        for prevTreeNode in prevTreeNodes:
+            if prevTreeNode.hintIndex not in treeNodesByHint:
+                treeNodesByHint[prevTreeNode.hintIndex] = list()
+            treeNodesByHint[prevTreeNode.hintIndex].append(prevTreeNode)
+        
+        for prevTreeNodesForHint in treeNodesByHint.values():
+            hintIndex = prevTreeNodesForHint[0].hintIndex
+            if hintIndex + 1 < len(hintEntries):
+                hintEntry = hintEntries[hintIndex + 1]
+                if (prevOldShape is not None) and (linear.getNormSq(prevOldShape.pointX, prevOldShape.pointY,
+                            hintEntry.pointX, hintEntry.pointY) < self.hintRefactorRadiusSq):
+                    if hintIndex + 1 > hintStatus:
+                        hintStatus = hintIndex + 1
+                    closestVISTA = vistaGraph.findPointsOnLinks(hintEntry.pointX, hintEntry.pointY,
+                        self.pointSearchRadius, self.pointSearchPrimary, self.pointSearchSecondary, prevPointsOnLinks,
+                        self._budgeted(self.limitHintClosest))
+                    if len(closestVISTA) > 0:
+                        gtfsPoints = []
+                        for vistaPoint in closestVISTA:
+                            gtfsPoint = PathEnd(hintEntry, vistaPoint)
+                            gtfsPoint.hintIndex = hintIndex + 1
+                            gtfsPoints.append(gtfsPoint)
+                        curList = self._findShortestPaths(pathProcessor, hintEntry, prevTreeNodesForHint, gtfsPoints,
+                                                          vistaGraph, 2)
+                        (curList, hintStatus, evalCode) = self._tryTreeStackRecursive(pathProcessor, oldTreeNode,
+                            hintEntry, curList, hintEntries, hintStatus, vistaGraph, 1, False)
+                        curListAllHints.extend(curList)
+                        evalCode = 1
+                        hitHint = True
+                    
+            if evalCode > 0:
+                if evalCode == 1:
+                    if self.shapeScatterCache is None:
+                        self.shapeScatterCache = vistaGraph.findPointsOnLinks(oldTreeNode.shapeEntry.pointX,
+                            oldTreeNode.shapeEntry.pointY, self.pointSearchRadius, self.pointSearchPrimary,
+                            self.pointSearchSecondary, prevPointsOnLinks, self._budgeted(self.limitClosestPoints))
+                    gtfsPoints = []
+                    for vistaPoint in self.shapeScatterCache:
+                        gtfsPoint = PathEnd(oldTreeNode.shapeEntry, vistaPoint)
+                        gtfsPoint.hintIndex = hintIndex
+                        gtfsPoints.append(gtfsPoint)
+                else:
+                    gtfsPoints = [oldTreeNode.cleanCopy()]
+                    gtfsPoints[0].hintIndex = hintIndex
+        
+                if len(gtfsPoints) > 0:
+                    curList = self._findShortestPaths(pathProcessor, oldTreeNode.shapeEntry, prevTreeNodesForHint,
+                        gtfsPoints, vistaGraph, 1 if firstFlag else 2)
+                    restartFlag = False
+                    for gtfsPoint in curList:
+                        if gtfsPoint.restart:
+                            if not restartFlag:
+                                gtfsPoint.totalCost *= HINT_RESTART_PENALTY_MULT
+                                curListAllNonHints.append(gtfsPoint)
+                                restartFlag = True
+                        else:
+                            curListAllNonHints.append(gtfsPoint)
+            elif firstFlag:
+                curTreeNode = copy.copy(oldTreeNode)
+                curTreeNode.prevTreeNode = prevTreeNodesForHint[0] 
+                curTreeNode.hintIndex = hintIndex
+                curListAllNonHints.append(curTreeNode)
+                
+        if firstFlag:
+            if evalCode == 2:
+                curListAllNonHints.sort(key = operator.attrgetter('totalCost'))
+                curListAllNonHints = [curListAllNonHints[0]]
+            elif not hitHint and (hintStatus >= 0):
+                for gtfsPoint in curListAllHints + curListAllNonHints:
+                    if gtfsPoint.hintIndex < hintStatus:
+                        gtfsPoint.totalCost += INSUFFICIENT_HINT_PENALTY * (hintStatus - gtfsPoint.hintIndex) 
+                hintStatus = -1
+        
+        return (curListAllNonHints + curListAllHints, hintStatus, evalCode)
+
+def _fixtureEngine(engineClass = PathEngine):
+    """
+    _fixtureEngine sets up a path engine with search limits scaled down to suit the fixture grid.
+    @type engineClass: type
+    @rtype PathEngine
+    """
+    pathFinder = engineClass(400, 400, 200, 1500, 1500, 300, 1.0, 1.5, 1.5, 8, 8)
+    pathFinder.setRefineParams(500, 1000)
+    pathFinder.maxHops = 6
+    pathFinder.limitHintClosest = 4
+    pathFinder.logFile = sys.stderr
+    return pathFinder
+
+class TestPathEngine(unittest.TestCase):
+
+    def test_refineLeavesOldPath(self):
+        """
+        Test 1: Refining a path with a hint doesn't modify the path that was given, and shares its tree nodes only up
+        to the hint zone
+        """
+        vistaGraph = _fixtureGraph()
+        pathFinder = _fixtureEngine()
+        oldGTFSPath = pathFinder.constructPath(_fixtureShape(vistaGraph, 7, _fixtureCoords()), vistaGraph)
+        before = [(treeNode.prevTreeNode, treeNode.hintIndex, treeNode.totalCost, treeNode.totalDist)
+                  for treeNode in oldGTFSPath]
+        newGTFSPath = pathFinder.refinePath(oldGTFSPath, vistaGraph, _fixtureShape(vistaGraph, 7, [(3000, 300)], True))
+        after = [(treeNode.prevTreeNode, treeNode.hintIndex, treeNode.totalCost, treeNode.totalDist)
+                 for treeNode in oldGTFSPath]
+        self.assertEqual(len(newGTFSPath), len(oldGTFSPath) + 1, "The hint is in the refined path")
+        self.assertEqual([id(item[0]) for item in after], [id(item[0]) for item in before], "Old path links")
+        self.assertEqual([item[1:] for item in after], [item[1:] for item in before], "Old path values")
+        sharedCount = 0
+        while newGTFSPath[sharedCount] is oldGTFSPath[sharedCount]:
+            sharedCount += 1
+        self.assertTrue(20 < sharedCount < 30, "The stretch before the hint zone is shared")
+        self.assertFalse(set([id(treeNode) for treeNode in newGTFSPath[sharedCount:]]) & set([id(treeNode)
+            for treeNode in oldGTFSPath]), "The refined path shares no tree nodes after it departs from the old one")
+
+    def test_refineMatchesRecursive(self):
+        """
+        Test 2: The iterative hint-zone search refines paths as the recursive one does
+        """
+        vistaGraph = _fixtureGraph()
+        shapes = _fixtureShapes(vistaGraph)
+        hints = {7: _fixtureShape(vistaGraph, 7, [(3000, 300), (3300, 280), (3620, 600)], True), 8: []}
+        for shapeID in (7, 8):
+            oldGTFSPath = _fixtureEngine().constructPath(shapes[shapeID], vistaGraph)
+            newGTFSPath = _fixtureEngine().refinePath(oldGTFSPath, vistaGraph, hints[shapeID])
+            self.assertEqual(_dumpPath(newGTFSPath), _dumpPath(_fixtureEngine(_RecursivePathEngine).refinePath(
+                oldGTFSPath, vistaGraph, hints[shapeID])), "Shape %d" % shapeID)
+            self.assertEqual(len([treeNode for treeNode in newGTFSPath if treeNode.shapeEntry.hintFlag]),
+                             len(hints[shapeID]), "Shape %d hints" % shapeID)
+        self.assertTrue(any(treeNode.restart for treeNode in oldGTFSPath[1:]), "Shape 8 has a restart")
+    
+    def test_chunkedMatchesWhole(self):
+        """
+        Test 3: constructPathChunked() finds the same paths as constructPath(), also with worker processes
+        """
+        vistaGraph = _fixtureGraph()
+        shapes = _fixtureShapes(vistaGraph)
+        for shapeID in (7, 8):
+            whole = _dumpPath(_fixtureEngine().constructPath(shapes[shapeID], vistaGraph))
+            for (chunkSize, overlap, workers) in ((10, None, 1), (20, None, 1), (30, None, 1), (15, 12, 1), (10, None, 2)):
+                self.assertTrue(len(shapes[shapeID]) > chunkSize + (overlap or 10), "Shape %d is split" % shapeID)
+                self.assertEqual(_dumpPath(_fixtureEngine().constructPathChunked(shapes[shapeID], vistaGraph,
+                    chunkSize, overlap, workers)), whole, "Shape %d in chunks of %d, overlap %s, %d workers"
+                    % (shapeID, chunkSize, str(overlap), workers))
+    
+    def test_compactMatchesDict(self):
+        """
+        Test 4: walkPath() finds the same routes on the compact arrays as on the GraphLink objects, also with U-turns
+        """
+        vistaGraph = _fixtureGraph()
+        # Add a dead-end spur off of the corner where the shapes begin:
+        (lat, lng) = vistaGraph.gps.feet2gps(-600.0, 0.0)
+        vistaGraph.addNode(graph.GraphNode(1000, lat, lng))
+        vistaGraph.addLink(graph.GraphLink(1000, vistaGraph.nodeMap[1], vistaGraph.nodeMap[1000]))
+        vistaGraph.addLink(graph.GraphLink(1001, vistaGraph.nodeMap[1000], vistaGraph.nodeMap[1]))
+        pathFinder = _fixtureEngine()
+        for (uTurnInterPenalty, uTurnDeadEndPenalty) in ((None, None), (300.0, None), (300.0, 100.0)):
+            processors = []
+            "@type processors: list<graph.WalkPathProcessor>"
+            for compactGraph in (None, vistaGraph.compactGraph()):
+                processor = graph.WalkPathProcessor(pathFinder.limitDirectDist, pathFinder.limitLinearDist,
+                                                    pathFinder.limitDirectDistRev, pathFinder.maxHops)
+                processor.compactGraph = compactGraph
+                processor.uTurnInterPenalty = uTurnInterPenalty
+                processor.uTurnDeadEndPenalty = uTurnDeadEndPenalty
+                processors.append(processor)
+            routes = ([], [])
+            "@type routes: (list<(list<int>, float)>, list<(list<int>, float)>)"
+            for (shapeID, shapeEntries) in sorted(_fixtureShapes(vistaGraph).items()):
+                prevPoints = []
+                "@type prevPoints: list<graph.PointOnLink>"
+                for shapeEntry in shapeEntries:
+                    points = vistaGraph.findPointsOnLinks(shapeEntry.pointX, shapeEntry.pointY,
+                        pathFinder.pointSearchRadius, pathFinder.pointSearchPrimary, pathFinder.pointSearchSecondary,
+                        prevPoints, pathFinder.limitClosestPoints)
+                    for origPoint in prevPoints:
+                        for destPoint in points:
+                            for (processor, processorRoutes) in zip(processors, routes):
+                                (traversed, distance) = processor.walkPath(origPoint, destPoint)
+                                processorRoutes.append(([link.id for link in traversed] if traversed is not None
+                                                        else None, distance))
+                    prevPoints = points
+            self.assertEqual(routes[1], routes[0], "Routes with U-turn penalties %s, %s" % (str(uTurnInterPenalty),
+                                                                                         str(uTurnDeadEndPenalty)))
+            self.assertTrue(len([route for (route, distance) in routes[0] if route is not None and len(route) > 1])
+                            > 100, "Routes that cross intersections")
+    
+    def test_tiledMatchesInMemory(self):
+        """
+        Test 5: A tiled snapshot that holds one tile at a time finds the same links and paths as the whole graph
+        """
+        from nmc_mm_lib import graph_snapshot
+        vistaGraph = _fixtureGraph()
+        shapes = _fixtureShapes(vistaGraph)
+        tempPath = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempPath, "fixture.tiles")
+            graph_snapshot.saveTiledSnapshot(vistaGraph, filename, "fixture", 1000.0)
+            tiledGraph = graph_snapshot.openTiledSnapshot(filename, "fixture", 1)
+            tiledShapes = _fixtureShapes(tiledGraph)
+            for shapeID in (7, 8):
+                for (shapeEntry, tiledEntry) in zip(shapes[shapeID], tiledShapes[shapeID]):
+                    for radius in (400, 1600):
+                        self.assertEqual(sorted([(distSq, pointOnLink.link.id, pointOnLink.dist) for (distSq,
+                            pointOnLink) in tiledGraph.findLinksInRadius(tiledEntry.pointX, tiledEntry.pointY,
+                            radius)]), sorted([(distSq, pointOnLink.link.id, pointOnLink.dist) for (distSq,
+                            pointOnLink) in vistaGraph.findLinksInRadius(shapeEntry.pointX, shapeEntry.pointY,
+                            radius)]), "Shape %d point %d within %d" % (shapeID, shapeEntry.shapeSeq, radius))
+                self.assertEqual(_dumpPath(_fixtureEngine().constructPath(tiledShapes[shapeID], tiledGraph)),
+                                 _dumpPath(_fixtureEngine().constructPath(shapes[shapeID], vistaGraph)),
+                                 "Shape %d" % shapeID)
+        finally:
+            shutil.rmtree(tempPath)
+    
+    def test_tiledLoadsNearTiles(self):
+        """
+        Test 6: A tiled snapshot reads in only the tiles that a link search reaches, and listing all of the links
+        doesn't let go of the tiles that are in use
+        """
+        from nmc_mm_lib import graph_snapshot
+        vistaGraph = _fixtureGraph()
+        # A long link from the bottom left corner to the top right corner, whose destination tile is far away:
+        vistaGraph.addLink(graph.GraphLink(1000, vistaGraph.nodeMap[1], vistaGraph.nodeMap[64]))
+        tempPath = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempPath, "fixture.tiles")
+            graph_snapshot.saveTiledSnapshot(vistaGraph, filename, "fixture", 1000.0)
+            tiledGraph = graph_snapshot.openTiledSnapshot(filename, "fixture", 2)
+            found = tiledGraph.findLinksInRadius(300.0, 300.0, 100.0)
+            self.assertEqual([pointOnLink.link.id for (distSq, pointOnLink) in found], [1000], "The long link")
+            self.assertEqual(tiledGraph.loadCount, 1, "Only the tile where the long link starts is read in")
+            self.assertAlmostEqual(found[0][1].pointX, 300.0, 6, "Point on the long link")
+            self.assertAlmostEqual(found[0][1].pointY, 300.0, 6, "Point on the long link")
+            
+            self.assertEqual(len(list(tiledGraph.linkMap.values())), len(vistaGraph.linkMap), "All of the links")
+            loadCount = tiledGraph.loadCount
+            tiledGraph.findLinksInRadius(300.0, 300.0, 100.0)
+            self.assertEqual(tiledGraph.loadCount, loadCount, "The tile in use is still loaded")
+        finally:
+            shutil.rmtree(tempPath)
+    
+    def test_workersMatchSerial(self):
+        """
+        Test 7: constructPaths() finds the same paths with worker processes as without, in the order asked for
+        """
+        vistaGraph = _fixtureGraph()
+        shapes = _fixtureShapes(vistaGraph)
+        shapes[9] = _fixtureShape(vistaGraph, 9, _fixtureCoords()[::-1])
+        shapeIDs = [8, 9, 7]
+        serial = [(shapeID, _dumpPath(treeNodes)) for (shapeID, treeNodes)
+                  in constructPaths(_fixtureEngine(), shapes, shapeIDs, vistaGraph)]
+        self.assertEqual([shapeID for (shapeID, dump) in serial], shapeIDs, "Serial order")
+        for workers in (2, 3):
+            forked = [(shapeID, _dumpPath(treeNodes)) for (shapeID, treeNodes)
+                      in constructPaths(_fixtureEngine(), shapes, shapeIDs, vistaGraph, workers = workers)]
+            self.assertEqual(forked, serial, "Paths with %d workers" % workers)
+
+if __name__ == '__main__':
+    unittest.main()
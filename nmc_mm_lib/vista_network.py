@@ -1,7 +1,8 @@
 """
 vista_network.py is an underlying node-link data representation of a
     roadway network. This requires psycopg to read a PostgreSQL DB
-    of the format defined in file vista-def.sql.
+    of the format defined in file vista-def.sql. The same tables can
+    instead be read from CSV files or a SQLite database.
 @author: Kenneth Perrine
 @contact: kperrine@utexas.edu
 @organization: Network Modeling Center, Center for Transportation Research,
@@ -25,51 +26,347 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
-from nmc_mm_lib import graph
-import sys, psycopg2
+from nmc_mm_lib import graph, graph_snapshot, gps
+import sys, os, hashlib, time
+try:
+    import resource
+except ImportError:
+    resource = None # Not available on Windows.
+
+CSV_PREFIX = "csv:"
+"@var CSV_PREFIX: Begins a dbServer that names a directory holding nodes.csv and linkdetails.csv."
+SQLITE_PREFIX = "sqlite:"
+"@var SQLITE_PREFIX: Begins a dbServer that names a SQLite database file holding the nodes and linkdetails tables."
+
+FETCH_BATCH_SIZE = 20000
+"@var FETCH_BATCH_SIZE: The number of rows that are brought over from the database at a time while reading the topology."
+
+# The columns of the tables in vista-def.sql that are read, with the SQLite types that they are loaded as:
+_TABLE_COLUMNS = (("nodes", (("id", "INTEGER"), ("type", "INTEGER"), ("x", "REAL"), ("y", "REAL"))),
+                  ("linkdetails", (("id", "INTEGER"), ("type", "INTEGER"), ("source", "INTEGER"),
+                                   ("destination", "INTEGER"), ("length", "REAL"))))
 
 def connect(dbServer, userName, password, networkName):
     """
-    Connects to the VISTA database.
+    Connects to the VISTA database.  If dbServer begins with "csv:" or "sqlite:", the tables are read from the CSV
+    files in the directory or the SQLite database file that follows, and userName, password and networkName aren't
+    used.
     @type dbServer: str
     @type userName: str
     @type password: str
     @type networkName: str
     @rtype psycopg2.connection
     """
+    # The database modules are imported only for the kind of database that is asked for:
+    if dbServer.startswith(CSV_PREFIX):
+        return _loadCSVTables(dbServer[len(CSV_PREFIX):])
+    if dbServer.startswith(SQLITE_PREFIX):
+        filename = dbServer[len(SQLITE_PREFIX):]
+        if not os.path.isfile(filename):
+            raise IOError("The SQLite network database '%s' doesn't exist." % filename)
+        import sqlite3
+        return sqlite3.connect(filename)
+    
+    import psycopg2
     dbName = userName + "_" + networkName
     database = psycopg2.connect(host = dbServer, user = userName, password = password, database = dbName)
     return database
 
-def fillGraph(database, useDirectDist=True):
+def _loadCSVTables(directory):
+    """
+    _loadCSVTables bulk-loads nodes.csv and linkdetails.csv from the given directory into an in-memory SQLite
+    database.  The first line of each file names the columns as in vista-def.sql; other columns are ignored.
+    @type directory: str
+    @rtype sqlite3.Connection
+    """
+    import csv, sqlite3
+    database = sqlite3.connect(":memory:")
+    for (tableName, columns) in _TABLE_COLUMNS:
+        database.execute("CREATE TABLE %s (%s)" % (tableName, ", ".join(["%s %s" % column for column in columns])))
+        filename = os.path.join(directory, tableName + ".csv")
+        with open(filename, 'r') as inFile:
+            csvReader = csv.reader(inFile)
+            header = [name.strip().lower() for name in next(csvReader)]
+            try:
+                indices = [header.index(name) for (name, _) in columns]
+            except ValueError:
+                raise IOError("The network file '%s' doesn't have the columns %s." % (filename,
+                    ", ".join([name for (name, _) in columns])))
+            converters = [int if columnType == "INTEGER" else float for (_, columnType) in columns]
+            database.executemany("INSERT INTO %s VALUES (%s)" % (tableName, ", ".join(["?"] * len(columns))),
+                ([converters[column](row[index]) if row[index].strip() != "" else None
+                  for (column, index) in enumerate(indices)] for row in csvReader if len(row) > 0))
+    database.commit()
+    return database
+
+def _streamRows(database, query):
     """
-    fillGraph fills up the Graph structure from the VISTA database.
+    _streamRows runs the query and yields its rows, bringing them over FETCH_BATCH_SIZE at a time.  On PostgreSQL a
+    named (server-side) cursor is used so that the whole result isn't held by the client at once.
     @type database: psycopg2.connection
-    @return A Graph representing the VISTA network model
+    @type query: str
+    @rtype generator<tuple>
+    """
+    try:
+        cursor = database.cursor(name = "nmc_mm_fill")
+        cursor.itersize = FETCH_BATCH_SIZE
+    except TypeError:
+        # Only psycopg2 has named cursors; others can't buffer on the server anyway.
+        cursor = database.cursor()
+    try:
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+
+def _peakMemory():
+    """
+    _peakMemory describes the most memory that this process has used so far, if that can be found out.
+    @rtype str
+    """
+    if resource is None:
+        return "unknown"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024 # Linux reports kilobytes; Mac OS reports bytes.
+    return "%.1f MB" % (peak / 1048576.0)
+
+def _emptyGraph(database, useDirectDist):
+    """
+    _emptyGraph creates a Graph without any nodes or links, centered upon the geographic center of the network.
+    @type database: psycopg2.connection
+    @type useDirectDist: bool
     @rtype graph.GraphLib
     """
     cursor = database.cursor()
-    
-    # Step 1: Figure out the geographic center of the network and create the Graph:  
     cursor.execute('SELECT AVG(x), AVG(y) FROM nodes WHERE type = 1')
     row = cursor.fetchone()
-    graphLib = graph.GraphLib(row[1], row[0], useDirectDist)
+    cursor.close()
+    return graph.GraphLib(row[1], row[0], useDirectDist)
+
+def fillGraph(database, useDirectDist=True, extent=None, extentBuffer=0.0, centerCallback=None):
+    """
+    fillGraph fills up the Graph structure from the VISTA database.  The rows are streamed from the database straight
+    into the graph, and the time taken and the peak memory of the process are reported.  If extent is given, only the
+    links whose bounding boxes overlap it, widened by extentBuffer feet on every side, are read along with their nodes.
+    The GPS center is still that of the whole network, so that coordinates match those of an unclipped graph.
+    @type database: psycopg2.connection
+    @type useDirectDist: bool
+    @param extent: The (minLat, minLng, maxLat, maxLng) area to read, as from shapesExtent(), or None for all of it
+    @type extent: tuple<float, float, float, float>
+    @type extentBuffer: float
+    @param centerCallback: If given, this is called with the gps.GPS of the graph as soon as the center is known,
+        before the nodes and links are read
+    @type centerCallback: function
+    @return A Graph representing the VISTA network model
+    @rtype graph.GraphLib
+    """
+    startTime = time.time()
     
-    # Step 2: Fill out the nodes:
-    cursor.execute('SELECT id, x, y FROM nodes WHERE type = 1')
-    for row in cursor:
-        node = graph.GraphNode(row[0], row[2], row[1])
-        graphLib.addNode(node)
+    # Step 1: Figure out the geographic center of the network and create the Graph:  
+    graphLib = _emptyGraph(database, useDirectDist)
+    if centerCallback is not None:
+        centerCallback(graphLib.gps)
     
-    # Step 3: Fill out the links:
-    cursor.execute("SELECT id, source, destination, length FROM linkdetails WHERE type = 1")
-    for row in cursor:
-        if (row[1] not in graphLib.nodeMap) or (row[2] not in graphLib.nodeMap):
-            print("WARNING: Link %d has bad Node IDs %d and/or %d" % (row[0], row[1], row[2]), file = sys.stderr)
-            continue 
-        link = graph.GraphLink(row[0], graphLib.nodeMap[row[1]], graphLib.nodeMap[row[2]])
-        link.distance = row[3] # This is the reported distance, but may be replaced if GraphLib.useDirectDist is true.
-        graphLib.addLink(link)
+    if extent is not None:
+        _fillClipped(database, graphLib, extent, extentBuffer)
+    else:
+        # Step 2: Fill out the nodes:
+        for row in _streamRows(database, 'SELECT id, x, y FROM nodes WHERE type = 1'):
+            node = graph.GraphNode(row[0], row[2], row[1])
+            graphLib.addNode(node)
+        
+        # Step 3: Fill out the links:
+        for row in _streamRows(database, "SELECT id, source, destination, length FROM linkdetails WHERE type = 1"):
+            if (row[1] not in graphLib.nodeMap) or (row[2] not in graphLib.nodeMap):
+                print("WARNING: Link %d has bad Node IDs %d and/or %d" % (row[0], row[1], row[2]), file = sys.stderr)
+                continue 
+            link = graph.GraphLink(row[0], graphLib.nodeMap[row[1]], graphLib.nodeMap[row[2]])
+            link.distance = row[3] # This is the reported distance, but may be replaced if GraphLib.useDirectDist is true.
+            graphLib.addLink(link)
         
     # There we are.
+    print("INFO: Read %d nodes and %d links in %.2f s; peak memory: %s." % (len(graphLib.nodeMap), len(graphLib.linkMap),
+        time.time() - startTime, _peakMemory()), file = sys.stderr)
+    return graphLib
+
+def _fillClipped(database, graphLib, extent, extentBuffer):
+    """
+    _fillClipped fills graphLib with the links that come near the extent, and with the nodes at their ends.  The
+    bounding box test is done by the database on the x and y columns of the nodes, so that the rest of the network
+    is never brought over.  Links are kept in the order that the database returns them.
+    @type database: psycopg2.connection
+    @type graphLib: graph.GraphLib
+    @type extent: tuple<float, float, float, float>
+    @type extentBuffer: float
+    """
+    (minLat, minLng, maxLat, maxLng) = extent
+    latBuffer = extentBuffer / gps.FT_PER_DEGREE
+    lngBuffer = extentBuffer / abs(graphLib.gps.oneDegreeLngFt)
+    bounds = {"minX": repr(float(minLng - lngBuffer)), "maxX": repr(float(maxLng + lngBuffer)),
+              "minY": repr(float(minLat - latBuffer)), "maxY": repr(float(maxLat + latBuffer))}
+    
+    # A link overlaps the box unless both of its ends are off to the same side of it:
+    query = ("SELECT l.id, l.source, l.destination, l.length, a.x, a.y, b.x, b.y "
+             "FROM linkdetails l, nodes a, nodes b "
+             "WHERE l.type = 1 AND a.id = l.source AND a.type = 1 AND b.id = l.destination AND b.type = 1 "
+             "AND (a.x >= %(minX)s OR b.x >= %(minX)s) AND (a.x <= %(maxX)s OR b.x <= %(maxX)s) "
+             "AND (a.y >= %(minY)s OR b.y >= %(minY)s) AND (a.y <= %(maxY)s OR b.y <= %(maxY)s)") % bounds
+    nodeMap = graphLib.nodeMap
+    for row in _streamRows(database, query):
+        if row[1] not in nodeMap:
+            graphLib.addNode(graph.GraphNode(row[1], row[5], row[4]))
+        if row[2] not in nodeMap:
+            graphLib.addNode(graph.GraphNode(row[2], row[7], row[6]))
+        link = graph.GraphLink(row[0], nodeMap[row[1]], nodeMap[row[2]])
+        link.distance = row[3]
+        graphLib.addLink(link)
+
+def shapesExtent(shapeLists):
+    """
+    shapesExtent finds the area covered by the given lists of shape entries, for limiting the network that is read
+    in to what is around them.  Only the latitudes and longitudes of the entries are looked at.
+    @type shapeLists: list<list<gtfs.ShapesEntry>>
+    @return The (minLat, minLng, maxLat, maxLng) bounds, or None if there aren't any entries
+    @rtype tuple<float, float, float, float>
+    """
+    ret = None
+    for shapeEntries in shapeLists:
+        for shapeEntry in shapeEntries:
+            if ret is None:
+                ret = [shapeEntry.lat, shapeEntry.lng, shapeEntry.lat, shapeEntry.lng]
+            else:
+                ret[0] = min(ret[0], shapeEntry.lat)
+                ret[1] = min(ret[1], shapeEntry.lng)
+                ret[2] = max(ret[2], shapeEntry.lat)
+                ret[3] = max(ret[3], shapeEntry.lng)
+    return tuple(ret) if ret is not None else None
+
+def tableChecksum(database, dbServer):
+    """
+    tableChecksum sums up the rows of the node and link tables that fillGraph() reads, so that a change to any of them
+    can be noticed.  On PostgreSQL, the database works out the number of rows, the highest ID and a sum of the MD5
+    hashes of the rows for each table, so that only those come back.  csv: and sqlite: networks have no MD5 function
+    to do that with, so their rows are streamed through here in ID order and hashed.
+    @type database: psycopg2.connection
+    @param dbServer: The dbServer that the database had been connected with, as for connect()
+    @type dbServer: str
+    @rtype str
+    """
+    md5 = hashlib.md5()
+    if dbServer.startswith(CSV_PREFIX) or dbServer.startswith(SQLITE_PREFIX):
+        for query in ('SELECT id, x, y FROM nodes WHERE type = 1 ORDER BY id',
+                      "SELECT id, source, destination, length FROM linkdetails WHERE type = 1 ORDER BY id"):
+            for row in _streamRows(database, query):
+                md5.update(repr(tuple(row)).encode("utf-8"))
+            md5.update(b"\n")
+    else:
+        cursor = database.cursor()
+        for (tableName, columns) in (("nodes", "id, x, y"), ("linkdetails", "id, source, destination, length")):
+            # The first 64 bits of each row's MD5 are added up, which doesn't depend upon the order of the rows:
+            cursor.execute("SELECT COUNT(*), MAX(id), "
+                           "SUM(('x' || SUBSTR(MD5(CONCAT_WS(',', %s)), 1, 16))::BIT(64)::BIGINT) "
+                           "FROM %s WHERE type = 1" % (columns, tableName))
+            md5.update(",".join([str(value) for value in cursor.fetchone()]).encode("utf-8"))
+            md5.update(b"\n")
+        cursor.close()
+    return md5.hexdigest()
+
+def loadGraph(dbServer, networkName, userName, password, useDirectDist=True, graphCache=None, extent=None,
+              extentBuffer=0.0, tileSize=None, maxTiles=graph_snapshot.DEFAULT_MAX_TILES, centerCallback=None,
+              needChecksum=False):
+    """
+    loadGraph connects to the VISTA database and fills up the Graph structure.  If graphCache names a directory, the
+    graph is instead restored from a snapshot kept there, as long as the tables haven't changed since it was
+    written; otherwise the snapshot is written anew.  If extent is given, only the part of the network around it is
+    read; see fillGraph().  If tileSize is also given along with graphCache, the snapshot is kept in tiles of that
+    many feet on a side, and a graph_snapshot.TiledGraphLib is returned that keeps up to maxTiles of them in memory.
+    centerCallback is called with the gps.GPS of the graph as soon as that is known, so that a caller that runs this
+    in another thread can get going on work that only needs the coordinates.  The tableChecksum() of the tables is
+    left in GraphLib.sourceChecksum if graphCache is given or needChecksum is set.  The connection is closed before
+    returning.
+    @type dbServer: str
+    @type networkName: str
+    @type userName: str
+    @type password: str
+    @type useDirectDist: bool
+    @type graphCache: str
+    @type extent: tuple<float, float, float, float>
+    @type extentBuffer: float
+    @type tileSize: float
+    @type maxTiles: int
+    @type centerCallback: function
+    @type needChecksum: bool
+    @rtype graph.GraphLib
+    """
+    # Get the database connected:
+    print("INFO: Connect to database...", file = sys.stderr)
+    database = connect(dbServer, userName, password, networkName)
+    try:
+        return _loadGraph(database, dbServer, networkName, userName, useDirectDist, graphCache, extent, extentBuffer,
+                          tileSize, maxTiles, centerCallback, needChecksum)
+    finally:
+        database.close()
+
+def _loadGraph(database, dbServer, networkName, userName, useDirectDist, graphCache, extent, extentBuffer, tileSize,
+               maxTiles, centerCallback, needChecksum):
+    """
+    _loadGraph does the work of loadGraph() upon the connected database.
+    @type database: psycopg2.connection
+    @rtype graph.GraphLib
+    """
+    snapshotFilename = None
+    checksum = None
+    if tileSize is not None and graphCache is None:
+        print("WARNING: The network can only be tiled with a graph cache; reading all of it.", file = sys.stderr)
+        tileSize = None
+    if graphCache is not None:
+        snapshotFilename = graph_snapshot.snapshotFilename(graphCache, dbServer, userName, networkName, useDirectDist,
+            None if extent is None else tuple(extent) + (extentBuffer,))
+        
+        # The center is known before the tables are checksummed, so that centerCallback isn't held up by that:
+        if centerCallback is not None:
+            centerCallback(_emptyGraph(database, useDirectDist).gps)
+            centerCallback = None
+        checksum = tableChecksum(database, dbServer)
+        if tileSize is not None:
+            snapshotFilename = graph_snapshot.tiledFilename(snapshotFilename, tileSize)
+            graphLib = graph_snapshot.openTiledSnapshot(snapshotFilename, checksum, maxTiles)
+        else:
+            graphLib = graph_snapshot.loadSnapshot(snapshotFilename, checksum)
+        if graphLib is not None:
+            print("INFO: Read topology from graph cache '%s'..." % snapshotFilename, file = sys.stderr)
+            graphLib.sourceChecksum = checksum
+            return graphLib
+    
+    # Read in the topology from the VISTA database:
+    if extent is None:
+        print("INFO: Read topology from database...", file = sys.stderr)
+    else:
+        print("INFO: Read topology within %g ft of (%g, %g)-(%g, %g) from database..." % ((extentBuffer,) + tuple(extent)),
+              file = sys.stderr)
+    graphLib = fillGraph(database, useDirectDist, extent, extentBuffer, centerCallback)
+    if needChecksum and checksum is None:
+        checksum = tableChecksum(database, dbServer)
+    
+    if snapshotFilename is not None:
+        print("INFO: Write topology to graph cache '%s'..." % snapshotFilename, file = sys.stderr)
+        try:
+            if not os.path.isdir(graphCache):
+                os.makedirs(graphCache)
+            if tileSize is not None:
+                graph_snapshot.saveTiledSnapshot(graphLib, snapshotFilename, checksum, tileSize)
+                
+                # Page in from the new snapshot, so that this run works the same way as those that follow:
+                graphLib = graph_snapshot.openTiledSnapshot(snapshotFilename, checksum, maxTiles)
+            else:
+                graph_snapshot.saveSnapshot(graphLib, snapshotFilename, checksum)
+        except (IOError, OSError) as err:
+            print("WARNING: The graph cache couldn't be written: %s" % str(err), file = sys.stderr)
+    graphLib.sourceChecksum = checksum
     return graphLib
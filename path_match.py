@@ -24,8 +24,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
-from nmc_mm_lib import gtfs, vista_network, path_engine, compat
-import sys
+from nmc_mm_lib import gtfs, vista_network, path_engine, compat, gps, graph_snapshot
+import hashlib, sys
 
 def syntax():
     """
@@ -34,10 +34,46 @@ def syntax():
     print("path_match.py resolves a GTFS shapefile to a VISTA network series of links and")
     print("outputs a CSV format of data.")
     print("Usage:")
-    print("  python path_match.py dbServer network user password shapePath")
+    print("  python path_match.py dbServer network user password shapePath [--workers N]")
+    print("    [--prev-match pathMatchFile --prev-hashes hashFile] [--hashes-out hashFile]")
+    print("    [--corridors N] [--ambiguity FT] [--beam-margin COST] [--escalate N] [--time-limit SEC]")
+    print("    [--lattice-out latticeFile] [--graph-cache DIR [--tiles FT] [--tile-cache N]] [--clip-network]")
+    print()
+    print("where:")
+    print("  --workers matches shapes in N parallel processes (default: 1). The output is the same as")
+    print("     with 1, except with --corridors: shapes can't share corridors across processes, so each")
+    print("     shape is then matched without the corridors of the others")
+    print("  --prev-match and --prev-hashes reuse the paths of a previous run for shapes")
+    print("     whose points haven't changed since then, if the network and settings are the same")
+    print("  --hashes-out writes the shape hashes for this run to use with --prev-hashes")
+    print("  --corridors reuses confidently matched runs of at least N points that are shared")
+    print("     with an earlier shape (off by default); see --workers")
+    print("  --ambiguity keeps only the candidate links within FT feet of the closest one for")
+    print("     each point, between 2 and the usual limit (off by default)")
+    print("  --beam-margin keeps only the proposed paths that cost no more than COST over the")
+    print("     cheapest after each point, between 2 and the usual limit (off by default)")
+    print("  --escalate searches each point with radii and hops cut in half N times over, and")
+    print("     widens the search a step at a time only if no path is found (default: 0)")
+    print("  --time-limit narrows the search on any shape that takes more than half of SEC")
+    print("     seconds, down to the narrowest search at SEC; such shapes are reported, and are")
+    print("     left out of --hashes-out so that they are matched again by the next run")
+    print("  --lattice-out writes the candidate links found around each matched shape point, out to")
+    print("     the search radius of path_refine, for path_refine -l to reuse")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
+    print("  --tiles keeps the graph cache in square tiles FT feet on a side and reads them in only")
+    print("     as they are needed, for networks that are too large to hold in memory")
+    print("  --tile-cache keeps up to N tiles in memory (default: %d)" % graph_snapshot.DEFAULT_MAX_TILES)
+    print("  --clip-network reads only the part of the network within reach of the shapes,")
+    print("     which saves time and memory on large networks; it can't be used with --lattice-out,")
+    print("     as path_refine reads in the whole network")
     sys.exit(0)
 
-def pathMatch(dbServer, networkName, userName, password, shapePath, limitMap = None):
+def pathMatch(dbServer, networkName, userName, password, shapePath, limitMap = None, workers = 1, dedupe = True,
+              prevMatchFilename = None, prevHashesFilename = None, hashesOutFilename = None, corridorPoints = 0,
+              candidateAmbiguity = None, beamMargin = None, escalationSteps = 0, shapeTimeLimit = None,
+              latticeOutFilename = None, graphCache = None, clipNetwork = False, tileSize = None,
+              maxTiles = graph_snapshot.DEFAULT_MAX_TILES, vistaGraph = None, gtfsShapes = None):
     # Default parameters, with explanations and cross-references to Perrine et al., 2015:
     pointSearchRadius = 1000    # "k": Radius (ft) to search from GTFS point to perpendicular VISTA links
     pointSearchPrimary = 350    # "k_p": Radius (ft) to search from GTFS point to new VISTA links    
@@ -52,24 +88,44 @@ def pathMatch(dbServer, networkName, userName, password, shapePath, limitMap = N
     limitSimultaneousPaths = 8  # "q_e": Number of proposed paths to maintain during pathfinding stage
     
     maxHops = 12                # Maximum number of VISTA links to pursue in a path-finding operation
+    latticeRadius = 1600        # Radius (ft) of the candidate lattice; the same as "k" in path_refine
     
-    # Get the database connected:
-    print("INFO: Connect to database...", file = sys.stderr)
-    database = vista_network.connect(dbServer, userName, password, networkName)
-    
-    # Read in the topology from the VISTA database:
-    print("INFO: Read topology from database...", file = sys.stderr)
-    vistaGraph = vista_network.fillGraph(database)
+    # The topology and the shapes are read in here unless they had been given, as by pipeline.py:
+    clipArea = None
+    if vistaGraph is None:
+        # Work out the area that the shapes cover, so that only the part of the network that can be reached from
+        # them needs to be read.  Only the latitudes and longitudes matter here, so any GPS center will do:
+        extent = None
+        extentBuffer = pointSearchRadius + limitLinearDist
+        if clipNetwork:
+            extent = vista_network.shapesExtent(compat.listvalues(gtfs.fillShapes(shapePath, gps.GPS(0.0, 0.0))))
+            clipArea = tuple(extent) + (extentBuffer,)
+        
+        # Read in the topology from the VISTA database, or from the graph cache:
+        vistaGraph = vista_network.loadGraph(dbServer, networkName, userName, password, graphCache = graphCache,
+                                             extent = extent, extentBuffer = extentBuffer, tileSize = tileSize,
+                                             maxTiles = maxTiles, needChecksum = (prevMatchFilename is not None) or
+                                             (hashesOutFilename is not None))
     
-    # Read in the shapefile information:
-    print("INFO: Read GTFS shapefile...", file = sys.stderr)
-    gtfsShapes = gtfs.fillShapes(shapePath, vistaGraph.gps)
+    if gtfsShapes is None:
+        # Read in the shapefile information:
+        print("INFO: Read GTFS shapefile...", file = sys.stderr)
+        gtfsShapes = gtfs.fillShapes(shapePath, vistaGraph.gps)
     
     # Initialize the path-finder:
     pathFinder = path_engine.PathEngine(pointSearchRadius, pointSearchPrimary, pointSearchSecondary, limitLinearDist,
                             limitDirectDist, limitDirectDistRev, distanceFactor, driftFactor, nonPerpPenalty, limitClosestPoints,
                             limitSimultaneousPaths)
     pathFinder.maxHops = maxHops
+    if corridorPoints > 0:
+        pathFinder.corridorCache = path_engine.CorridorCache(corridorPoints)
+    pathFinder.candidateAmbiguity = candidateAmbiguity
+    pathFinder.beamMargin = beamMargin
+    pathFinder.escalationSteps = escalationSteps
+    pathFinder.shapeTimeLimit = shapeTimeLimit
+    if latticeOutFilename is not None:
+        pathFinder.candidateLattice = {}
+        pathFinder.latticeRadius = max(latticeRadius, pointSearchRadius)
     
     # Begin iteration through each shape:
     shapeIDs = compat.listkeys(gtfsShapes)
@@ -82,20 +138,117 @@ def pathMatch(dbServer, networkName, userName, password, shapePath, limitMap = N
         for shapeID in limitMap:
             if shapeID not in shapeIDs:
                 print("WARNING: Limit shape ID %d is not found in the shape file." % shapeID, file = sys.stderr)
+        shapeIDs = [shapeID for shapeID in shapeIDs if shapeID in limitMap]
     
+    shapeHashes = {}
+    "@type shapeHashes: dict<int, str>"
     for shapeID in shapeIDs:
-        "@type shapeID: int"
-        
-        if limitMap is not None and shapeID not in limitMap:
-            continue
-        
-        print("INFO: -- Shape ID %d --" % shapeID, file = sys.stderr)
-        
-        # Find the path for the given shape:
-        gtfsNodes = pathFinder.constructPath(gtfsShapes[shapeID], vistaGraph)
+        shapeHashes[shapeID] = gtfs.shapeHash(gtfsShapes[shapeID])
+    
+    # Paths from a previous run can only be reused if they had been matched on the same network with the same
+    # settings, so the shape hashes are written and checked along with a key for these.  The number of workers is
+    # part of this because shapes don't share corridors across processes.  The time limit isn't; shapes that reached
+    # it are left out of the hash file instead, so that they are matched again:
+    runKey = ""
+    if (prevMatchFilename is not None) or (hashesOutFilename is not None):
+        settings = (pointSearchRadius, pointSearchPrimary, pointSearchSecondary, limitLinearDist, limitDirectDist,
+            limitDirectDistRev, distanceFactor, driftFactor, nonPerpPenalty, limitClosestPoints, limitSimultaneousPaths,
+            maxHops, corridorPoints, candidateAmbiguity, beamMargin, escalationSteps, workers, clipArea)
+        checksum = vistaGraph.sourceChecksum
+        if checksum is None:
+            # The network had been handed over without its checksum:
+            database = vista_network.connect(dbServer, userName, password, networkName)
+            try:
+                checksum = vista_network.tableChecksum(database, dbServer)
+            finally:
+                database.close()
+        runKey = hashlib.md5(repr((checksum,) + settings).encode("utf-8")).hexdigest()
+    
+    # Reuse paths from a previous run for the shapes whose points haven't changed since:
+    matchShapeIDs = shapeIDs
+    if prevMatchFilename is not None:
+        print("INFO: Read the previous shape hash file '%s'..." % prevHashesFilename, file = sys.stderr)
+        with open(prevHashesFilename, 'r') as inFile:
+            prevHashes = gtfs.readShapeHashes(inFile, runKey = runKey)
+            "@type prevHashes: dict<int, str>"
+        if prevHashes:
+            unchangedShapeIDs = set([shapeID for shapeID in shapeIDs if prevHashes.get(shapeID) == shapeHashes[shapeID]])
+            print("INFO: Read the previous path-match file '%s'..." % prevMatchFilename, file = sys.stderr)
+            with open(prevMatchFilename, 'r') as inFile:
+                prevNodes = path_engine.readStandardDump(vistaGraph, gtfsShapes, inFile,
+                                                         restrictShapeIDs = unchangedShapeIDs)
+                "@type prevNodes: dict<int, list<path_engine.PathEnd>>"
+            if prevNodes is not None:
+                gtfsNodesResults.update(prevNodes)
+                matchShapeIDs = [shapeID for shapeID in shapeIDs if shapeID not in prevNodes]
+                print("INFO: Reusing previous paths for %d of %d shapes." % (len(prevNodes), len(shapeIDs)),
+                      file = sys.stderr)
+                
+                # The candidate lattice covers every shape, so fill it in for those that won't be matched:
+                if pathFinder.candidateLattice is not None:
+                    for shapeID in prevNodes:
+                        pathFinder.fillLattice(gtfsShapes[shapeID], vistaGraph)
     
+    # Shapes that have exactly the same points would be matched to exactly the same path, so only match the first
+    # of each:
+    duplicateShapeIDs = {}
+    "@type duplicateShapeIDs: dict<int, int>"
+    if dedupe:
+        dedupeShapeIDs = matchShapeIDs
+        matchShapeIDs = []
+        representativeIDs = {}
+        "@type representativeIDs: dict<str, int>"
+        for shapeID in dedupeShapeIDs:
+            shapeKey = shapeHashes[shapeID]
+            if shapeKey in representativeIDs:
+                duplicateShapeIDs[shapeID] = representativeIDs[shapeKey]
+            else:
+                representativeIDs[shapeKey] = shapeID
+                matchShapeIDs.append(shapeID)
+    
+    # Find the path for each shape, possibly across worker processes:
+    for (shapeID, gtfsNodes) in path_engine.constructPaths(pathFinder, gtfsShapes, matchShapeIDs, vistaGraph, workers):
         # File this away as a result for later output:
         gtfsNodesResults[shapeID] = gtfsNodes
+        
+    # Fill in the duplicates from the paths that were found:
+    for shapeID in shapeIDs:
+        if shapeID in duplicateShapeIDs:
+            representativeID = duplicateShapeIDs[shapeID]
+            print("INFO: Shape ID %d has the same points as Shape ID %d; reusing its path." % (shapeID, representativeID),
+                  file = sys.stderr)
+            gtfsNodesResults[shapeID] = path_engine.clonePath(gtfsNodesResults[representativeID],
+                gtfsShapes[representativeID], gtfsShapes[shapeID])
+            if pathFinder.candidateLattice is not None:
+                for (srcEntry, destEntry) in zip(gtfsShapes[representativeID], gtfsShapes[shapeID]):
+                    if (representativeID, srcEntry.shapeSeq) in pathFinder.candidateLattice:
+                        pathFinder.candidateLattice[(shapeID, destEntry.shapeSeq)] = \
+                            pathFinder.candidateLattice[(representativeID, srcEntry.shapeSeq)]
+    if len(pathFinder.overBudgetShapes) > 0:
+        print("WARNING: %d shape(s) reached the time limit: %s" % (len(pathFinder.overBudgetShapes),
+            ", ".join([str(shapeID) for shapeID in pathFinder.overBudgetShapes])), file = sys.stderr)
+    if dedupe:
+        print("INFO: Deduplication saved %d of %d shape matches." % (len(duplicateShapeIDs), len(dedupeShapeIDs)),
+              file = sys.stderr)
+        
+    # Record the shape hashes that go with this run:
+    if hashesOutFilename is not None:
+        overBudgetShapeIDs = set(pathFinder.overBudgetShapes)
+        overBudgetShapeIDs.update([shapeID for shapeID in duplicateShapeIDs
+                                   if duplicateShapeIDs[shapeID] in overBudgetShapeIDs])
+        if overBudgetShapeIDs:
+            print("INFO: Leaving %d shape(s) that reached the time limit, or share the points of one that did, out "
+                  "of the shape hash file." % len(overBudgetShapeIDs), file = sys.stderr)
+        print("INFO: Write the shape hash file '%s'..." % hashesOutFilename, file = sys.stderr)
+        with open(hashesOutFilename, 'w') as outFile:
+            gtfs.dumpShapeHashes(dict([(shapeID, shapeHashes[shapeID]) for shapeID in gtfsNodesResults
+                                       if shapeID not in overBudgetShapeIDs]), outFile, runKey)
+    
+    # Record the candidate links that were found, for path_refine to reuse:
+    if latticeOutFilename is not None:
+        print("INFO: Write the candidate lattice file '%s'..." % latticeOutFilename, file = sys.stderr)
+        with open(latticeOutFilename, 'w') as outFile:
+            path_engine.dumpCandidateLattice(pathFinder.candidateLattice, pathFinder.latticeRadius, outFile)
     return gtfsNodesResults
 
 def main(argv):
@@ -107,8 +260,77 @@ def main(argv):
     userName = argv[3]
     password = argv[4]
     shapePath = argv[5]
+    workers = 1
+    prevMatchFilename = None
+    prevHashesFilename = None
+    hashesOutFilename = None
+    corridorPoints = 0
+    candidateAmbiguity = None
+    beamMargin = None
+    escalationSteps = 0
+    shapeTimeLimit = None
+    latticeOutFilename = None
+    graphCache = None
+    clipNetwork = False
+    tileSize = None
+    maxTiles = graph_snapshot.DEFAULT_MAX_TILES
+    i = 6
+    while i < len(argv):
+        if argv[i] == "--workers" and i < len(argv) - 1:
+            workers = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--prev-match" and i < len(argv) - 1:
+            prevMatchFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--prev-hashes" and i < len(argv) - 1:
+            prevHashesFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--hashes-out" and i < len(argv) - 1:
+            hashesOutFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--corridors" and i < len(argv) - 1:
+            corridorPoints = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--ambiguity" and i < len(argv) - 1:
+            candidateAmbiguity = float(argv[i + 1])
+            i += 1
+        elif argv[i] == "--beam-margin" and i < len(argv) - 1:
+            beamMargin = float(argv[i + 1])
+            i += 1
+        elif argv[i] == "--escalate" and i < len(argv) - 1:
+            escalationSteps = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--time-limit" and i < len(argv) - 1:
+            shapeTimeLimit = float(argv[i + 1])
+            i += 1
+        elif argv[i] == "--lattice-out" and i < len(argv) - 1:
+            latticeOutFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+            graphCache = argv[i + 1]
+            i += 1
+        elif argv[i] == "--tiles" and i < len(argv) - 1:
+            tileSize = float(argv[i + 1])
+            i += 1
+        elif argv[i] == "--tile-cache" and i < len(argv) - 1:
+            maxTiles = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--clip-network":
+            clipNetwork = True
+        i += 1
+    if (prevMatchFilename is None) != (prevHashesFilename is None):
+        print("ERROR: --prev-match and --prev-hashes must be used together.", file = sys.stderr)
+        syntax()
+    if clipNetwork and (latticeOutFilename is not None):
+        print("ERROR: --clip-network and --lattice-out cannot be used together.", file = sys.stderr)
+        syntax()
     
-    gtfsNodesResults = pathMatch(dbServer, networkName, userName, password, shapePath)
+    gtfsNodesResults = pathMatch(dbServer, networkName, userName, password, shapePath, workers = workers,
+        prevMatchFilename = prevMatchFilename, prevHashesFilename = prevHashesFilename,
+        hashesOutFilename = hashesOutFilename, corridorPoints = corridorPoints, candidateAmbiguity = candidateAmbiguity,
+        beamMargin = beamMargin, escalationSteps = escalationSteps, shapeTimeLimit = shapeTimeLimit,
+        latticeOutFilename = latticeOutFilename, graphCache = graphCache, clipNetwork = clipNetwork,
+        tileSize = tileSize, maxTiles = maxTiles)
     
     # Extract useful information:
     print("INFO: -- Final --", file = sys.stderr)
@@ -24,8 +24,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
-from nmc_mm_lib import gtfs, path_engine, compat
-import sys, operator, transit_gtfs
+from nmc_mm_lib import gtfs, path_engine, parallel, compat
+import sys, operator
 
 def syntax():
     """
@@ -35,6 +35,16 @@ def syntax():
     print("restarts. Outputs another path match CSV")
     print("Usage:")
     print("  python path_refine.py dbServer network user password shapePath pathMatchFile [-h hintFile] [-r filterRouteFile]")
+    print("    [-t timeLimit] [-l latticeFile] [--workers N] [--graph-cache DIR]")
+    print()
+    print("where:")
+    print("  -t narrows the search on any shape that takes more than half of timeLimit seconds,")
+    print("     down to the narrowest search at timeLimit; such shapes are reported")
+    print("  -l filters the candidate links for each shape point from a file written by path_match")
+    print("     --lattice-out rather than searching the network again")
+    print("  --workers refines shapes in N parallel processes (default: 1)")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
     sys.exit(0)
 
 def filterRoutes(gtfsNodes, shapePath, gtfsShapes, routeRestrictFilename, inclusiveFlag = False):
@@ -168,7 +178,53 @@ def fillHints(filename, shapePath, gtfsShapes, GPS, unusedShapeIDs):
     # Return the hints file contents:
     return ret
 
-def pathsRefine(gtfsNodes, hintEntries, vistaGraph):
+def _shapeHints(hintEntries, shapeID):
+    """
+    _shapeHints returns the hints for the given shape, or an empty list if there aren't any.
+    @type hintEntries: dict<int, list<gtfs.ShapesEntry>>
+    @type shapeID: int
+    @rtype list<gtfs.ShapesEntry>
+    """
+    return hintEntries[shapeID] if shapeID in hintEntries else list()
+
+def _refineEntries(oldGTFSPath, shapeHints):
+    """
+    _refineEntries lists the shape entries that a refined path can refer to, for use with path_engine.compactPath()
+    and path_engine.expandPath().
+    @type oldGTFSPath: list<path_engine.PathEnd>
+    @type shapeHints: list<gtfs.ShapesEntry>
+    @rtype list<gtfs.ShapesEntry>
+    """
+    return [treeNode.shapeEntry for treeNode in oldGTFSPath] + shapeHints
+
+def _refineWork(shapeID, pathFinder, gtfsNodes, hintEntries, vistaGraph):
+    """
+    _refineWork refines the path for one shape within a worker process.  It returns the path in compact form along
+    with the shape IDs that had reached the time limit.
+    """
+    print("INFO: -- Shape ID %s --" % str(shapeID), file = sys.stderr)
+    overBudgetCount = len(pathFinder.overBudgetShapes)
+    shapeHints = _shapeHints(hintEntries, shapeID)
+    gtfsNodesRevised = pathFinder.refinePath(gtfsNodes[shapeID], vistaGraph, shapeHints)
+    return (path_engine.compactPath(gtfsNodesRevised, _refineEntries(gtfsNodes[shapeID], shapeHints)),
+            pathFinder.overBudgetShapes[overBudgetCount:])
+
+def pathsRefine(gtfsNodes, hintEntries, vistaGraph, shapeTimeLimit = None, workers = 1, candidateLattice = None,
+                latticeRadius = 0.0):
+    """
+    pathsRefine refines each of the given paths and returns the results by shape ID.  If workers is more than 1,
+    the shapes that need work are refined in that many forked processes; the result is the same as a serial run.
+    If candidateLattice is given, as read with path_engine.readCandidateLattice(), the candidate links for shape
+    points are filtered from it rather than searched for.
+    @type gtfsNodes: dict<int, list<path_engine.PathEnd>>
+    @type hintEntries: dict<int, list<gtfs.ShapesEntry>>
+    @type vistaGraph: graph.GraphLib
+    @type shapeTimeLimit: float
+    @type workers: int
+    @type candidateLattice: dict<(int, int), list<(int, float, bool, float)>>
+    @type latticeRadius: float
+    @rtype dict<int, list<path_engine.PathEnd>>
+    """
     # Default parameters, with explanations and cross-references to Perrine et al., 2015:
     hintRefactorRadius = 1000   # Radius (ft) to invalidate surrounding found points.
     termRefactorRadius = 3000   # Radius (ft) to invalidate found points at either end of a restart.
@@ -194,6 +250,14 @@ def pathsRefine(gtfsNodes, hintEntries, vistaGraph):
     pathFinder.setRefineParams(hintRefactorRadius, termRefactorRadius)
     pathFinder.maxHops = maxHops
     pathFinder.limitHintClosest = limitHintClosest
+    pathFinder.shapeTimeLimit = shapeTimeLimit
+    if candidateLattice is not None:
+        if latticeRadius < pointSearchRadius:
+            print("WARNING: The candidate lattice radius of %g ft is less than the search radius of %g ft, so it " \
+                  "won't be used." % (latticeRadius, pointSearchRadius), file = sys.stderr)
+        else:
+            pathFinder.candidateLattice = candidateLattice
+            pathFinder.latticeRadius = latticeRadius
     
     # Begin iteration through each shape:
     shapeIDs = compat.listkeys(gtfsNodes)
@@ -202,17 +266,42 @@ def pathsRefine(gtfsNodes, hintEntries, vistaGraph):
     gtfsNodesResults = {}
     "@type gtfsNodesResults: dict<int, list<path_engine.PathEnd>>"
     
+    passCount = 0
+    refineShapeIDs = []
+    "@type refineShapeIDs: list<int>"
     for shapeID in shapeIDs:
         "@type shapeID: int"
         
-        print("INFO: -- Shape ID %s --" % str(shapeID), file = sys.stderr)
-        
-        # Find the path for the given shape:
-        gtfsNodesRevised = pathFinder.refinePath(gtfsNodes[shapeID], vistaGraph, 
-            hintEntries[shapeID] if shapeID in hintEntries else list()) 
+        # Shapes without restarts or hints don't need any work:
+        if not pathFinder.needsRefine(gtfsNodes[shapeID], _shapeHints(hintEntries, shapeID)):
+            gtfsNodesResults[shapeID] = gtfsNodes[shapeID]
+            passCount += 1
+        else:
+            refineShapeIDs.append(shapeID)
     
-        # File this away as a result for later output:
-        gtfsNodesResults[shapeID] = gtfsNodesRevised
+    if workers <= 1:
+        for shapeID in refineShapeIDs:
+            print("INFO: -- Shape ID %s --" % str(shapeID), file = sys.stderr)
+            
+            # Find the path for the given shape:
+            gtfsNodesRevised = pathFinder.refinePath(gtfsNodes[shapeID], vistaGraph, _shapeHints(hintEntries, shapeID))
+        
+            # File this away as a result for later output:
+            gtfsNodesResults[shapeID] = gtfsNodesRevised
+    else:
+        # Refine the shapes in worker processes that share the already-loaded paths, hints and vistaGraph:
+        results = parallel.forkMap(_refineWork, refineShapeIDs, workers, pathFinder, gtfsNodes, hintEntries, vistaGraph)
+        for index, (compactNodes, overBudgetShapes) in enumerate(results):
+            shapeID = refineShapeIDs[index]
+            gtfsNodesResults[shapeID] = path_engine.expandPath(compactNodes,
+                _refineEntries(gtfsNodes[shapeID], _shapeHints(hintEntries, shapeID)), vistaGraph)
+            pathFinder.overBudgetShapes.extend(overBudgetShapes)
+    print("INFO: Passed through %d of %d shapes that had no restarts or hints." % (passCount, len(shapeIDs)),
+          file = sys.stderr)
+        
+    if len(pathFinder.overBudgetShapes) > 0:
+        print("WARNING: %d shape(s) reached the time limit: %s" % (len(pathFinder.overBudgetShapes),
+            ", ".join([str(shapeID) for shapeID in pathFinder.overBudgetShapes])), file = sys.stderr)
     return gtfsNodesResults
 
 def main(argv):
@@ -227,6 +316,10 @@ def main(argv):
     pathMatchFilename = argv[6]
     hintFilename = None
     routeRestrictFilename = None
+    shapeTimeLimit = None
+    workers = 1
+    latticeFilename = None
+    graphCache = None
     if len(argv) > 6:
         i = 7
         while i < len(argv):
@@ -236,11 +329,25 @@ def main(argv):
             elif argv[i] == "-r" and i < len(argv) - 1:
                 routeRestrictFilename = argv[i + 1]
                 i += 1
+            elif argv[i] == "-t" and i < len(argv) - 1:
+                shapeTimeLimit = float(argv[i + 1])
+                i += 1
+            elif argv[i] == "-l" and i < len(argv) - 1:
+                latticeFilename = argv[i + 1]
+                i += 1
+            elif argv[i] == "--workers" and i < len(argv) - 1:
+                workers = int(argv[i + 1])
+                i += 1
+            elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+                graphCache = argv[i + 1]
+                i += 1
             i += 1
     
-    # Restore the stuff that was built with path_match:
-    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs) = transit_gtfs.restorePathMatch(dbServer, networkName,
-        userName, password, shapePath, pathMatchFilename)
+    # Restore the stuff that was built with path_match.  (transit_gtfs is imported here rather than at the top so that
+    # filter_gtfs_shapes doesn't need to load it for filterRoutes().)
+    import transit_gtfs
+    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, _, _) = transit_gtfs.restorePathMatch(dbServer, networkName,
+        userName, password, shapePath, pathMatchFilename, graphCache = graphCache)
     # TODO: We don't do anything with unusedShapeIDs right now.
     
     # Restore the hint file if it is specified:
@@ -255,8 +362,19 @@ def main(argv):
     if routeRestrictFilename is not None:
         gtfsNodes = filterRoutes(gtfsNodes, shapePath, gtfsShapes, routeRestrictFilename)
 
+    # Restore the candidate lattice if it is specified:
+    candidateLattice = None
+    latticeRadius = 0.0
+    if latticeFilename is not None:
+        print("INFO: Read candidate lattice file '%s'..." % latticeFilename, file = sys.stderr)
+        with open(latticeFilename, 'r') as inFile:
+            lattice = path_engine.readCandidateLattice(vistaGraph, inFile)
+        if lattice is not None:
+            (latticeRadius, candidateLattice) = lattice
+
     print("INFO: Refining paths.", file = sys.stderr)
-    gtfsNodesResults = pathsRefine(gtfsNodes, hintEntries, vistaGraph)
+    gtfsNodesResults = pathsRefine(gtfsNodes, hintEntries, vistaGraph, shapeTimeLimit, workers, candidateLattice,
+                                   latticeRadius)
     "@type gtfsNodesResults: dict<int, list<path_engine.PathEnd>>"
     
     print("INFO: -- Final --", file = sys.stderr)
@@ -0,0 +1,213 @@
+"""
+pipeline.py runs path_match, path_refine and transit_gtfs, and optionally
+    problem_report, one after another in one process.  The network and the GTFS
+    shapes are read in once, and the paths are handed from one stage to the next
+    in memory; path-match files are only written if asked for.
+@author: Kenneth Perrine
+@contact: kperrine@utexas.edu
+@organization: Network Modeling Center, Center for Transportation Research,
+    Cockrell School of Engineering, The University of Texas at Austin
+@version: 1.0
+
+@copyright: (C) 2014, The University of Texas at Austin
+@license: GPL v3
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from __future__ import print_function
+from datetime import datetime
+from nmc_mm_lib import gtfs, vista_network, path_engine, compat
+import path_match, path_refine, sys
+
+def syntax():
+    """
+    Print usage information
+    """
+    print("pipeline.py runs path_match, path_refine and transit_gtfs, and optionally problem_report, in one process,")
+    print("reading the network and the GTFS shapes only once.")
+    print("Usage:")
+    print("  python pipeline.py dbServer network user password shapePath [-h hintFile] [-r filterRouteFile]")
+    print("    [--match-out pathMatchFile] [--refine-out pathMatchFile] [--problem-out reportFile]")
+    print("    [-t refDateTime [-e endTime] {[-c serviceID] ...} [-u] [-w] [-p]] [--workers N] [--graph-cache DIR]")
+    print()
+    print("where:")
+    print("  -h and -r are as for path_refine")
+    print("  --match-out writes the path-match file from path_match to pathMatchFile")
+    print("  --refine-out writes the path-match file from path_refine to pathMatchFile")
+    print("  --problem-out writes the problem_report output for the refined paths to reportFile")
+    print("  -t runs transit_gtfs on the refined paths, writing its files in the current path;")
+    print("     -t, -e, -c, -u, -w, -wb, -we, -x, -xb, -xe and -p are as for transit_gtfs")
+    print("  --workers runs path_match and path_refine in N parallel processes (default: 1)")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
+    sys.exit(0)
+
+def _handOff(gtfsNodes, gtfsShapes, outFilename):
+    """
+    _handOff passes the paths from one stage on to the next, leaving out the shapes that have no path as
+    transit_gtfs.restorePathMatch() does.  The paths are also written to the path-match file outFilename if given.
+    @type gtfsNodes: dict<int, list<path_engine.PathEnd>>
+    @type gtfsShapes: dict<int, list<gtfs.ShapesEntry>>
+    @type outFilename: str
+    @return The paths, the shapes that have paths, and the IDs of the shapes that don't
+    @rtype (dict<int, list<path_engine.PathEnd>>, dict<int, list<gtfs.ShapesEntry>>, set<int>)
+    """
+    if outFilename is not None:
+        print("INFO: Write the path-match file '%s'..." % outFilename, file = sys.stderr)
+        shapeIDs = compat.listkeys(gtfsNodes)
+        "@type shapeIDs: list<int>"
+        shapeIDs.sort()
+        with open(outFilename, 'w') as outFile:
+            path_engine.dumpStandardHeader(outFile)
+            for shapeID in shapeIDs:
+                path_engine.dumpStandardInfo(gtfsNodes[shapeID], outFile)
+
+    ret = dict([(shapeID, treeNodes) for (shapeID, treeNodes) in compat.iteritems(gtfsNodes) if len(treeNodes) > 0])
+    "@type ret: dict<int, list<path_engine.PathEnd>>"
+    usedShapes = dict([(shapeID, shapeEntries) for (shapeID, shapeEntries) in compat.iteritems(gtfsShapes)
+                       if shapeID in ret])
+    unusedShapeIDs = set([shapeID for shapeID in gtfsShapes if shapeID not in ret])
+    return (ret, usedShapes, unusedShapeIDs)
+
+def main(argv):
+    # Initialize from command-line parameters:
+    if len(argv) < 6:
+        syntax()
+    dbServer = argv[1]
+    networkName = argv[2]
+    userName = argv[3]
+    password = argv[4]
+    shapePath = argv[5]
+    hintFilename = None
+    routeRestrictFilename = None
+    matchOutFilename = None
+    refineOutFilename = None
+    problemOutFilename = None
+    workers = 1
+    graphCache = None
+    refTime = None
+    endTimeInt = 86400
+    restrictService = set()
+    "@type restrictService: set<string>"
+    excludeUpstream = False
+    widenBegin = False
+    widenEnd = False
+    excludeBegin = False
+    excludeEnd = False
+    busProblemReport = False
+    i = 6
+    while i < len(argv):
+        if argv[i] == "-h" and i < len(argv) - 1:
+            hintFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "-r" and i < len(argv) - 1:
+            routeRestrictFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--match-out" and i < len(argv) - 1:
+            matchOutFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--refine-out" and i < len(argv) - 1:
+            refineOutFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--problem-out" and i < len(argv) - 1:
+            problemOutFilename = argv[i + 1]
+            i += 1
+        elif argv[i] == "--workers" and i < len(argv) - 1:
+            workers = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+            graphCache = argv[i + 1]
+            i += 1
+        elif argv[i] == "-t" and i < len(argv) - 1:
+            refTime = datetime.strptime(argv[i + 1], '%H:%M:%S')
+            i += 1
+        elif argv[i] == "-e" and i < len(argv) - 1:
+            endTimeInt = int(argv[i + 1])
+            i += 1
+        elif argv[i] == "-c" and i < len(argv) - 1:
+            restrictService.add(argv[i + 1])
+            i += 1
+        elif argv[i] == "-u":
+            excludeUpstream = True
+        elif argv[i] == "-w":
+            widenBegin = True
+            widenEnd = True
+        elif argv[i] == "-wb":
+            widenBegin = True
+        elif argv[i] == "-we":
+            widenEnd = True
+        elif argv[i] == "-x":
+            excludeBegin = True
+            excludeEnd = True
+        elif argv[i] == "-xb":
+            excludeBegin = True
+        elif argv[i] == "-xe":
+            excludeEnd = True
+        elif argv[i] == "-p":
+            busProblemReport = True
+        i += 1
+
+    if refTime is None and matchOutFilename is None and refineOutFilename is None and problemOutFilename is None:
+        print("ERROR: Nothing would be written. Use -t, --match-out, --refine-out or --problem-out.", file = sys.stderr)
+        syntax()
+    if (widenBegin and excludeBegin) or (widenEnd and excludeEnd):
+        print("ERROR: Widening (-w, -wb or -we) and exclusion (-x, -xb or -xe) cannot be used together.",
+              file = sys.stderr)
+        syntax()
+
+    # Read in the topology and the shapefile once for all of the stages:
+    vistaGraph = vista_network.loadGraph(dbServer, networkName, userName, password, graphCache = graphCache)
+    print("INFO: Read GTFS shapefile...", file = sys.stderr)
+    gtfsShapes = gtfs.fillShapes(shapePath, vistaGraph.gps)
+    "@type gtfsShapes: dict<int, list<gtfs.ShapesEntry>>"
+
+    # Stage 1: Match the shapes to the network:
+    print("INFO: -- Stage: path_match --", file = sys.stderr)
+    gtfsNodes = path_match.pathMatch(dbServer, networkName, userName, password, shapePath, workers = workers,
+                                     vistaGraph = vistaGraph, gtfsShapes = gtfsShapes)
+    (gtfsNodes, usedShapes, unusedShapeIDs) = _handOff(gtfsNodes, gtfsShapes, matchOutFilename)
+
+    # Stage 2: Refine the paths at hints and restarts:
+    print("INFO: -- Stage: path_refine --", file = sys.stderr)
+    if hintFilename is not None:
+        print("INFO: Read hint file...", file = sys.stderr)
+    hintEntries = path_refine.fillHints(hintFilename, shapePath, usedShapes, vistaGraph.gps, unusedShapeIDs)
+    "@type hintEntries: dict<int, path_engine.ShapesEntry>"
+    if routeRestrictFilename is not None:
+        gtfsNodes = path_refine.filterRoutes(gtfsNodes, shapePath, usedShapes, routeRestrictFilename)
+    print("INFO: Refining paths.", file = sys.stderr)
+    gtfsNodes = path_refine.pathsRefine(gtfsNodes, hintEntries, vistaGraph, workers = workers)
+    (gtfsNodes, usedShapes, unusedShapeIDs) = _handOff(gtfsNodes, gtfsShapes, refineOutFilename)
+
+    # Stage 3: Report on potential problems:
+    if problemOutFilename is not None:
+        import problem_report
+        print("INFO: -- Stage: problem_report --", file = sys.stderr)
+        print("INFO: Write problem report '%s'..." % problemOutFilename, file = sys.stderr)
+        with open(problemOutFilename, 'w') as outFile:
+            problem_report.problemReport(gtfsNodes, vistaGraph, outFile = outFile)
+
+    # Stage 4: Write out the bus routes:
+    if refTime is not None:
+        import transit_gtfs
+        print("INFO: -- Stage: transit_gtfs --", file = sys.stderr)
+        transit_gtfs.problemReport = busProblemReport
+        transit_gtfs.dumpBusFiles(vistaGraph, usedShapes, gtfsNodes, unusedShapeIDs, shapePath, userName, networkName,
+            refTime, endTimeInt, restrictService, excludeUpstream, widenBegin, widenEnd, excludeBegin, excludeEnd)
+
+    print("INFO: Done.", file = sys.stderr)
+
+# Boostrap:
+if __name__ == '__main__':
+    main(sys.argv)
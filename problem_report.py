@@ -92,11 +92,13 @@ def main(argv):
     parser.add_argument("shapePath", help="Path to GTFS files")
     parser.add_argument("pathMatchFile", help="Path match file that was previously outputted by path_match.py or others")
     parser.add_argument("-L", "--interLinks", action="store_true", help="Outputs intermediate links and positions")
+    parser.add_argument("--graph-cache", dest="graphCache", metavar="DIR", help="Keeps a snapshot of the network " +
+        "topology in this directory and reads it from there while the network tables are unchanged")
     args = parser.parse_args()
     
     # Restore the stuff that was built with path_match:
-    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs) = transit_gtfs.restorePathMatch(args.dbServer, args.networkName,
-        args.userName, args.password, args.shapePath, args.pathMatchFile)
+    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, _, _) = transit_gtfs.restorePathMatch(args.dbServer,
+        args.networkName, args.userName, args.password, args.shapePath, args.pathMatchFile, graphCache=args.graphCache)
     print("INFO: Output CSV...", file=sys.stderr)
     problemReport(gtfsNodes, vistaGraph, showLinks=args.interLinks)
     print("INFO: Done.", file = sys.stderr)
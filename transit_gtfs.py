@@ -29,7 +29,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 from __future__ import print_function
 from nmc_mm_lib import gtfs, vista_network, path_engine, graph, compat
-import problem_report, sys, time
+import sys, threading, time
 from datetime import datetime, timedelta
 
 DWELLTIME_DEFAULT = 0
@@ -48,7 +48,7 @@ def syntax(exitCode):
     print("Usage:")
     print("  python transit_gtfs.py dbServer network user password shapePath")
     print("    pathMatchFile -t refDateTime [-e endTime] {[-c serviceID]")
-    print("    [-c serviceID] ...} [-u] [-w] [-p]")
+    print("    [-c serviceID] ...} [-u] [-w] [-p] [--graph-cache DIR]")
     print()
     print("where:")
     print("  -t is the zero-reference time that all arrival time outputs are related to.")
@@ -62,20 +62,70 @@ def syntax(exitCode):
     print("  -x, -xb, -xe: exclude both, exclude begin, exclude end: excludes entire")
     print("     entire routes that intersect with -t (begin) and/or -e (end).")
     print("  -p outputs a problem report on the stop matches")
+    print("  --graph-cache keeps a snapshot of the network topology in directory DIR and reads")
+    print("     it from there while the network tables are unchanged")
     sys.exit(exitCode)
 
-def restorePathMatch(dbServer, networkName, userName, password, shapePath, pathMatchFilename, useDirectDist=True):
-    # Get the database connected:
-    print("INFO: Connect to database...", file = sys.stderr)
-    database = vista_network.connect(dbServer, userName, password, networkName)
-    
-    # Read in the topology from the VISTA database:
-    print("INFO: Read topology from database...", file = sys.stderr)
-    vistaGraph = vista_network.fillGraph(database, useDirectDist)
+def restorePathMatch(dbServer, networkName, userName, password, shapePath, pathMatchFilename, useDirectDist=True,
+                     graphCache=None, readStops=False):
+    """
+    restorePathMatch reads in the network, the GTFS shapes and the path-match file that path_match.py had written.
+    The network is read in a separate thread; the shapes only need the GPS center of the network, so they are read
+    as soon as that is known while the nodes and links are still coming in.  If readStops is set, the GTFS routes and
+    stops are read alongside as well for readBusRecords(); otherwise, None is returned in their place.
+    @type dbServer: str
+    @type networkName: str
+    @type userName: str
+    @type password: str
+    @type shapePath: str
+    @type pathMatchFilename: str
+    @type useDirectDist: bool
+    @type graphCache: str
+    @type readStops: bool
+    @return The network, shapes, path-match paths, the shape IDs without paths, and the routes and stops
+    @rtype (graph.GraphLib, dict<int, list<gtfs.ShapesEntry>>, dict<int, list<path_engine.PathEnd>>, set<int>,
+        dict<int, gtfs.RoutesEntry>, dict<int, gtfs.StopsEntry>)
+    """
+    from multiprocessing.pool import ThreadPool
+    centerReady = threading.Event()
+    centers = []
+    "@type centers: list<gps.GPS>"
+    def onCenter(networkGPS):
+        centers.append(networkGPS)
+        centerReady.set()
     
-    # Read in the shapefile information:
-    print("INFO: Read GTFS shapefile...", file = sys.stderr)
-    gtfsShapes = gtfs.fillShapes(shapePath, vistaGraph.gps)
+    gtfsRoutes = None
+    gtfsStops = None
+    pool = ThreadPool(3 if readStops else 1)
+    try:
+        # Read in the topology from the VISTA database, or from the graph cache:
+        graphResult = pool.apply_async(vista_network.loadGraph, (dbServer, networkName, userName, password,
+            useDirectDist), {"graphCache": graphCache, "centerCallback": onCenter})
+        if readStops:
+            print("INFO: Read GTFS routesfile...", file = sys.stderr)
+            routesResult = pool.apply_async(gtfs.fillRoutes, (shapePath,))
+        
+        # Wait for the GPS center, unless reading in the topology fails before then:
+        while not centerReady.wait(0.1):
+            if graphResult.ready():
+                break
+        if not centers:
+            graphResult.get()
+            raise ValueError("The GPS center of the network wasn't found.")
+        if readStops:
+            print("INFO: Read GTFS stopsfile...", file = sys.stderr)
+            stopsResult = pool.apply_async(gtfs.fillStops, (shapePath, centers[0]))
+        
+        # Read in the shapefile information:
+        print("INFO: Read GTFS shapefile...", file = sys.stderr)
+        gtfsShapes = gtfs.fillShapes(shapePath, centers[0])
+        vistaGraph = graphResult.get()
+        if readStops:
+            gtfsRoutes = routesResult.get()
+            gtfsStops = stopsResult.get()
+    finally:
+        pool.close()
+        pool.join()
 
     # Read the path-match file:
     print("INFO: Read the path-match file '%s'..." % pathMatchFilename, file = sys.stderr)
@@ -90,7 +140,7 @@ def restorePathMatch(dbServer, networkName, userName, password, shapePath, pathM
             del gtfsShapes[shapeID]
             unusedShapeIDs.add(shapeID)
 
-    return (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs)
+    return (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, gtfsRoutes, gtfsStops)
 
 def _outHeader(tableName, userName, networkName, outFile):
     print("User,%s" % userName, file = outFile)
@@ -511,6 +561,7 @@ def dumpBusRouteLinks(gtfsTrips, gtfsStopTimes, gtfsNodes, vistaNetwork, stopSea
             for seq in seqs:
                 ourTgtList.append(problemReportNodes[shapeID][seq])
             problemReportNodesOut[shapeID] = ourTgtList                
+        import problem_report
         problem_report.problemReport(problemReportNodesOut, vistaNetwork)
     
     return (ret, warmupStartTime, cooldownEndTime) 
@@ -534,15 +585,18 @@ def dumpBusStops(gtfsStops, stopLinkMap, userName, networkName, outFile = sys.st
         "@type pointOnLink: graph.PointOnLink"
         print('"%d","%d","%s","%d"' % (stopID, pointOnLink.link.id, gtfsStops[stopID].stopName, int(pointOnLink.dist)), file = outFile) 
 
-def readBusRecords(shapePath, vistaGraph, gtfsShapes, unusedShapeIDs, restrictService):
-    # Read in the routes information:
-    print("INFO: Read GTFS routesfile...", file=sys.stderr)
-    gtfsRoutes = gtfs.fillRoutes(shapePath)
+def readBusRecords(shapePath, vistaGraph, gtfsShapes, unusedShapeIDs, restrictService, gtfsRoutes=None,
+                   gtfsStops=None):
+    # Read in the routes information, unless restorePathMatch() had already:
+    if gtfsRoutes is None:
+        print("INFO: Read GTFS routesfile...", file=sys.stderr)
+        gtfsRoutes = gtfs.fillRoutes(shapePath)
     "@type gtfsRoutes: dict<int, RoutesEntry>"
     
     # Read in the stops information:
-    print("INFO: Read GTFS stopsfile...", file=sys.stderr)
-    gtfsStops = gtfs.fillStops(shapePath, vistaGraph.gps)
+    if gtfsStops is None:
+        print("INFO: Read GTFS stopsfile...", file=sys.stderr)
+        gtfsStops = gtfs.fillStops(shapePath, vistaGraph.gps)
     "@type gtfsStops: dict<int, StopsEntry>"
     
     # Read in the trips information:
@@ -558,83 +612,38 @@ def readBusRecords(shapePath, vistaGraph, gtfsShapes, unusedShapeIDs, restrictSe
 
     return gtfsRoutes, gtfsStops, gtfsTrips, gtfsStopTimes
 
-def main(argv):
-    global problemReport
-    excludeUpstream = False
-    
-    # Initialize from command-line parameters:
-    if len(argv) < 7:
-        syntax(1)
-    dbServer = argv[1]
-    networkName = argv[2]
-    userName = argv[3]
-    password = argv[4]
-    shapePath = argv[5]
-    pathMatchFilename = argv[6]
-    endTimeInt = 86400
-    refTime = None
-    widenBegin = False
-    widenEnd = False
-    excludeBegin = False
-    excludeEnd = False
-    
-    restrictService = set()
-    "@type restrictService: set<string>"
-
-    if len(argv) > 6:
-        i = 7
-        while i < len(argv):
-            if argv[i] == "-t" and i < len(argv) - 1:
-                refTime = datetime.strptime(argv[i + 1], '%H:%M:%S')
-                i += 1
-            elif argv[i] == "-e" and i < len(argv) - 1:
-                endTimeInt = int(argv[i + 1])
-                i += 1
-            elif argv[i] == "-c" and i < len(argv) - 1:
-                restrictService.add(argv[i + 1])
-                i += 1
-            elif argv[i] == "-u":
-                excludeUpstream = True
-            elif argv[i] == "-w":
-                widenBegin = True
-                widenEnd = True
-            elif argv[i] == "-wb":
-                widenBegin = True
-            elif argv[i] == "-we":
-                widenEnd = True
-            elif argv[i] == "-x":
-                excludeBegin = True
-                excludeEnd = True
-            elif argv[i] == "-xb":
-                excludeBegin = True
-            elif argv[i] == "-xe":
-                excludeEnd = True
-            elif argv[i] == "-p":
-                problemReport = True
-            i += 1
-    
-    if refTime is None:
-        print("ERROR: No reference time is specified. You must use the -t parameter.", file = sys.stderr)
-        syntax(1)
-    endTime = refTime + timedelta(seconds = endTimeInt)
-    
-    if widenBegin and excludeBegin:
-        print("ERROR: Widening (-w or -wb) and exclusion (-x or -xb) cannot be used together.")
-        syntax(1)    
-    if widenEnd and excludeEnd:
-        print("ERROR: Widening (-w or -we) and exclusion (-x or -xe) cannot be used together.")
-        syntax(1)
-    
+def dumpBusFiles(vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, shapePath, userName, networkName, refTime,
+                 endTimeInt, restrictService, excludeUpstream, widenBegin, widenEnd, excludeBegin, excludeEnd,
+                 gtfsRoutes=None, gtfsStops=None):
+    """
+    dumpBusFiles reads in the rest of the GTFS bus records and writes out the public.bus_*.csv files in the current
+    path for the paths in gtfsNodes, as restored by restorePathMatch() or handed over by pipeline.py.
+    @type vistaGraph: graph.GraphLib
+    @type gtfsShapes: dict<int, list<gtfs.ShapesEntry>>
+    @type gtfsNodes: dict<int, list<path_engine.PathEnd>>
+    @type unusedShapeIDs: set<int>
+    @type shapePath: str
+    @type userName: str
+    @type networkName: str
+    @type refTime: datetime
+    @param endTimeInt: The number of seconds after refTime that the output ends
+    @type endTimeInt: int
+    @type restrictService: set<str>
+    @type excludeUpstream: bool
+    @type widenBegin: bool
+    @type widenEnd: bool
+    @type excludeBegin: bool
+    @type excludeEnd: bool
+    @type gtfsRoutes: dict<int, gtfs.RoutesEntry>
+    @type gtfsStops: dict<int, gtfs.StopsEntry>
+    """
     # Default parameters:
     stopSearchRadius = 800
-    
-    # Restore the stuff that was built with path_match:
-    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs) = restorePathMatch(dbServer, networkName, userName,
-        password, shapePath, pathMatchFilename)
+    endTime = refTime + timedelta(seconds = endTimeInt)
     
     # Read in the stuff from GTFS that further defines buses:
     _, gtfsStops, gtfsTrips, gtfsStopTimes = readBusRecords(shapePath, vistaGraph, gtfsShapes, unusedShapeIDs,
-        restrictService)
+        restrictService, gtfsRoutes, gtfsStops)
         
     # Output the routes_link file:
     print("INFO: Dumping public.bus_route_link.csv...", file = sys.stderr)
@@ -718,6 +727,84 @@ def main(argv):
         print("INFO: New time reference is %s, duration %d sec." % (newStartTime.strftime("%H:%M:%S"), totalTimeDiff.total_seconds()),
             file = sys.stderr)
 
+def main(argv):
+    global problemReport
+    excludeUpstream = False
+    
+    # Initialize from command-line parameters:
+    if len(argv) < 7:
+        syntax(1)
+    dbServer = argv[1]
+    networkName = argv[2]
+    userName = argv[3]
+    password = argv[4]
+    shapePath = argv[5]
+    pathMatchFilename = argv[6]
+    endTimeInt = 86400
+    refTime = None
+    widenBegin = False
+    widenEnd = False
+    excludeBegin = False
+    excludeEnd = False
+    graphCache = None
+    
+    restrictService = set()
+    "@type restrictService: set<string>"
+
+    if len(argv) > 6:
+        i = 7
+        while i < len(argv):
+            if argv[i] == "-t" and i < len(argv) - 1:
+                refTime = datetime.strptime(argv[i + 1], '%H:%M:%S')
+                i += 1
+            elif argv[i] == "-e" and i < len(argv) - 1:
+                endTimeInt = int(argv[i + 1])
+                i += 1
+            elif argv[i] == "-c" and i < len(argv) - 1:
+                restrictService.add(argv[i + 1])
+                i += 1
+            elif argv[i] == "-u":
+                excludeUpstream = True
+            elif argv[i] == "-w":
+                widenBegin = True
+                widenEnd = True
+            elif argv[i] == "-wb":
+                widenBegin = True
+            elif argv[i] == "-we":
+                widenEnd = True
+            elif argv[i] == "-x":
+                excludeBegin = True
+                excludeEnd = True
+            elif argv[i] == "-xb":
+                excludeBegin = True
+            elif argv[i] == "-xe":
+                excludeEnd = True
+            elif argv[i] == "-p":
+                problemReport = True
+            elif argv[i] == "--graph-cache" and i < len(argv) - 1:
+                graphCache = argv[i + 1]
+                i += 1
+            i += 1
+    
+    if refTime is None:
+        print("ERROR: No reference time is specified. You must use the -t parameter.", file = sys.stderr)
+        syntax(1)
+    
+    if widenBegin and excludeBegin:
+        print("ERROR: Widening (-w or -wb) and exclusion (-x or -xb) cannot be used together.")
+        syntax(1)    
+    if widenEnd and excludeEnd:
+        print("ERROR: Widening (-w or -we) and exclusion (-x or -xe) cannot be used together.")
+        syntax(1)
+    
+    # Restore the stuff that was built with path_match:
+    (vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, gtfsRoutes, gtfsStops) = restorePathMatch(dbServer,
+        networkName, userName, password, shapePath, pathMatchFilename, graphCache = graphCache, readStops = True)
+    
+    dumpBusFiles(vistaGraph, gtfsShapes, gtfsNodes, unusedShapeIDs, shapePath, userName, networkName, refTime,
+        endTimeInt, restrictService, excludeUpstream, widenBegin, widenEnd, excludeBegin, excludeEnd, gtfsRoutes,
+        gtfsStops)
+
     print("INFO: Done.", file = sys.stderr)
 
 # Boostrap: